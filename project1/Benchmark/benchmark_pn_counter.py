@@ -0,0 +1,84 @@
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from account_table import AccountTable
+from pn_counter import CounterTable
+
+# Applies the propagations of every other branch to one branch from concurrent threads, like the server's
+# worker threads do: integer balances add each propagation, PN-counters merge the sender's counters. The
+# counters are also fed every propagation twice in a random order, and still end at the right balances,
+# where the integer balances count a redelivered propagation again.
+#
+#   python3 ./Benchmark/benchmark_pn_counter.py --branches 5 --threads 10 --propagations 200000
+
+
+def make_propagations(branches, accounts, propagations):
+    # (origin, account, money, increment, decrement) in the order each origin sent them, and the final balances
+    increments = dict()
+    decrements = dict()
+    balances = [0] * accounts
+    sent = []
+    for i in range(propagations):
+        origin = branches[1 + i % (len(branches) - 1)]
+        account = random.randrange(accounts)
+        money = random.choice([-1, 1]) * random.randint(1, 100)
+        key = (origin, account)
+        if money >= 0:
+            increments[key] = increments.get(key, 0) + money
+        else:
+            decrements[key] = decrements.get(key, 0) - money
+        balances[account] += money
+        sent.append((origin, account, money, increments.get(key, 0), decrements.get(key, 0)))
+    return sent, balances
+
+
+def apply_concurrently(apply, propagations, threads):
+    # every thread gets an interleaved share of the propagations
+    workers = [threading.Thread(target=lambda share: [apply(propagation) for propagation in share],
+                                args=(propagations[i::threads],)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def run(name, table, apply, propagations, threads, balances):
+    elapsed = apply_concurrently(lambda propagation: apply(table, propagation), propagations, threads)
+    correct = all(table.balance(account) == balance for account, balance in enumerate(balances))
+    print(f"{name:>32}: {len(propagations)} in {elapsed:.2f}s, {len(propagations) / elapsed:.0f}/s, "
+          f"balances {'correct' if correct else 'WRONG'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Integer balances and PN-counter merges under concurrent propagation")
+    parser.add_argument("--branches", type=int, default=5)
+    parser.add_argument("--accounts", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=10)
+    parser.add_argument("--propagations", type=int, default=200000)
+    args = parser.parse_args()
+
+    branches = list(range(1, args.branches + 1))
+    propagations, balances = make_propagations(branches, args.accounts, args.propagations)
+    redelivered = propagations * 2
+    random.shuffle(redelivered)
+
+    def add(table, propagation):
+        table.add(propagation[1], propagation[2])
+
+    def merge(table, propagation):
+        origin, account, _, increment, decrement = propagation
+        table.merge(account, origin, increment, decrement)
+
+    run("integer add", AccountTable(), add, propagations, args.threads, balances)
+    run("counter merge", CounterTable(branches, branches[0]), merge, propagations, args.threads, balances)
+    run("integer add, redelivered", AccountTable(), add, redelivered, args.threads, balances)
+    run("counter merge, redelivered", CounterTable(branches, branches[0]), merge, redelivered, args.threads,
+        balances)
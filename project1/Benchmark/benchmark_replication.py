@@ -0,0 +1,115 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent import futures
+
+import grpc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Branch
+from channel_manager import SERVER_OPTIONS
+from latency_stats import LatencyStats
+import distributed_banking_system_pb2
+import distributed_banking_system_pb2_grpc
+
+# Compares the replication modes of Branch: every customer keeps one deposit in flight at a time on its
+# branch, and the branches count the propagation calls they send. Broadcast sends N - 1 per write from the
+# branch that took it, the chain one per branch it passes.
+#
+#   python3 ./Benchmark/benchmark_replication.py --branches 5 --customers 32 --requests 50
+MODES = ["sequential", "parallel", "quorum", "chain"]
+
+
+def run_branch(port, id, branch_id_list, replication_mode, stop, calls_sent):
+    sys.stdout = open(os.devnull, "w")
+    stats = LatencyStats()
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), options=SERVER_OPTIONS)
+    branch = Branch.Branch(id, 0, branch_id_list, replication_mode=replication_mode, stats=stats)
+    distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(branch, server)
+    server.add_insecure_port("[::]:" + port)
+    server.start()
+    branch.channels.warm_up(branch.branch_id_list)
+    stop.wait()
+    calls_sent.put(sum(row["count"] for row in stats.snapshot() if row["side"] == "client"))
+    server.stop(None)
+    branch.channels.close()
+
+
+def start_branches(branch_id_list, replication_mode, stop, calls_sent):
+    processes = []
+    for id in branch_id_list:
+        process = multiprocessing.Process(target=run_branch, args=(str(50050 + id), id, branch_id_list,
+                                                                   replication_mode, stop, calls_sent))
+        process.start()
+        processes.append(process)
+
+    for id in branch_id_list:
+        channel = grpc.insecure_channel(f"localhost:{50050 + id}")
+        grpc.channel_ready_future(channel).result(timeout=10)
+        channel.close()
+    return processes
+
+
+def run_customer(customer_id, branch_id, requests):
+    channel = grpc.insecure_channel(f"localhost:{50050 + branch_id}")
+    stub = distributed_banking_system_pb2_grpc.BankingServiceStub(channel)
+    latencies = []
+    for i in range(requests):
+        event = distributed_banking_system_pb2.Event(id=customer_id * requests + i, interface="deposit", money=1)
+        start = time.perf_counter()
+        stub.MsgDelivery(distributed_banking_system_pb2.BankingOperationRequest(id=customer_id, type="customer",
+                                                                                events=[event]))
+        latencies.append(time.perf_counter() - start)
+    channel.close()
+    return latencies
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def benchmark(replication_mode, branches, customers, requests):
+    branch_id_list = list(range(1, branches + 1))
+    stop = multiprocessing.Event()
+    calls_sent = multiprocessing.Queue()
+    processes = start_branches(branch_id_list, replication_mode, stop, calls_sent)
+    try:
+        start = time.perf_counter()
+        with futures.ThreadPoolExecutor(max_workers=customers) as executor:
+            calls = [executor.submit(run_customer, customer_id, branch_id_list[customer_id % branches], requests)
+                     for customer_id in range(customers)]
+            latencies = sorted(latency for call in calls for latency in call.result())
+        elapsed = time.perf_counter() - start
+        stop.set()
+        sent = [calls_sent.get(timeout=30) for _ in processes]
+    finally:
+        for process in processes:
+            process.join(5)
+            process.terminate()
+
+    return {"mode": replication_mode,
+            "requests": len(latencies),
+            "seconds": elapsed,
+            "requests_per_second": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_calls_per_branch": max(sent),
+            "calls_per_write": sum(sent) / len(latencies)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Broadcast, quorum and chain replication in Branch")
+    parser.add_argument("--branches", type=int, default=5)
+    parser.add_argument("--customers", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    for replication_mode in MODES:
+        result = benchmark(replication_mode, args.branches, args.customers, args.requests)
+        print(f"{result['mode']:>10}: {result['requests']} deposits in {result['seconds']:.2f}s, "
+              f"{result['requests_per_second']:.0f} req/s, "
+              f"p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+              f"{result['calls_per_write']:.1f} calls per write, busiest branch sent {result['max_calls_per_branch']}")
@@ -1,164 +1,1009 @@
+import asyncio
+import functools
+import inspect
 import json
 import multiprocessing
+import os
+import random
+import signal
 import sys
+import threading
 import time
 from concurrent import futures
 import logging
-import datetime
 
 import grpc
 import distributed_banking_system_pb2
 import distributed_banking_system_pb2_grpc
+from account_table import AccountTable, DEFAULT_ACCOUNT
+from pn_counter import CounterTable
+from escrow import Escrow, ESCROW_RESEND_BACKOFF, ESCROW_RESEND_MAX_BACKOFF
+from channel_manager import ChannelManager, SERVER_OPTIONS
+from protobuf_conversion import protobuf_to_dict
+from quorum_replicator import QuorumReplicator, WRITE_QUORUM
+from read_lease import ReadLease, AsyncReadLease, READ_LEASE, SYNC_TIMEOUT
+from request_cache import RequestCache, AsyncRequestCache, DEDUP_CAPACITY, DEDUP_TTL
+from latency_stats import (LatencyStats, ServerLatencyInterceptor, AsyncServerLatencyInterceptor,
+                           ClientLatencyInterceptor, AsyncClientLatencyInterceptor)
+from write_ahead_log import WriteAheadLog
 
-_ONE_DAY = datetime.timedelta(days=1)
+# how propagation is sent to the peers: "sequential" calls one peer after another,
+# "parallel" sends to all peers at once and gathers the acks, "quorum" sends to all peers at once and
+# commits once WRITE_QUORUM branches have the write, the other peers get it in the background, "chain"
+# passes the write from the head of the branch list to its tail, each branch to the next one, and serves
+# the queries at the tail
+REPLICATION_MODE = "sequential"
+# "thread" serves MsgDelivery from a thread pool, "aio" serves it from an asyncio event loop
+SERVER_MODE = "thread"
+# apply a customer's events locally first and send each peer one batch with all of the propagations
+GROUP_COMMIT = False
+# "integer" keeps one balance per account, "counter" keeps a PN-counter per account that propagations merge
+# into, so they apply in any order and any number of times; counter writes are committed like GROUP_COMMIT
+BALANCE_MODE = "integer"
+# split the funds of every account into per-branch allowances: a branch approves withdrawals from its own
+# without asking its peers, answers every write right away and propagates it in the background; implies
+# "counter" balances
+ESCROW = False
+# directory for each branch's write-ahead log and snapshots, None keeps the balance in memory only
+STATE_DIRECTORY = None
+# record per-RPC latency histograms, printed on SIGUSR1 and when the branch stops; the interceptors add
+# to every call, so only the benchmarks turn it on
+LATENCY_STATS = False
 
 
 class Branch(distributed_banking_system_pb2_grpc.BankingServiceServicer):
 
-    def __init__(self, id, balance, branches):
+    def __init__(self, id, balance, branches, replication_mode=REPLICATION_MODE, group_commit=GROUP_COMMIT,
+                 wal=None, stats=None, write_quorum=WRITE_QUORUM, read_lease=READ_LEASE, balance_mode=BALANCE_MODE,
+                 escrow=ESCROW, dedup_capacity=DEDUP_CAPACITY, dedup_ttl=DEDUP_TTL):
         # unique ID of the Branch
         self.id = id
-        # replica of the Branch's balance
-        self.balance = balance
+        # "integer" or "counter" balances; the write-ahead log does not record counters, a branch with one
+        # keeps integers and no escrow
+        self.balance_mode = balance_mode if wal is None else "integer"
+        # this branch's allowances of the accounts' funds, None unless escrow is on
+        self.escrow = None
+        if escrow and wal is None:
+            self.balance_mode = "counter"
+            self.escrow = Escrow(branches, id, balance)
+        # propagations and refills running in the background
+        self.background_calls = set()
+        # replica of the balances of the Branch's accounts, `balance` is the default account
+        self.accounts = CounterTable(branches, id, balance) if self.balance_mode == "counter" else AccountTable(balance)
         # the list of process IDs of the branches
         self.branches = branches
         # the list of Client stubs to communicate with the branches
         self.stubList = list()
+        # latency histograms of the served and the sent calls, None when they are not recorded
+        self.stats = stats
+        # the channels behind the stubs, shared per peer and kept connected
+        self.channels = self.create_channel_manager()
         # a list of received messages used for debugging purpose
         self.recvMsg = list()
         # iterate the processID of the branches
         self.branch_id_list = list()
+        # "sequential", "parallel" or "quorum" propagation to the peers
+        self.replication_mode = replication_mode
+        # acknowledgements and stragglers of the quorum writes, None unless replication_mode is "quorum"
+        self.quorum = QuorumReplicator(len(branches), write_quorum) if replication_mode == "quorum" else None
+        # how long queries are answered from the local balances before the branch syncs with its peers
+        self.lease = self.create_read_lease(read_lease)
+        # responses of the balance changing requests, for the copies a sender resends; None when not cached
+        self.requests = self.create_request_cache(dedup_capacity, dedup_ttl) if dedup_capacity else None
+        # one batched propagation per peer per customer request
+        self.group_commit = group_commit
+        # write-ahead log of the balance changes, None when the balance is not persisted
+        self.wal = wal
+        self.restore_accounts()
         self.initialize_stubs()
 
+    @property
+    def balance(self):
+        # the only account unless the events name one
+        return self.accounts.balance()
+
+    def restore_accounts(self):
+        # the default account is recovered into `balance` already, the others come from the log
+        if self.wal is not None:
+            for account, balance in self.wal.balances.items():
+                if account != DEFAULT_ACCOUNT:
+                    self.accounts.add(account, balance)
+
     def initialize_stubs(self):
-        # Initialize gRPC stubs for communication with other branches
+        # Initialize gRPC stubs for communication with other branches, in a chain only with its neighbours
+        links = self.chain_links() if self.replication_mode == "chain" else self.branches
         for branch_id in self.branches:
-            if branch_id != self.id:
-                port = str(50050 + int(branch_id))
-                address = f"localhost:{port}"
-                channel = grpc.insecure_channel(address)
-                stub = distributed_banking_system_pb2_grpc.BankingServiceStub(channel)
+            if branch_id != self.id and branch_id in links:
+                stub = self.channels.stub(branch_id)
                 self.stubList.append(stub)
+                self.branch_id_list.append(branch_id)
+
+    def chain_links(self):
+        # A write enters the chain at the head and every branch passes it on to the next one; the origin of
+        # the write applies it last, so the branch after it is skipped to. Queries go to the tail
+        position = self.branches.index(self.id)
+        return set(self.branches[:2] + self.branches[position + 1:position + 3] + self.branches[-1:])
+
+    def next_in_chain(self, position, origin):
+        # the branch after `position` in the chain that is not the origin of the write, None after the tail
+        for branch_id in self.branches[position + 1:position + 3]:
+            if branch_id != origin:
+                return branch_id
+        return None
+
+    def stub_for(self, branch_id):
+        return self.stubList[self.branch_id_list.index(branch_id)]
+
+    def create_channel_manager(self):
+        return ChannelManager(interceptors=self.client_interceptors)
+
+    def client_interceptors(self, branch_id):
+        if self.stats is None:
+            return []
+        return [ClientLatencyInterceptor(self.stats, branch_id)]
+
+    def create_read_lease(self, duration):
+        return ReadLease(self.sync_with_peers, duration)
+
+    def create_request_cache(self, capacity, ttl):
+        return RequestCache(self.request_key, capacity, ttl)
+
+    def request_key(self, request):
+        # Customer requests and propagations by (type, sender, customer, event ids and interfaces); the event ids
+        # are unique per customer only, and a branch forwards the events of all of its customers. Syncs, escrow
+        # transfers, requests without ids and queries alone are not cached, a query reads the current balance
+        if request.type not in ("customer", "branch", "chain") or not any(
+                event.id and event.interface != "query" for event in request.events):
+            return None
+        return request.type, request.id, tuple((event.customer, event.id, event.interface) for event in request.events)
+
+    def stamp_customer(self, request):
+        # the propagations of a customer's events carry the customer, for the request keys of the peers
+        for event in request.events:
+            event.customer = request.id
 
     def MsgDelivery(self, request, context):
-        type = request.type
-        response = []
+        # a request that is sent again, after a timeout or by a retry policy, gets the response of the first
+        if self.requests is None:
+            return self.deliver(request)
+        return self.requests.handle(request, functools.partial(self.deliver, request))
+
+    def deliver(self, request):
+        handler = self.handler(request.type)
+        response = handler(request) if handler is not None else []
+        self.wait_durable()
+        return distributed_banking_system_pb2.BankingOperationResponse(id=self.id, recv=response)
+
+    def handler(self, type):
+        # The method that answers a request of `type`, None for the types a branch ignores. AsyncBranch awaits
+        # the ones that call the peers, the others answer right away in both
         match type:
             case "customer":
-                response = self.process_customer_events(request)
+                return self.process_customer_events
             case "branch":
-                response = self.process_branch_events(request)
+                return self.process_branch_events
+            case "chain":
+                return self.process_chain_events
+            case "sync":
+                return self.process_sync
+            case "escrow":
+                return self.process_escrow_events
+        return None
 
-        return distributed_banking_system_pb2.BankingOperationResponse(id=self.id, recv=response)
+    def log_change(self, interface, event_id, money, account=DEFAULT_ACCOUNT):
+        # Write a balance change ahead to the log, it is on disk once wait_durable() returns
+        if self.wal is not None:
+            self.wal.append(interface, event_id, money, account)
+
+    def wait_durable(self):
+        # Block until every logged change is fsynced, concurrent requests share one group fsync
+        if self.wal is not None:
+            self.wal.wait_durable(self.wal.appended)
 
     def process_customer_events(self, request):
+        self.stamp_customer(request)
+        self.hold_read_lease(request)
+        return self.customer_handler()(request)
+
+    def customer_handler(self):
+        # escrow answers from the allowances, counters and group commit send each peer one batch, and
+        # otherwise every write is replicated before the next event is applied
+        if self.escrow is not None:
+            return self.escrow_customer_events
+        if self.group_commit or self.balance_mode == "counter":
+            return self.group_commit_customer_events
+        return self.replicate_customer_events
+
+    def replicate_customer_events(self, request):
         response = list()
         replica_branch_responses = list()
         for event in request.events:
             match event.interface:
                 case "query":
-                    response.append(self.query(event))
-                case "deposit":
-                    deposit_response, propagate_deposit_response = self.deposit(event)
-                    response.append(deposit_response)
-                    replica_branch_responses.extend(propagate_deposit_response)
-                case "withdraw":
-                    withdraw_response, propagate_withdraw_response = self.withdraw(event)
-                    response.append(withdraw_response)
-                    replica_branch_responses.extend(propagate_withdraw_response)
+                    response.append(self.read(event))
+                case "deposit" | "withdraw":
+                    write_response, propagate_write_response = self.write(event)
+                    response.append(write_response)
+                    replica_branch_responses.extend(propagate_write_response)
+
+        self.record_replica_responses(replica_branch_responses)
+        return response
 
+    def record_replica_responses(self, replica_branch_responses):
         replica_branch_dict_responses = []
         for replica_branch_response in replica_branch_responses:
             replica_branch_dict_responses.append(protobuf_to_dict(replica_branch_response))
 
         self.recvMsg.extend(replica_branch_dict_responses)
         print(replica_branch_dict_responses)
+
+    def group_commit_customer_events(self, request):
+        response = list()
+        for events, query in self.commit_batches(request.events):
+            if events:
+                response.extend(self.commit_batch(events))
+            if query is not None:
+                response.append(self.read(query))
+        return response
+
+    def commit_batch(self, events):
+        response, applied = self.apply_customer_events(events)
+        replica_branch_responses = []
+        if applied:
+            try:
+                replica_branch_responses = self.replicate([event for event, _ in applied])
+            except:
+                self.roll_back(applied)
+            else:
+                self.release_deposits(applied)
+                self.log_batch(applied)
+        self.record_replica_responses(replica_branch_responses)
+        return response
+
+    def commit_batches(self, events):
+        # (events, query) per batch of a customer request. In a chain the tail answers the queries, so the
+        # writes before a query are committed as a batch of their own and reach the tail before it is asked;
+        # anywhere else the whole request is one batch and its queries are answered locally in between
+        if self.read_from() is None:
+            return [(list(events), None)]
+        batches = list()
+        batch = list()
+        for event in events:
+            if event.interface == "query":
+                batches.append((batch, event))
+                batch = list()
+            else:
+                batch.append(event)
+        if batch:
+            batches.append((batch, None))
+        return batches
+
+    def apply_customer_events(self, events):
+        # Validate and apply the events in order, returning the responses and the (event, response) pairs to propagate.
+        # The deposits are held until the batch is replicated, other requests cannot spend them before and a roll
+        # back cannot take back money that is gone; the batch's own withdrawals may spend them
+        response = list()
+        applied = list()
+        # per account, what the batch deposited so far
+        credits = dict()
+        for event in events:
+            match event.interface:
+                case "query":
+                    response.append(self.query(event))
+                case "deposit":
+                    self.accounts.add(event.account, event.money)
+                    self.accounts.hold(event.account, event.money)
+                    credits[event.account] = credits.get(event.account, 0) + event.money
+                    self.stamp_counters(event)
+                    event_response = {'interface': 'deposit', 'result': 'success'}
+                    response.append(event_response)
+                    applied.append((event, event_response))
+                case "withdraw":
+                    event_response = {'interface': 'withdraw', 'result': 'failed'}
+                    if self.accounts.withdraw(event.account, event.money, credits.get(event.account, 0)):
+                        self.stamp_counters(event)
+                        event_response['result'] = 'success'
+                        applied.append((event, event_response))
+                    response.append(event_response)
+        return response, applied
+
+    def log_batch(self, applied):
+        for event, _ in applied:
+            self.log_change(event.interface, event.id, event.money, event.account)
+
+    def stamp_counters(self, event):
+        # the propagation carries this branch's counters of the account, which include the event by now
+        if self.balance_mode == "counter":
+            event.increment, event.decrement = self.accounts.state(event.account)
+
+    def escrow_customer_events(self, request):
+        # Answer the events from this branch's allowances and send the peers the counters in the background;
+        # only a withdrawal its allowance does not cover waits, for the peers to grant it more
+        response = list()
+        applied = list()
+        for event in request.events:
+            shortfall = self.shortfall(event)
+            if shortfall > 0:
+                self.refill(event.account, shortfall)
+            response.extend(self.apply_escrow_event(event, applied))
+        if applied:
+            self.propagate_in_background(applied)
+        return response
+
+    def shortfall(self, event):
+        # what a withdrawal needs on top of this branch's allowance
+        if event.interface != "withdraw":
+            return 0
+        return event.money - self.escrow.allowance(event.account)
+
+    def apply_escrow_event(self, event, applied):
+        # the responses of the event, it goes into `applied` if it changed the balance
+        match event.interface:
+            case "query":
+                return [self.query(event)]
+            case "deposit":
+                self.escrow.add(event.account, event.money)
+                self.accounts.add(event.account, event.money)
+            case "withdraw":
+                if not self.escrow.take(event.account, event.money):
+                    self.escrow.refuse()
+                    return [{'interface': 'withdraw', 'result': 'failed'}]
+                self.accounts.add(event.account, -event.money)
+                if self.escrow.start_refill(event.account):
+                    self.refill_in_background(event.account)
+            case _:
+                return []
+        self.stamp_counters(event)
+        applied.append(event)
+        return [{'interface': event.interface, 'result': 'success'}]
+
+    def process_escrow_events(self, request):
+        # A peer runs low on the accounts' allowances: give it part of this branch's
+        response = list()
+        for event in request.events:
+            granted = 0 if self.escrow is None else self.escrow.grant(request.id, event.id, event.account, event.money)
+            response.append({'interface': 'transfer', 'result': 'success', 'money': granted})
         return response
 
+    def transfer_request(self, transfer_id, account, money):
+        transfer = distributed_banking_system_pb2.Event(id=transfer_id, interface="transfer", account=account,
+                                                        money=money)
+        return distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="escrow", events=[transfer])
+
+    def refill(self, account, wanted):
+        # Ask the peers for the account's unconfirmed transfers again, then the others, in random order, for
+        # allowance until they granted `wanted`; an unreachable peer is not waited for
+        received = 0
+        for transfer_id, branch_id, money in self.escrow.retry_transfers(account):
+            received += self.transfer(transfer_id, branch_id, account, money)
+        for branch_id in self.refill_peers():
+            if received >= wanted:
+                break
+            money = wanted - received
+            received += self.transfer(self.escrow.start_transfer(branch_id, account, money), branch_id, account, money)
+        return received
+
+    def refill_peers(self):
+        peers = [branch_id for branch_id in self.branches if branch_id != self.id]
+        random.shuffle(peers)
+        return peers
+
+    def transfer(self, transfer_id, branch_id, account, money):
+        # the allowance the peer granted in the transfer, 0 if the call failed and the transfer is unconfirmed
+        try:
+            response = self.channels.stub(branch_id).MsgDelivery(self.transfer_request(transfer_id, account, money),
+                                                                 wait_for_ready=False)
+        except grpc.RpcError as e:
+            print(f"Failed to ask branch {branch_id} for allowance: {e.code()}")
+            self.escrow.fail_transfer(transfer_id)
+            return 0
+        return self.escrow.finish_transfer(transfer_id, response.recv[0].money)
+
+    def refill_in_background(self, account):
+        threading.Thread(target=self.refill_low_allowance, args=(account,), daemon=True).start()
+
+    def refill_low_allowance(self, account):
+        try:
+            self.refill(account, self.escrow.low_water)
+        finally:
+            self.escrow.finish_refill(account)
+
+    def propagate_in_background(self, events):
+        # Counters merge in any order and any number of times; the accounts of a propagation that fails are sent
+        # to the peer again, with their latest counters, until it acknowledges them
+        request = self.propagation_request(events)
+        accounts = {event.account for event in events}
+        for branch_id in self.branches:
+            if branch_id != self.id:
+                call = self.channels.stub(branch_id).MsgDelivery.future(request)
+                self.background_calls.add(call)
+                call.add_done_callback(functools.partial(self.background_call_done, branch_id, accounts))
+
+    def background_call_done(self, branch_id, accounts, call):
+        self.background_calls.discard(call)
+        if not call.cancelled() and call.exception() is not None:
+            print(f"Failed to propagate to branch {branch_id} in the background: {call.exception().code()}")
+            if self.escrow.mark_stale(branch_id, accounts):
+                self.resend_in_background(branch_id)
+
+    def resend_in_background(self, branch_id):
+        threading.Thread(target=self.resend_counters, args=(branch_id,), daemon=True).start()
+
+    def resend_counters(self, branch_id):
+        # Send the peer the latest counters of its stale accounts until it has acknowledged all of them
+        delay = ESCROW_RESEND_BACKOFF
+        while accounts := self.escrow.take_stale(branch_id):
+            try:
+                self.channels.stub(branch_id).MsgDelivery(self.counters_request(accounts), wait_for_ready=False)
+                delay = ESCROW_RESEND_BACKOFF
+            except grpc.RpcError as e:
+                print(f"Failed to resend counters to branch {branch_id}: {e.code()}")
+                self.escrow.mark_stale(branch_id, accounts)
+                time.sleep(delay)
+                delay = min(2 * delay, ESCROW_RESEND_MAX_BACKOFF)
+
+    def counters_request(self, accounts):
+        # this branch's counters of the accounts as they are now, they cover every propagation before
+        events = []
+        for account in sorted(accounts):
+            increment, decrement = self.accounts.state(account)
+            events.append(distributed_banking_system_pb2.Event(interface="counters", account=account,
+                                                               increment=increment, decrement=decrement))
+        return self.propagation_request(events)
+
+    def release_deposits(self, applied):
+        # the batch is replicated, its deposits may be spent
+        for event, _ in applied:
+            if event.interface == "deposit":
+                self.accounts.settle(event.account, event.money, False)
+
+    def roll_back(self, applied):
+        # The batch did not reach every peer: undo it locally and report its events as failed. Undoing adds to
+        # the counters, the peers that have the batch get the undo with the next propagation. The deposits were
+        # held, so nobody else spent them
+        for event, event_response in reversed(applied):
+            match event.interface:
+                case "deposit":
+                    self.accounts.add(event.account, -event.money)
+                    self.accounts.settle(event.account, event.money, False)
+                case "withdraw":
+                    self.accounts.add(event.account, event.money)
+            event_response['result'] = 'failed'
+
+    def hold_read_lease(self, request):
+        # queries are answered from the local balances, the lease bounds how stale they may be
+        if has_queries(request) and not self.lease.hold():
+            print(f"Branch {self.id} answers a query without having synced with its peers")
+
+    def sync_with_peers(self):
+        # Without quorum writes a write commits only once every peer has it, so the balances are up to date
+        if self.quorum is None:
+            return True
+        request = self.sync_request()
+        calls = [stub.MsgDelivery.future(request, timeout=SYNC_TIMEOUT) for stub in self.stubList]
+        return self.synced(outcome(call) for call in calls)
+
+    def sync_request(self):
+        return distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="sync")
+
+    def synced(self, results):
+        # Whether every peer has the writes that committed there, from its response or the RpcError it failed with
+        for result in results:
+            if isinstance(result, grpc.RpcError):
+                print(f"Failed to sync with the peers: {result.code()}")
+                return False
+            if isinstance(result, BaseException):
+                raise result
+            if result.recv[0].result != "success":
+                return False
+        return True
+
+    def process_sync(self, request):
+        # The peer renews its read lease: wait until it has every write that committed here
+        flushed = self.quorum is None or self.quorum.flush(request.id, SYNC_TIMEOUT)
+        return [self.sync_response(flushed)]
+
+    def sync_response(self, flushed):
+        return {'interface': 'sync', 'result': 'success' if flushed else 'failed'}
+
+    def read(self, event):
+        # In a chain the tail has every write that went through, so it answers the queries
+        tail = self.read_from()
+        if tail is None:
+            return self.query(event)
+        try:
+            return protobuf_to_dict(self.stub_for(tail).MsgDelivery(self.tail_request(event)).recv[0])
+        except grpc.RpcError as e:
+            print(f"Failed to reach the tail of the chain, branch {tail}: {e.code()}")
+            return self.query(event)
+
+    def read_from(self):
+        # the branch that answers this branch's queries, None when it answers them itself
+        tail = self.branches[-1]
+        return tail if self.replication_mode == "chain" and tail != self.id else None
+
+    def tail_request(self, event):
+        return distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="customer", events=[event])
+
     def query(self, request):
-        return {'interface': 'query', 'result': None, 'balance': self.balance}
+        return {'interface': 'query', 'result': None, 'balance': self.accounts.balance(request.account)}
 
-    def deposit(self, event):
+    def write(self, event):
+        # Replicate a deposit, or a withdrawal the balance covers, to the peers and apply it once they have it
+        if not self.begin_write(event):
+            return {'interface': event.interface, 'result': 'failed'}, []
         result = "failed"
         replica_branch_responses = []
         try:
-            replica_branch_responses = self.replicate_deposit(event)
-            self.balance += event.money
+            replica_branch_responses = self.replicate([event])
             result = "success"
         except:
             result = "failed"
             replica_branch_responses = []
-        response = {'interface': 'deposit', 'result': result}
+        finally:
+            self.finish_write(event, result == "success")
+        response = {'interface': event.interface, 'result': result}
         return response, replica_branch_responses
 
-    def withdraw(self, event):
-        result = "failed"
-        replica_branch_responses = []
-        try:
-            if self.balance >= event.money:
-                replica_branch_responses = self.replicate_withdraw(event)
-                self.balance -= event.money
-                result = "success"
-        except:
-            result = "failed"
-            replica_branch_responses = []
-        response = {'interface': 'withdraw', 'result': result}
-        return response, replica_branch_responses
+    def begin_write(self, event):
+        # A withdrawal holds its money while it replicates, so concurrent withdrawals cannot overdraw; one the
+        # balance does not cover is refused
+        return event.interface != "withdraw" or self.accounts.reserve(event.account, event.money)
+
+    def finish_write(self, event, replicated):
+        if event.interface == "withdraw":
+            self.accounts.settle(event.account, event.money, replicated)
+        elif replicated:
+            self.accounts.add(event.account, event.money)
+        if replicated:
+            self.log_change(event.interface, event.id, event.money, event.account)
 
     def process_branch_events(self, request):
         response = list()
         for event in request.events:
             match event.interface:
                 case "withdraw":
-                    response.append(self.propagate_withdraw(event))
+                    response.append(self.propagate_withdraw(event, request.id))
                 case "deposit":
-                    response.append(self.propagate_deposit(event))
+                    response.append(self.propagate_deposit(event, request.id))
+                case "counters":
+                    response.append(self.merge_counters(event, request.id))
         return response
 
-    def propagate_deposit(self, event):
-        self.balance += event.money
+    def merge_counters(self, event, origin):
+        # the counters a peer resent after a background propagation failed
+        if self.balance_mode == "counter":
+            self.accounts.merge(event.account, origin, event.increment, event.decrement)
+        return {'interface': 'counters', 'result': 'success'}
+
+    def process_chain_events(self, request):
+        # The writes of branch `request.id` on their way down the chain: apply them here and pass them on, the
+        # call returns once the tail has them
+        response = self.process_branch_events(request)
+        successor = self.chain_successor(request)
+        if successor is not None:
+            self.stub_for(successor).MsgDelivery(request)
+        return response
+
+    def chain_successor(self, request):
+        return self.next_in_chain(self.branches.index(self.id), request.id)
+
+    def propagate_deposit(self, event, origin):
+        self.apply_propagation(event, origin, event.money)
+        self.log_change("propagate_deposit", event.id, event.money, event.account)
         return {'interface': 'propagate_deposit', 'result': 'success'}
 
-    def propagate_withdraw(self, request):
-        self.balance -= request.money
+    def propagate_withdraw(self, request, origin):
+        self.apply_propagation(request, origin, -request.money)
+        self.log_change("propagate_withdraw", request.id, request.money, request.account)
         return {'interface': 'propagate_withdraw', 'result': 'success'}
 
-    def replicate_deposit(self, event):
+    def apply_propagation(self, event, origin, money):
+        # a counter propagation that arrives late or a second time is covered already and changes nothing
+        if self.balance_mode == "counter":
+            self.accounts.merge(event.account, origin, event.increment, event.decrement)
+        else:
+            self.accounts.add(event.account, money)
+
+    def replicate(self, events):
+        return self.check_replicas(events, self.send_to_peers(events))
+
+    def check_replicas(self, events, responses):
+        # the responses of the peers that have the events, those that refused one are reported
         replica_branch_responses = []
-        for stub in self.stubList:
-            response = stub.MsgDelivery(
-                distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="branch", events=[event]))
-            if response.recv[0].result != "success":
-                print(f"Failed to replicate deposit to branch {self.stubList.index(stub) + 1}")
+        for branch_id, response in responses:
+            for event, event_result in zip(events, response.recv):
+                if event_result.result != "success":
+                    print(f"Failed to replicate {event.interface} {event.id} to branch {branch_id}")
             replica_branch_responses.append(response)
         return replica_branch_responses
 
-    def replicate_withdraw(self, event):
+    def send_to_peers(self, events):
+        # Propagate the events to every peer and return (branch_id, response) pairs in peer order
+        return self.peer_sender()(self.propagation_request(events))
+
+    def propagation_request(self, events):
+        return distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="branch", events=events)
+
+    def peer_sender(self):
+        match self.replication_mode:
+            case "parallel":
+                return self.fan_out
+            case "chain":
+                return self.send_down_chain
+            case "quorum":
+                return self.send_to_quorum
+        return self.send_in_turn
+
+    def send_in_turn(self, request):
+        return [(branch_id, stub.MsgDelivery(request)) for branch_id, stub in self.peer_stubs()]
+
+    def peer_stubs(self):
+        return zip(self.branch_id_list, self.stubList)
+
+    def send_to_quorum(self, request):
+        return self.quorum.replicate(describe_write(request.events), self.quorum_peers(request))
+
+    def quorum_peers(self, request):
+        return [(branch_id, functools.partial(stub.MsgDelivery, request)) for branch_id, stub in self.peer_stubs()]
+
+    def send_down_chain(self, request):
+        # The first branch of the chain answers once the tail has the events, this branch applies them after
+        first = self.start_chain(request)
+        if first is None:
+            return []
+        return [(first, self.stub_for(first).MsgDelivery(request))]
+
+    def start_chain(self, request):
+        # the first branch of the chain the request goes to, None when this branch is the whole chain
+        first = self.next_in_chain(-1, self.id)
+        if first is not None:
+            request.type = "chain"
+        return first
+
+    def fan_out(self, request):
+        # Send the request to all peers at once, so latency tracks the slowest peer instead of the sum
+        calls = [(branch_id, stub.MsgDelivery.future(request)) for branch_id, stub in self.peer_stubs()]
+        return self.gathered((branch_id, outcome(call)) for branch_id, call in calls)
+
+    def gathered(self, results):
+        # (branch_id, response) of every peer from its response or the RpcError it failed with; once every peer
+        # has answered, the first error fails the operation like the sequential path does
+        responses = []
+        error = None
+        for branch_id, result in results:
+            if isinstance(result, grpc.RpcError):
+                print(f"Failed to reach branch {branch_id}: {result.code()}")
+                error = error or result
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                responses.append((branch_id, result))
+        if error is not None:
+            raise error
+        return responses
+
+
+class AsyncBranch(Branch):
+    # Branch served by grpc.aio: peer propagation is awaited on the event loop instead of holding a thread.
+    # Only the methods that call the peers or wait are overridden, everything they decide on comes from Branch
+
+    def create_channel_manager(self):
+        return ChannelManager(aio=True, interceptors=self.client_interceptors)
+
+    def client_interceptors(self, branch_id):
+        if self.stats is None:
+            return []
+        return [AsyncClientLatencyInterceptor(self.stats, branch_id)]
+
+    def create_read_lease(self, duration):
+        return AsyncReadLease(self.sync_with_peers, duration)
+
+    def create_request_cache(self, capacity, ttl):
+        return AsyncRequestCache(self.request_key, capacity, ttl)
+
+    async def MsgDelivery(self, request, context):
+        if self.requests is None:
+            return await self.deliver(request)
+        return await self.requests.handle(request, functools.partial(self.deliver, request))
+
+    async def deliver(self, request):
+        handler = self.handler(request.type)
+        response = handler(request) if handler is not None else []
+        if inspect.isawaitable(response):
+            response = await response
+        if self.wal is not None:
+            await asyncio.to_thread(self.wait_durable)
+        return distributed_banking_system_pb2.BankingOperationResponse(id=self.id, recv=response)
+
+    async def process_customer_events(self, request):
+        self.stamp_customer(request)
+        await self.hold_read_lease(request)
+        return await self.customer_handler()(request)
+
+    async def replicate_customer_events(self, request):
+        response = list()
+        replica_branch_responses = list()
+        for event in request.events:
+            match event.interface:
+                case "query":
+                    response.append(await self.read(event))
+                case "deposit" | "withdraw":
+                    write_response, propagate_write_response = await self.write(event)
+                    response.append(write_response)
+                    replica_branch_responses.extend(propagate_write_response)
+
+        self.record_replica_responses(replica_branch_responses)
+        return response
+
+    async def group_commit_customer_events(self, request):
+        response = list()
+        for events, query in self.commit_batches(request.events):
+            if events:
+                response.extend(await self.commit_batch(events))
+            if query is not None:
+                response.append(await self.read(query))
+        return response
+
+    async def commit_batch(self, events):
+        response, applied = self.apply_customer_events(events)
         replica_branch_responses = []
-        for stub in self.stubList:
-            response = stub.MsgDelivery(
-                distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="branch", events=[event]))
-            if response.recv[0].result != "success":
-                print(f"Failed to replicate withdrawal to branch {self.stubList.index(stub) + 1}")
-            replica_branch_responses.append(response)
-        return replica_branch_responses
+        if applied:
+            try:
+                replica_branch_responses = await self.replicate([event for event, _ in applied])
+            except Exception:
+                self.roll_back(applied)
+            else:
+                self.release_deposits(applied)
+                self.log_batch(applied)
+        self.record_replica_responses(replica_branch_responses)
+        return response
+
+    async def escrow_customer_events(self, request):
+        response = list()
+        applied = list()
+        for event in request.events:
+            shortfall = self.shortfall(event)
+            if shortfall > 0:
+                await self.refill(event.account, shortfall)
+            response.extend(self.apply_escrow_event(event, applied))
+        if applied:
+            self.propagate_in_background(applied)
+        return response
+
+    async def refill(self, account, wanted):
+        received = 0
+        for transfer_id, branch_id, money in self.escrow.retry_transfers(account):
+            received += await self.transfer(transfer_id, branch_id, account, money)
+        for branch_id in self.refill_peers():
+            if received >= wanted:
+                break
+            money = wanted - received
+            received += await self.transfer(self.escrow.start_transfer(branch_id, account, money), branch_id, account,
+                                            money)
+        return received
+
+    async def transfer(self, transfer_id, branch_id, account, money):
+        try:
+            response = await self.channels.stub(branch_id).MsgDelivery(
+                self.transfer_request(transfer_id, account, money), wait_for_ready=False)
+        except grpc.RpcError as e:
+            print(f"Failed to ask branch {branch_id} for allowance: {e.code()}")
+            self.escrow.fail_transfer(transfer_id)
+            return 0
+        return self.escrow.finish_transfer(transfer_id, response.recv[0].money)
+
+    def refill_in_background(self, account):
+        task = asyncio.ensure_future(self.refill_low_allowance(account))
+        self.background_calls.add(task)
+        task.add_done_callback(self.background_calls.discard)
+
+    async def refill_low_allowance(self, account):
+        try:
+            await self.refill(account, self.escrow.low_water)
+        finally:
+            self.escrow.finish_refill(account)
 
+    def propagate_in_background(self, events):
+        request = self.propagation_request(events)
+        accounts = {event.account for event in events}
+        for branch_id in self.branches:
+            if branch_id != self.id:
+                # the event loop only holds weak references to the tasks
+                task = asyncio.ensure_future(self.channels.stub(branch_id).MsgDelivery(request))
+                self.background_calls.add(task)
+                task.add_done_callback(functools.partial(self.background_call_done, branch_id, accounts))
+
+    def resend_in_background(self, branch_id):
+        task = asyncio.ensure_future(self.resend_counters(branch_id))
+        self.background_calls.add(task)
+        task.add_done_callback(self.background_calls.discard)
+
+    async def resend_counters(self, branch_id):
+        delay = ESCROW_RESEND_BACKOFF
+        while accounts := self.escrow.take_stale(branch_id):
+            try:
+                await self.channels.stub(branch_id).MsgDelivery(self.counters_request(accounts), wait_for_ready=False)
+                delay = ESCROW_RESEND_BACKOFF
+            except grpc.RpcError as e:
+                print(f"Failed to resend counters to branch {branch_id}: {e.code()}")
+                self.escrow.mark_stale(branch_id, accounts)
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, ESCROW_RESEND_MAX_BACKOFF)
+
+    async def hold_read_lease(self, request):
+        if has_queries(request) and not await self.lease.hold():
+            print(f"Branch {self.id} answers a query without having synced with its peers")
+
+    async def sync_with_peers(self):
+        if self.quorum is None:
+            return True
+        request = self.sync_request()
+        return self.synced(await asyncio.gather(*(stub.MsgDelivery(request, timeout=SYNC_TIMEOUT)
+                                                  for stub in self.stubList), return_exceptions=True))
+
+    async def process_sync(self, request):
+        flushed = self.quorum is None or await self.quorum.flush_async(request.id, SYNC_TIMEOUT)
+        return [self.sync_response(flushed)]
+
+    async def read(self, event):
+        tail = self.read_from()
+        if tail is None:
+            return self.query(event)
+        try:
+            return protobuf_to_dict((await self.stub_for(tail).MsgDelivery(self.tail_request(event))).recv[0])
+        except grpc.RpcError as e:
+            print(f"Failed to reach the tail of the chain, branch {tail}: {e.code()}")
+            return self.query(event)
+
+    async def write(self, event):
+        if not self.begin_write(event):
+            return {'interface': event.interface, 'result': 'failed'}, []
+        result = "failed"
+        replica_branch_responses = []
+        try:
+            replica_branch_responses = await self.replicate([event])
+            result = "success"
+        except Exception:
+            result = "failed"
+            replica_branch_responses = []
+        finally:
+            self.finish_write(event, result == "success")
+        response = {'interface': event.interface, 'result': result}
+        return response, replica_branch_responses
+
+    async def process_chain_events(self, request):
+        response = self.process_branch_events(request)
+        successor = self.chain_successor(request)
+        if successor is not None:
+            await self.stub_for(successor).MsgDelivery(request)
+        return response
+
+    async def replicate(self, events):
+        return self.check_replicas(events, await self.send_to_peers(events))
+
+    async def send_to_peers(self, events):
+        return await self.peer_sender()(self.propagation_request(events))
+
+    async def send_in_turn(self, request):
+        return [(branch_id, await stub.MsgDelivery(request)) for branch_id, stub in self.peer_stubs()]
+
+    async def send_to_quorum(self, request):
+        return await self.quorum.replicate_async(describe_write(request.events), self.quorum_peers(request))
+
+    async def send_down_chain(self, request):
+        first = self.start_chain(request)
+        if first is None:
+            return []
+        return [(first, await self.stub_for(first).MsgDelivery(request))]
 
-def serve(port, id, balance, branch_id_list, result_queue):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(Branch(id, balance, branch_id_list),
-                                                                             server)
+    async def fan_out(self, request):
+        results = await asyncio.gather(*(stub.MsgDelivery(request) for stub in self.stubList), return_exceptions=True)
+        return self.gathered(zip(self.branch_id_list, results))
+
+
+def has_queries(request):
+    return any(event.interface == "query" for event in request.events)
+
+
+def outcome(call):
+    # the response of a grpc future, or the RpcError it failed with, once it is done
+    error = call.exception()
+    return error if error is not None else call.result()
+
+
+def describe_write(events):
+    # how the quorum records name a write
+    return ", ".join(f"{event.interface} {event.id}" for event in events)
+
+
+def serve(port, id, balance, branch_id_list, result_queue, server_mode=SERVER_MODE):
+    wal, balance = open_write_ahead_log(id, balance)
+    if server_mode == "aio":
+        asyncio.run(serve_async(port, id, balance, branch_id_list, wal))
+        return
+
+    stats = LatencyStats() if LATENCY_STATS else None
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), options=SERVER_OPTIONS,
+                         interceptors=[ServerLatencyInterceptor(stats)] if stats is not None else None)
+    branch = Branch(id, balance, branch_id_list, wal=wal, stats=stats)
+    dump_stats_on_signal(id, stats, branch)
+    distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(branch, server)
     server.add_insecure_port("[::]:" + port)
     server.start()
     print("Server started, listening on " + port)
+    # connect to the peers before the first customer request needs them
+    branch.channels.warm_up(branch.branch_id_list)
+    print(f"Branch {id} peer channels: {branch.channels.connection_states()}")
     wait_for_termination(server)
+    branch.channels.close()
+    dump_stats(id, stats, branch)
+    if wal is not None:
+        wal.close()
     result_queue.put(server)
 
 
+def dump_stats(id, stats, branch):
+    if stats is not None:
+        stats.dump(f"Branch {id} latency")
+    if branch.quorum is not None:
+        print(f"Branch {id} quorum writes: {json.dumps(branch.quorum.snapshot())}")
+    print(f"Branch {id} read lease: {json.dumps(branch.lease.snapshot())}")
+    if branch.escrow is not None:
+        print(f"Branch {id} escrow: {json.dumps(branch.escrow.snapshot())}")
+    if branch.requests is not None:
+        print(f"Branch {id} request cache: {json.dumps(branch.requests.snapshot())}")
+
+
+def dump_stats_on_signal(id, stats, branch, loop=None):
+    # kill -USR1 <pid> prints the branch's p50/p99/p999 per request type, interface and peer, what its
+    # quorum writes left unacknowledged, its read lease renewals and expirations, its escrow allowances and
+    # the requests it answered from its request cache
+    # With an event loop the dump runs as one of its callbacks: a signal.signal() handler would interrupt the
+    # loop's thread, which may hold the locks the dump takes, and wait for them forever
+    if hasattr(signal, "SIGUSR1"):
+        if loop is not None:
+            loop.add_signal_handler(signal.SIGUSR1, dump_stats, id, stats, branch)
+        else:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: dump_stats(id, stats, branch))
+
+
+def open_write_ahead_log(id, balance):
+    # Recover the branch from its newest snapshot and log tail, returns (log, balance)
+    if STATE_DIRECTORY is None:
+        return None, balance
+    wal = WriteAheadLog(os.path.join(STATE_DIRECTORY, f"branch_{id}"))
+    recovered_balance = wal.recover(balance)
+    print(f"Branch {id} recovered balance {recovered_balance}")
+    return wal, recovered_balance
+
+
+async def serve_async(port, id, balance, branch_id_list, wal=None):
+    # the aio channels of the peer stubs bind to the running loop, so the servicer is built in here
+    stats = LatencyStats() if LATENCY_STATS else None
+    server = grpc.aio.server(options=SERVER_OPTIONS,
+                             interceptors=[AsyncServerLatencyInterceptor(stats)] if stats is not None else None)
+    branch = AsyncBranch(id, balance, branch_id_list, wal=wal, stats=stats)
+    dump_stats_on_signal(id, stats, branch, asyncio.get_running_loop())
+    distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(branch, server)
+    server.add_insecure_port("[::]:" + port)
+    await server.start()
+    print("Async server started, listening on " + port)
+    await branch.channels.warm_up_async(branch.branch_id_list)
+    print(f"Branch {id} peer channels: {branch.channels.connection_states()}")
+    try:
+        await server.wait_for_termination()
+    finally:
+        await server.stop(None)
+        await branch.channels.close_async()
+        dump_stats(id, stats, branch)
+        if wal is not None:
+            wal.close()
+
+
 def wait_for_termination(server):
     try:
-        while True:
-            time.sleep(_ONE_DAY.total_seconds())
+        server.wait_for_termination()
     except KeyboardInterrupt:
         server.stop(None)
 
@@ -229,19 +1074,6 @@ def populate_branch_id_list(branch_id_list):
         print(f"An error occurred: {str(e)}")
 
 
-def protobuf_to_dict(message):
-    result = {}
-    for field, value in message.ListFields():
-        if field.type == field.TYPE_MESSAGE:
-            if field.label == field.LABEL_REPEATED:
-                result[field.name] = [protobuf_to_dict(item) for item in value]
-            else:
-                result[field.name] = protobuf_to_dict(value)
-        else:
-            result[field.name] = value
-    return result
-
-
 if __name__ == "__main__":
     logging.basicConfig()
     branch_id_list = []
@@ -1,51 +1,38 @@
 import multiprocessing
-import os
 import sys
 
-import grpc
 import distributed_banking_system_pb2
-import distributed_banking_system_pb2_grpc
+from channel_manager import ChannelManager, CUSTOMER_CHANNEL_OPTIONS, CUSTOMER_WARM_UP_TIMEOUT
+from customer_driver import run_customers
+from output_collector import OutputCollector
+from protobuf_conversion import protobuf_to_dict
 import json
-import time
 
 OUTPUT_FILE_PATH = "./Output/output.json"
-
-
-def dict_to_str(response):
-    return str(protobuf_to_dict(response)) + "\n"
-
-
-def protobuf_to_dict(message):
-    result = {}
-    for field, value in message.ListFields():
-        if field.type == field.TYPE_MESSAGE:
-            if field.label == field.LABEL_REPEATED:
-                result[field.name] = [protobuf_to_dict(item) for item in value]
-            else:
-                result[field.name] = protobuf_to_dict(value)
-        else:
-            result[field.name] = value
-    return result
+# "process" starts one process per customer, each after the previous customer has completed,
+# "pool" runs all customers concurrently on a few worker processes with an event loop each
+DRIVER_MODE = "process"
+# "lines" writes str() of every response on its own line, "ndjson" one JSON object per line
+OUTPUT_FORMAT = "lines"
 
 
 class Customer:
-    def __init__(self, id, events):
+    def __init__(self, id, events, channels=None):
         # unique ID of the Customer
         self.id = id
         # events from the input
         self.events = events
         # a list of received messages used for debugging purpose
         self.recvMsg = list()
+        # the channel to the branch, kept connected by the manager; a pool worker shares its manager
+        self.channels = channels if channels is not None else ChannelManager(options=CUSTOMER_CHANNEL_OPTIONS)
         # pointer for the stub
         self.stub = self.createStub()
 
     def createStub(self):
-        port = str(50050 + int(id))
-
-        address = f"localhost:{port}"
-        channel = grpc.insecure_channel(address)
-        return distributed_banking_system_pb2_grpc.BankingServiceStub(channel)
-
+        # the customer talks to the branch with the same id
+        self.channels.warm_up([self.id], CUSTOMER_WARM_UP_TIMEOUT)
+        return self.channels.stub(self.id)
 
     def executeEvents(self):
         banking_service_stub = self.stub
@@ -61,18 +48,39 @@ class Customer:
         print(branch_dict_response)
 
 
-def start_customer_process(id, events):
-    customer = Customer(id, events)
-    branch_response = customer.executeEvents()
+class AsyncCustomer(Customer):
+    # Customer session of the pool driver, on the worker's shared grpc.aio channels
+
+    def createStub(self):
+        # the driver warmed up the channels to every branch before the sessions start
+        return self.channels.stub(self.id)
+
+    async def executeEvents(self):
+        return await self.stub.MsgDelivery(
+            distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="customer", events=self.events))
+
+
+async def run_customer_session(item, channels):
+    customer = AsyncCustomer(item["id"], item["events"], channels)
+    branch_response = await customer.executeEvents()
     customer.update_recvMsg(branch_response)
+    return customer.recvMsg
+
 
-    directory = os.path.dirname(OUTPUT_FILE_PATH)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+def run_customer_pool(customers, collector):
+    # every customer talks to the branch with its own id
+    results = run_customers(customers, run_customer_session, sorted({item["id"] for item in customers}))
+    for index, result in enumerate(results):
+        collector.put(index, result)
 
-    output_file = open(OUTPUT_FILE_PATH, "a")
-    output_file.write(dict_to_str(branch_response))
-    output_file.close()
+
+def start_customer_process(index, id, events, output_queue):
+    customer = Customer(id, events)
+    branch_response = customer.executeEvents()
+    customer.channels.close()
+    customer.update_recvMsg(branch_response)
+    # the collector in the parent is the only writer of the output file
+    output_queue.put((index, customer.recvMsg))
 
 
 if __name__ == '__main__':
@@ -89,25 +97,28 @@ if __name__ == '__main__':
         processes = []
         result_queue = multiprocessing.Queue()
         parsed_data = json.load(input_file)
-        for item in parsed_data:
-            if item["type"] != "customer":
-                continue
-
-            id = item["id"]
-            type = item["type"]
-            events = item["events"]
-            # print("ID:", item["id"])
-            # print("Type:", item["type"])
-            # print("Events:", item["events"])
-            process = multiprocessing.Process(target=start_customer_process,
-                                              args=(id, events))
-            processes.append(process)
-            process.start()
-
-            # sleep for 3 seconds for event propagation
-            time.sleep(3)
-        for process in processes:
-            process.join()
+        customers = [item for item in parsed_data if item["type"] == "customer"]
+        # appends, as the customers did before there was one writer
+        collector = OutputCollector(OUTPUT_FILE_PATH, OUTPUT_FORMAT, mode="a")
+        if DRIVER_MODE == "pool":
+            run_customer_pool(customers, collector)
+        else:
+            for index, item in enumerate(customers):
+                id = item["id"]
+                type = item["type"]
+                events = item["events"]
+                # print("ID:", item["id"])
+                # print("Type:", item["type"])
+                # print("Events:", item["events"])
+                process = multiprocessing.Process(target=start_customer_process,
+                                                  args=(index, id, events, collector.queue))
+                processes.append(process)
+                process.start()
+
+                # a customer's response comes back only after its events are propagated, so the next
+                # customer can start as soon as this one has completed
+                process.join()
+        collector.close()
         print("Customer process completed\n")
     except FileNotFoundError:
         print(f"File not found: {input_file_path}")
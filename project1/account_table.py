@@ -0,0 +1,87 @@
+import threading
+
+# account of the requests that name none; its opening balance is the branch's balance from the input
+DEFAULT_ACCOUNT = 0
+# locks of an account table, accounts of different shards never wait for each other
+ACCOUNT_SHARDS = 16
+
+
+class AccountTable:
+    # Balances of the accounts held at a branch. Every account has a slot in one flat list and `slots` maps
+    # the account to it, so a lookup is one dict access and the table grows by one int per account. An
+    # account is guarded by the lock of its shard (account % shards); adding a slot takes a separate lock.
+
+    def __init__(self, balance=0, shards=ACCOUNT_SHARDS):
+        self.slots = {DEFAULT_ACCOUNT: 0}
+        self.balances = [balance]
+        # money that is in the balance but may not be spent, of writes that are still replicating, per slot
+        self.reserved = [0]
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.slots_lock = threading.Lock()
+
+    def lock(self, account):
+        return self.locks[account % len(self.locks)]
+
+    def slot(self, account):
+        slot = self.slots.get(account)
+        if slot is None:
+            with self.slots_lock:
+                slot = self.slots.get(account)
+                if slot is None:
+                    self.balances.append(0)
+                    self.reserved.append(0)
+                    slot = self.slots[account] = len(self.balances) - 1
+        return slot
+
+    def balance(self, account=DEFAULT_ACCOUNT):
+        slot = self.slots.get(account)
+        return 0 if slot is None else self.balances[slot]
+
+    def add(self, account, money):
+        # Deposits add, propagated withdrawals and undone deposits add a negative amount
+        slot = self.slot(account)
+        with self.lock(account):
+            self.balances[slot] += money
+            return self.balances[slot]
+
+    def withdraw(self, account, money, credit=0):
+        # Take the money if the account covers it without the reserved money, returns whether it did; `credit`
+        # is reserved money the caller may spend, its own deposits that are still replicating
+        if self.balance(account) + credit < money:
+            # also keeps withdrawals from unknown accounts from adding a slot
+            return False
+        slot = self.slot(account)
+        with self.lock(account):
+            if self.balances[slot] - self.reserved[slot] + credit < money:
+                return False
+            self.balances[slot] -= money
+            return True
+
+    def hold(self, account, money):
+        # Keep money that is in the balance from being spent, a deposit's until it is replicated
+        slot = self.slot(account)
+        with self.lock(account):
+            self.reserved[slot] += money
+
+    def reserve(self, account, money):
+        # Hold the money of a withdrawal while it replicates, so concurrent withdrawals cannot overdraw
+        if self.balance(account) < money:
+            return False
+        slot = self.slot(account)
+        with self.lock(account):
+            if self.balances[slot] - self.reserved[slot] < money:
+                return False
+            self.reserved[slot] += money
+            return True
+
+    def settle(self, account, money, withdrawn):
+        # Release a reservation, taking the money out of the account when the withdrawal went through
+        slot = self.slot(account)
+        with self.lock(account):
+            self.reserved[slot] -= money
+            if withdrawn:
+                self.balances[slot] -= money
+
+    def items(self):
+        # (account, balance) of every account, the default one first
+        return [(account, self.balances[slot]) for account, slot in list(self.slots.items())]
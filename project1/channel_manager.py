@@ -0,0 +1,205 @@
+import asyncio
+import functools
+import json
+import threading
+import time
+
+import grpc
+import distributed_banking_system_pb2_grpc
+
+# seconds a branch waits at startup for a peer channel to become ready
+WARM_UP_TIMEOUT = 10
+# seconds a customer waits for its branches, its calls fail fast on a branch that is not up
+CUSTOMER_WARM_UP_TIMEOUT = 1
+# NoCompression, Deflate or Gzip for every call on the channel
+COMPRESSION = grpc.Compression.NoCompression
+MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+# seconds between the wake-ups of grpc's connectivity poller
+CONNECTIVITY_POLL_INTERVAL = 0.2
+# calls between branches wait for a reconnecting peer instead of failing fast; off, a call to a peer that
+# is down fails at once as it did without the manager
+WAIT_FOR_READY = False
+# seconds a MsgDelivery call may take under WAIT_FOR_READY, including the time it waits for its channel to
+# (re)connect; streams are long-lived and get no deadline
+CALL_TIMEOUT = 30
+SERVICE_CONFIG = json.dumps({"methodConfig": [
+    {"name": [{"service": "distributed_banking.BankingService"}],
+     "waitForReady": True},
+    {"name": [{"service": "distributed_banking.BankingService", "method": "MsgDelivery"}],
+     "waitForReady": True,
+     "timeout": f"{CALL_TIMEOUT}s"},
+]})
+CONNECTION_OPTIONS = [
+    # reconnect quickly once a restarted peer is back
+    ("grpc.initial_reconnect_backoff_ms", 100),
+    ("grpc.max_reconnect_backoff_ms", 2000),
+    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+]
+# keepalive pings find a dead peer between requests instead of in the middle of replication; a peer gets
+# a generous timeout to answer, a busy branch is not dropped in the middle of a call
+KEEPALIVE_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 20000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+CHANNEL_OPTIONS = KEEPALIVE_OPTIONS + CONNECTION_OPTIONS
+if WAIT_FOR_READY:
+    CHANNEL_OPTIONS = [("grpc.service_config", SERVICE_CONFIG)] + CHANNEL_OPTIONS
+# customers keep gRPC's defaults: no keepalive pings, a call to a branch that is down fails at once and
+# has no deadline
+CUSTOMER_CHANNEL_OPTIONS = CONNECTION_OPTIONS
+# the server side has to accept the client's keepalive pings
+SERVER_OPTIONS = [
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.min_ping_interval_without_data_ms", 5000),
+    ("grpc.http2.max_ping_strikes", 0),
+    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+]
+
+
+def branch_address(branch_id):
+    return f"localhost:{50050 + int(branch_id)}"
+
+
+class ChannelManager:
+    # One channel per branch, shared by every stub of the process. Channels are warmed up with
+    # channel_ready_future, and a channel that drops to IDLE or TRANSIENT_FAILURE is asked to reconnect
+    # right away, so calls on the hot path find it connected.
+
+    def __init__(self, options=CHANNEL_OPTIONS, compression=COMPRESSION, aio=False, interceptors=None):
+        self.options = options
+        self.compression = compression
+        # grpc.aio channels for the asyncio server and driver
+        self.aio = aio
+        # function of the branch id that returns the client interceptors for its channel
+        self.interceptors = interceptors
+        self.channels = dict()
+        self.stubs = dict()
+        # last connectivity state seen per branch
+        self.states = dict()
+        self.lock = threading.Lock()
+        self.watchers = list()
+        # (channel, callback) of every subscribed channel, unsubscribed before the channel is closed
+        self.subscriptions = dict()
+        # the connection attempt on_state_change() last started per branch
+        self.reconnects = dict()
+        self.closed = False
+
+    def channel(self, branch_id):
+        with self.lock:
+            if branch_id not in self.channels:
+                self.channels[branch_id] = self.create_channel(branch_id)
+            return self.channels[branch_id]
+
+    def stub(self, branch_id):
+        with self.lock:
+            if branch_id not in self.stubs:
+                if branch_id not in self.channels:
+                    self.channels[branch_id] = self.create_channel(branch_id)
+                self.stubs[branch_id] = distributed_banking_system_pb2_grpc.BankingServiceStub(
+                    self.channels[branch_id])
+            return self.stubs[branch_id]
+
+    def create_channel(self, branch_id):
+        address = branch_address(branch_id)
+        interceptors = self.interceptors(branch_id) if self.interceptors is not None else []
+        if self.aio:
+            self.states[branch_id] = grpc.ChannelConnectivity.IDLE
+            return grpc.aio.insecure_channel(address, options=self.options, compression=self.compression,
+                                             interceptors=interceptors)
+
+        channel = grpc.insecure_channel(address, options=self.options, compression=self.compression)
+        callback = functools.partial(self.on_state_change, branch_id, channel)
+        channel.subscribe(callback, try_to_connect=True)
+        self.subscriptions[branch_id] = (channel, callback)
+        if interceptors:
+            return grpc.intercept_channel(channel, *interceptors)
+        return channel
+
+    def on_state_change(self, branch_id, channel, state):
+        self.states[branch_id] = state
+        with self.lock:
+            if self.closed or state not in (grpc.ChannelConnectivity.IDLE, grpc.ChannelConnectivity.TRANSIENT_FAILURE):
+                return
+            reconnect = self.reconnects.get(branch_id)
+            if reconnect is None or reconnect.done():
+                # only starts a connection attempt, nobody waits on it; close() cancels it
+                self.reconnects[branch_id] = grpc.channel_ready_future(channel)
+
+    def warm_up(self, branch_ids, timeout=WARM_UP_TIMEOUT):
+        # Wait until every channel is connected, returns the ids of the branches that did not come up
+        ready_futures = [(branch_id, grpc.channel_ready_future(self.channel(branch_id))) for branch_id in branch_ids]
+        not_ready = []
+        for branch_id, ready_future in ready_futures:
+            try:
+                ready_future.result(timeout=timeout)
+            except grpc.FutureTimeoutError:
+                print(f"Channel to branch {branch_id} is not ready after {timeout}s")
+                # stops watching the channel, the manager keeps reconnecting it
+                ready_future.cancel()
+                not_ready.append(branch_id)
+        return not_ready
+
+    async def warm_up_async(self, branch_ids, timeout=WARM_UP_TIMEOUT):
+        # the channels come up together, a branch that is down costs `timeout` once
+        branch_ids = list(branch_ids)
+        ready = await asyncio.gather(*(self.wait_ready(branch_id, timeout) for branch_id in branch_ids))
+        return [branch_id for branch_id, is_ready in zip(branch_ids, ready) if not is_ready]
+
+    async def wait_ready(self, branch_id, timeout):
+        channel = self.channel(branch_id)
+        self.watchers.append(asyncio.create_task(self.watch(branch_id, channel)))
+        try:
+            await asyncio.wait_for(channel.channel_ready(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            print(f"Channel to branch {branch_id} is not ready after {timeout}s")
+            return False
+
+    async def watch(self, branch_id, channel):
+        # grpc.aio channels have no subscribe(), follow their state changes from a task instead
+        state = channel.get_state(try_to_connect=True)
+        while state != grpc.ChannelConnectivity.SHUTDOWN:
+            self.states[branch_id] = state
+            if state in (grpc.ChannelConnectivity.IDLE, grpc.ChannelConnectivity.TRANSIENT_FAILURE):
+                channel.get_state(try_to_connect=True)
+            await channel.wait_for_state_change(state)
+            state = channel.get_state()
+
+    def connection_states(self):
+        # Per-branch connection state, e.g. {2: "READY", 3: "TRANSIENT_FAILURE"}
+        return {branch_id: state.name for branch_id, state in sorted(self.states.items())}
+
+    def close(self):
+        # grpc keeps polling a channel that has subscribers, even once it is closed
+        with self.lock:
+            self.closed = True
+            for channel, callback in self.subscriptions.values():
+                channel.unsubscribe(callback)
+            for reconnect in self.reconnects.values():
+                reconnect.cancel()
+            subscribed = bool(self.subscriptions)
+            channels = list(self.channels.values())
+            self.subscriptions.clear()
+            self.reconnects.clear()
+            self.channels.clear()
+            self.stubs.clear()
+        # without subscribers the poller stops the second time it wakes up at the latest; until then it may
+        # still check the channel, which fails once the channel is closed. grpc tells nobody when it stops, so
+        # this waits out the poll interval, without the lock
+        if subscribed:
+            time.sleep(2.5 * CONNECTIVITY_POLL_INTERVAL)
+        for channel in channels:
+            channel.close()
+
+    async def close_async(self):
+        self.closed = True
+        for watcher in self.watchers:
+            watcher.cancel()
+        for channel in self.channels.values():
+            await channel.close()
+        self.channels.clear()
+        self.stubs.clear()
@@ -24,21 +24,31 @@ class BankingOperationResponse(_message.Message):
     def __init__(self, id: _Optional[int] = ..., recv: _Optional[_Iterable[_Union[EventResult, _Mapping]]] = ...) -> None: ...
 
 class Event(_message.Message):
-    __slots__ = ["id", "interface", "money"]
+    __slots__ = ["id", "interface", "money", "account", "increment", "decrement", "customer"]
     ID_FIELD_NUMBER: _ClassVar[int]
     INTERFACE_FIELD_NUMBER: _ClassVar[int]
     MONEY_FIELD_NUMBER: _ClassVar[int]
+    ACCOUNT_FIELD_NUMBER: _ClassVar[int]
+    INCREMENT_FIELD_NUMBER: _ClassVar[int]
+    DECREMENT_FIELD_NUMBER: _ClassVar[int]
+    CUSTOMER_FIELD_NUMBER: _ClassVar[int]
     id: int
     interface: str
     money: int
-    def __init__(self, id: _Optional[int] = ..., interface: _Optional[str] = ..., money: _Optional[int] = ...) -> None: ...
+    account: int
+    increment: int
+    decrement: int
+    customer: int
+    def __init__(self, id: _Optional[int] = ..., interface: _Optional[str] = ..., money: _Optional[int] = ..., account: _Optional[int] = ..., increment: _Optional[int] = ..., decrement: _Optional[int] = ..., customer: _Optional[int] = ...) -> None: ...
 
 class EventResult(_message.Message):
-    __slots__ = ["interface", "result", "balance"]
+    __slots__ = ["interface", "result", "balance", "money"]
     INTERFACE_FIELD_NUMBER: _ClassVar[int]
     RESULT_FIELD_NUMBER: _ClassVar[int]
     BALANCE_FIELD_NUMBER: _ClassVar[int]
+    MONEY_FIELD_NUMBER: _ClassVar[int]
     interface: str
     result: str
     balance: int
-    def __init__(self, interface: _Optional[str] = ..., result: _Optional[str] = ..., balance: _Optional[int] = ...) -> None: ...
+    money: int
+    def __init__(self, interface: _Optional[str] = ..., result: _Optional[str] = ..., balance: _Optional[int] = ..., money: _Optional[int] = ...) -> None: ...
@@ -0,0 +1,181 @@
+import threading
+from collections import OrderedDict
+
+from account_table import DEFAULT_ACCOUNT
+
+# allowance below which a branch asks its peers for more of an account's funds in the background
+ESCROW_LOW_WATER = 100
+# share of its allowance a branch gives away at most when a peer asks for some
+ESCROW_GRANT_SHARE = 0.5
+# grants a branch remembers by the asking branch's transfer id, so that a transfer asked for again gets the
+# allowance of the first grant instead of a second one; beyond it the oldest are forgotten
+ESCROW_GRANT_HISTORY = 10000
+# seconds before the counters a peer missed are sent to it again, doubled after every failed resend up to the
+# maximum
+ESCROW_RESEND_BACKOFF = 0.1
+ESCROW_RESEND_MAX_BACKOFF = 5.0
+
+
+class Escrow:
+    # The withdrawable funds of every account split into one allowance per branch. A branch approves a
+    # withdrawal from its own allowance without asking anyone and deposits add to the allowance of the branch
+    # that took them. Allowances only move between branches when one gives part of its own to another, so
+    # they never add up to more than the balance and no sequence of withdrawals at any branches can take an
+    # account below zero. The opening balance of the default account is split evenly.
+    # Every transfer of allowance has an id of the asking branch. The granting branch answers a transfer it
+    # granted before with the same grant, and the asking branch keeps a transfer whose call failed and asks
+    # for it again, from the same peer, until a call succeeds; allowance granted in a call that failed is
+    # received late, not lost. The same goes for the counters a background propagation failed to bring to a
+    # peer: the accounts stay stale for the peer until a resend of their latest counters succeeds.
+
+    def __init__(self, branches, id, balance=0, low_water=ESCROW_LOW_WATER, grant_share=ESCROW_GRANT_SHARE,
+                 grant_history=ESCROW_GRANT_HISTORY):
+        self.low_water = low_water
+        self.grant_share = grant_share
+        self.grant_history = grant_history
+        # the first branch gets the remainder of the split
+        share, remainder = divmod(balance, len(branches))
+        self.allowances = {DEFAULT_ACCOUNT: share + (remainder if branches.index(id) == 0 else 0)}
+        self.lock = threading.Lock()
+        # accounts being refilled in the background
+        self.refilling = set()
+        # id of the last transfer this branch asked for
+        self.transfer_id = 0
+        # transfer id -> (peer, account, money) of the transfers no call succeeded for yet, and the ones of them
+        # a call is on its way for
+        self.unconfirmed = dict()
+        self.in_flight = set()
+        # (asking branch, transfer id) -> allowance granted, the oldest first
+        self.grants = OrderedDict()
+        # peer -> accounts whose latest counters the peer has not acknowledged, and the peers a resend runs for
+        self.stale = dict()
+        self.resending = set()
+        # metrics
+        self.local_withdrawals = 0
+        self.refused_withdrawals = 0
+        self.refills = 0
+        self.received = 0
+        self.granted = 0
+        self.retried_transfers = 0
+        self.repeated_grants = 0
+        self.resent_counters = 0
+
+    def allowance(self, account=DEFAULT_ACCOUNT):
+        return self.allowances.get(account, 0)
+
+    def take(self, account, money):
+        # Approve a withdrawal if the allowance covers it, returns whether it did
+        with self.lock:
+            if self.allowances.get(account, 0) < money:
+                return False
+            self.allowances[account] -= money
+            self.local_withdrawals += 1
+            return True
+
+    def refuse(self):
+        with self.lock:
+            self.refused_withdrawals += 1
+
+    def add(self, account, money):
+        # deposits taken here and undone withdrawals
+        with self.lock:
+            self.allowances[account] = self.allowances.get(account, 0) + money
+
+    def start_transfer(self, branch_id, account, money):
+        # Returns the id of a new transfer of up to `money` from the peer, which is unconfirmed until
+        # finish_transfer()
+        with self.lock:
+            self.transfer_id += 1
+            self.unconfirmed[self.transfer_id] = (branch_id, account, money)
+            self.in_flight.add(self.transfer_id)
+            return self.transfer_id
+
+    def retry_transfers(self, account):
+        # The account's unconfirmed transfers no call is on its way for, as (transfer id, peer, money); they are
+        # on their way from now on
+        with self.lock:
+            transfers = [(transfer_id, branch_id, money)
+                         for transfer_id, (branch_id, transfer_account, money) in self.unconfirmed.items()
+                         if transfer_account == account and transfer_id not in self.in_flight]
+            for transfer_id, _, _ in transfers:
+                self.in_flight.add(transfer_id)
+            self.retried_transfers += len(transfers)
+            return transfers
+
+    def finish_transfer(self, transfer_id, granted):
+        # the peer answered the transfer, its grant goes into the allowance; returns the grant
+        with self.lock:
+            _, account, _ = self.unconfirmed.pop(transfer_id)
+            self.in_flight.discard(transfer_id)
+            self.allowances[account] = self.allowances.get(account, 0) + granted
+            self.received += granted
+            return granted
+
+    def fail_transfer(self, transfer_id):
+        # the call failed, the transfer stays unconfirmed for the next refill of the account
+        with self.lock:
+            self.in_flight.discard(transfer_id)
+
+    def grant(self, branch_id, transfer_id, account, wanted):
+        # Give a peer up to `wanted` of the allowance, at most ESCROW_GRANT_SHARE of it; returns what it gave,
+        # for a transfer granted before what it gave then
+        key = (branch_id, transfer_id)
+        with self.lock:
+            if key in self.grants:
+                self.repeated_grants += 1
+                return self.grants[key]
+            granted = max(min(wanted, int(self.allowances.get(account, 0) * self.grant_share)), 0)
+            if granted > 0:
+                self.allowances[account] -= granted
+                self.granted += granted
+            self.grants[key] = granted
+            while len(self.grants) > self.grant_history:
+                self.grants.popitem(last=False)
+            return granted
+
+    def mark_stale(self, branch_id, accounts):
+        # Returns whether a resend has to be started for the peer, one that runs already picks the accounts up
+        with self.lock:
+            self.stale.setdefault(branch_id, set()).update(accounts)
+            if branch_id in self.resending:
+                return False
+            self.resending.add(branch_id)
+            return True
+
+    def take_stale(self, branch_id):
+        # The stale accounts of the peer, which the resend sends the counters of now; the resend ends when there
+        # are none
+        with self.lock:
+            accounts = self.stale.pop(branch_id, set())
+            if accounts:
+                self.resent_counters += len(accounts)
+            else:
+                self.resending.discard(branch_id)
+            return accounts
+
+    def start_refill(self, account):
+        # Returns whether the account runs low and is not being refilled yet; finish_refill() ends the refill
+        with self.lock:
+            if self.allowances.get(account, 0) >= self.low_water or account in self.refilling:
+                return False
+            self.refilling.add(account)
+            self.refills += 1
+            return True
+
+    def finish_refill(self, account):
+        with self.lock:
+            self.refilling.discard(account)
+
+    def snapshot(self):
+        with self.lock:
+            return {"allowances": {str(account): allowance for account, allowance in self.allowances.items()},
+                    "local_withdrawals": self.local_withdrawals,
+                    "refused_withdrawals": self.refused_withdrawals,
+                    "refills": self.refills,
+                    "received": self.received,
+                    "granted": self.granted,
+                    "unconfirmed_transfers": len(self.unconfirmed),
+                    "retried_transfers": self.retried_transfers,
+                    "repeated_grants": self.repeated_grants,
+                    "stale_accounts": sum(len(accounts) for accounts in self.stale.values()),
+                    "resent_counters": self.resent_counters}
@@ -0,0 +1,110 @@
+import threading
+
+from account_table import DEFAULT_ACCOUNT, ACCOUNT_SHARDS
+
+
+class CounterTable:
+    # Balances of the accounts held at a branch as PN-counters: per account, how much each branch deposited
+    # (its increment) and withdrew (its decrement) in total, on top of the opening balance. A branch only
+    # changes its own entries and a propagation carries them; the peer merges them by keeping the larger of
+    # its entry and the received one. Merges commute and are idempotent, so propagations may be applied in
+    # any order, batched, or delivered twice. The balance is derived from the entries and kept as a running
+    # total, so a read is one list access without a lock; changes to an account take the lock of its shard.
+
+    def __init__(self, branches, id, balance=0, shards=ACCOUNT_SHARDS):
+        # position of each branch's entries in the vectors of an account
+        self.indexes = {branch_id: index for index, branch_id in enumerate(branches)}
+        self.index = self.indexes[id]
+        self.slots = {DEFAULT_ACCOUNT: 0}
+        self.balances = [balance]
+        self.increments = [[0] * len(branches)]
+        self.decrements = [[0] * len(branches)]
+        # money that is in the balance but may not be spent, of deposits that are still replicating
+        self.reserved = [0]
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.slots_lock = threading.Lock()
+
+    def lock(self, account):
+        return self.locks[account % len(self.locks)]
+
+    def slot(self, account):
+        slot = self.slots.get(account)
+        if slot is None:
+            with self.slots_lock:
+                slot = self.slots.get(account)
+                if slot is None:
+                    self.balances.append(0)
+                    self.increments.append([0] * len(self.indexes))
+                    self.decrements.append([0] * len(self.indexes))
+                    self.reserved.append(0)
+                    slot = self.slots[account] = len(self.balances) - 1
+        return slot
+
+    def balance(self, account=DEFAULT_ACCOUNT):
+        slot = self.slots.get(account)
+        return 0 if slot is None else self.balances[slot]
+
+    def add(self, account, money):
+        # A change made at this branch: deposits count in its increment, withdrawals and undone deposits in
+        # its decrement and undone withdrawals in its increment again
+        slot = self.slot(account)
+        with self.lock(account):
+            if money >= 0:
+                self.increments[slot][self.index] += money
+            else:
+                self.decrements[slot][self.index] -= money
+            self.balances[slot] += money
+            return self.balances[slot]
+
+    def withdraw(self, account, money, credit=0):
+        # Take the money if the account covers it without the reserved money, returns whether it did; `credit`
+        # is reserved money the caller may spend, its own deposits that are still replicating
+        if self.balance(account) + credit < money:
+            return False
+        slot = self.slot(account)
+        with self.lock(account):
+            if self.balances[slot] - self.reserved[slot] + credit < money:
+                return False
+            self.decrements[slot][self.index] += money
+            self.balances[slot] -= money
+            return True
+
+    def hold(self, account, money):
+        # Keep money that is in the balance from being spent, a deposit's until it is replicated
+        slot = self.slot(account)
+        with self.lock(account):
+            self.reserved[slot] += money
+
+    def settle(self, account, money, withdrawn):
+        # Release held money, taking it out of the account when it was withdrawn
+        slot = self.slot(account)
+        with self.lock(account):
+            self.reserved[slot] -= money
+            if withdrawn:
+                self.decrements[slot][self.index] += money
+                self.balances[slot] -= money
+
+    def state(self, account=DEFAULT_ACCOUNT):
+        # (increment, decrement) of this branch for the account, what its propagations carry
+        slot = self.slot(account)
+        with self.lock(account):
+            return self.increments[slot][self.index], self.decrements[slot][self.index]
+
+    def merge(self, account, branch_id, increment, decrement):
+        # Take in the entries of another branch, returns the balance; older or repeated entries change nothing
+        slot = self.slot(account)
+        index = self.indexes[branch_id]
+        with self.lock(account):
+            increments = self.increments[slot]
+            decrements = self.decrements[slot]
+            if increment > increments[index]:
+                self.balances[slot] += increment - increments[index]
+                increments[index] = increment
+            if decrement > decrements[index]:
+                self.balances[slot] -= decrement - decrements[index]
+                decrements[index] = decrement
+            return self.balances[slot]
+
+    def items(self):
+        # (account, balance) of every account, the default one first
+        return [(account, self.balances[slot]) for account, slot in list(self.slots.items())]
@@ -0,0 +1,173 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent import futures
+
+import grpc
+
+# branches, this one included, that have to apply a write before it commits; None is a majority
+WRITE_QUORUM = None
+# times a propagation that failed is sent to the peer again, in the background once the write has committed
+QUORUM_RETRIES = 3
+# seconds before the first retry, doubled for every further one
+QUORUM_RETRY_BACKOFF = 0.1
+# failures after which the peer cannot have applied the propagation, so it is safe to send it again
+RETRY_CODES = (grpc.StatusCode.UNAVAILABLE,)
+# threads sending propagations of the thread-pool server, the stragglers of committed writes included
+QUORUM_WORKERS = 16
+
+
+def write_quorum(branch_count, quorum=WRITE_QUORUM):
+    if quorum is None:
+        return branch_count // 2 + 1
+    return max(1, min(quorum, branch_count))
+
+
+class QuorumReplicator:
+    # Sends a write to every peer at once and returns as soon as W - 1 of them acknowledged it, W counting
+    # this branch, so a write waits for the W-th fastest branch instead of the slowest. The other calls go on
+    # in the background and a peer that fails with one of `retry_codes` is sent the write again with backoff.
+    # Nothing is lost silently: a peer that never acknowledges a write is recorded in `unacknowledged`, and
+    # a write that misses its quorum is recorded in `partial` with the peers that did apply it. flush() waits
+    # until a peer has every committed write, so the peer can sync before it serves local reads.
+
+    def __init__(self, branch_count, quorum=WRITE_QUORUM, retries=QUORUM_RETRIES, backoff=QUORUM_RETRY_BACKOFF,
+                 retry_codes=RETRY_CODES):
+        self.quorum = write_quorum(branch_count, quorum)
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_codes = retry_codes
+        self.executor = futures.ThreadPoolExecutor(max_workers=QUORUM_WORKERS)
+        self.lock = threading.Lock()
+        # propagations still running after their write returned, and their calls or aio tasks per peer
+        self.stragglers = 0
+        self.in_flight = dict()
+        self.committed = 0
+        # (write, branch_id) of the propagations that failed for good
+        self.unacknowledged = []
+        # (write, branch ids that applied it) of the writes that missed the quorum
+        self.partial = []
+
+    def replicate(self, write, peers):
+        # `peers` are (branch_id, send) pairs, send() makes the call; returns the (branch_id, response) pairs of
+        # the acknowledgements the quorum waited for or raises the first failure once the quorum is out of reach
+        needed = self.quorum - 1
+        pending = {self.executor.submit(self.deliver, write, branch_id, send): branch_id for branch_id, send in peers}
+        acknowledged, error = [], None
+        while pending and len(acknowledged) < needed and self.reachable(pending, acknowledged):
+            done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for call in done:
+                branch_id = pending.pop(call)
+                if call.exception() is None:
+                    acknowledged.append((branch_id, call.result()))
+                else:
+                    error = error or call.exception()
+        if len(acknowledged) < needed:
+            # wait for the rest, so the record says which peers applied the write
+            for call in futures.as_completed(pending):
+                if call.exception() is None:
+                    acknowledged.append((pending[call], call.result()))
+            self.record_partial(write, acknowledged)
+            raise error
+        self.leave_stragglers(pending)
+        return acknowledged
+
+    def deliver(self, write, branch_id, send):
+        for attempt in range(self.retries + 1):
+            try:
+                return send()
+            except grpc.RpcError as e:
+                if attempt == self.retries or e.code() not in self.retry_codes:
+                    self.record_unacknowledged(write, branch_id, e)
+                    raise
+                print(f"Retrying {write} at branch {branch_id}: {e.code()}")
+            time.sleep(self.backoff * (1 << attempt))
+
+    async def replicate_async(self, write, peers):
+        # replicate() for grpc.aio stubs: send() returns the call to await
+        needed = self.quorum - 1
+        pending = {asyncio.ensure_future(self.deliver_async(write, branch_id, send)): branch_id
+                   for branch_id, send in peers}
+        acknowledged, error = [], None
+        while pending and len(acknowledged) < needed and self.reachable(pending, acknowledged):
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                branch_id = pending.pop(task)
+                if task.exception() is None:
+                    acknowledged.append((branch_id, task.result()))
+                else:
+                    error = error or task.exception()
+        if len(acknowledged) < needed:
+            results = await asyncio.gather(*pending, return_exceptions=True)
+            for branch_id, result in zip(pending.values(), results):
+                if not isinstance(result, BaseException):
+                    acknowledged.append((branch_id, result))
+            self.record_partial(write, acknowledged)
+            raise error
+        # in_flight also keeps the tasks alive, the event loop only holds weak references to them
+        self.leave_stragglers(pending)
+        return acknowledged
+
+    async def deliver_async(self, write, branch_id, send):
+        for attempt in range(self.retries + 1):
+            try:
+                return await send()
+            except grpc.RpcError as e:
+                if attempt == self.retries or e.code() not in self.retry_codes:
+                    self.record_unacknowledged(write, branch_id, e)
+                    raise
+                print(f"Retrying {write} at branch {branch_id}: {e.code()}")
+            await asyncio.sleep(self.backoff * (1 << attempt))
+
+    def reachable(self, pending, acknowledged):
+        return len(acknowledged) + len(pending) >= self.quorum - 1
+
+    def leave_stragglers(self, pending):
+        with self.lock:
+            self.committed += 1
+            self.stragglers += len(pending)
+            for call, branch_id in pending.items():
+                self.in_flight.setdefault(branch_id, set()).add(call)
+        for call, branch_id in pending.items():
+            call.add_done_callback(functools.partial(self.straggler_done, branch_id))
+
+    def straggler_done(self, branch_id, call):
+        with self.lock:
+            self.stragglers -= 1
+            self.in_flight[branch_id].discard(call)
+
+    def flush(self, branch_id, timeout=None):
+        # Wait until the committed writes that are still on their way to the peer got there, returns whether
+        # they all did within the timeout
+        with self.lock:
+            calls = list(self.in_flight.get(branch_id, ()))
+        done, not_done = futures.wait(calls, timeout)
+        return not not_done and all(call.exception() is None for call in done)
+
+    async def flush_async(self, branch_id, timeout=None):
+        with self.lock:
+            tasks = list(self.in_flight.get(branch_id, ()))
+        if not tasks:
+            return True
+        done, not_done = await asyncio.wait(tasks, timeout=timeout)
+        return not not_done and all(not task.cancelled() and task.exception() is None for task in done)
+
+    def record_unacknowledged(self, write, branch_id, error):
+        print(f"Branch {branch_id} did not acknowledge {write}: {error.code()}")
+        with self.lock:
+            self.unacknowledged.append((write, branch_id))
+
+    def record_partial(self, write, acknowledged):
+        print(f"{write} missed its quorum of {self.quorum}, applied at branches "
+              f"{[branch_id for branch_id, _ in acknowledged]}")
+        with self.lock:
+            self.partial.append((write, [branch_id for branch_id, _ in acknowledged]))
+
+    def snapshot(self):
+        with self.lock:
+            return {"quorum": self.quorum,
+                    "committed": self.committed,
+                    "stragglers": self.stragglers,
+                    "unacknowledged": [f"{write} at branch {branch_id}" for write, branch_id in self.unacknowledged],
+                    "partial": [f"{write} at branches {branch_ids}" for write, branch_ids in self.partial]}
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import time
+
+# seconds a branch answers queries from its local balances after it synced, 0 syncs for every query and
+# None never syncs
+READ_LEASE = 1.0
+# seconds a sync may take before the branch gives up on it and answers from what it has
+SYNC_TIMEOUT = 5.0
+
+
+class ReadLease:
+    # A query is answered from the local balances while the lease holds. The first query after it expired
+    # renews it: sync() brings the branch up to date with every write that committed anywhere before, and
+    # the lease then holds for `duration` seconds from the start of the sync. So an answer misses no write
+    # that committed more than `duration` seconds before it. Queries that arrive during a sync wait for it
+    # instead of syncing again. A sync that fails (a peer is unreachable) leaves the lease expired: the queries
+    # of the next `duration` seconds are answered from the local balances without the guarantee, counted as
+    # unsynced reads, and the next query after them tries to sync again.
+
+    def __init__(self, sync, duration=READ_LEASE):
+        # returns whether the branch got up to date
+        self.sync = sync
+        self.duration = duration
+        self.lock = threading.Lock()
+        self.expires = 0.0
+        # after a failed sync, when to try the next one
+        self.retry_at = 0.0
+        # metrics
+        self.local_reads = 0
+        self.unsynced_reads = 0
+        self.expirations = 0
+        self.renewals = 0
+        self.failed_renewals = 0
+        self.sync_seconds = 0.0
+
+    def check(self):
+        # True while the lease holds, False until a failed sync is retried, None once it has to be renewed
+        now = time.monotonic()
+        if self.duration is None or now < self.expires:
+            self.local_reads += 1
+            return True
+        if now < self.retry_at:
+            self.unsynced_reads += 1
+            return False
+        return None
+
+    def hold(self):
+        # Renew the lease if it expired, returns whether the local balances are within the guarantee
+        held = self.check()
+        if held is not None:
+            return held
+        with self.lock:
+            # the query this one waited for may have renewed it
+            held = self.check()
+            if held is not None:
+                return held
+            started = time.monotonic()
+            return self.renewed(started, self.sync())
+
+    def renewed(self, started, synced):
+        self.expirations += 1
+        self.sync_seconds += time.monotonic() - started
+        if not synced:
+            self.failed_renewals += 1
+            self.unsynced_reads += 1
+            self.retry_at = time.monotonic() + self.duration
+            return False
+        self.renewals += 1
+        self.expires = started + self.duration
+        return True
+
+    def snapshot(self):
+        return {"duration": self.duration,
+                "local_reads": self.local_reads,
+                "unsynced_reads": self.unsynced_reads,
+                "expirations": self.expirations,
+                "renewals": self.renewals,
+                "failed_renewals": self.failed_renewals,
+                "sync_ms": round(self.sync_seconds * 1000, 3)}
+
+
+class AsyncReadLease(ReadLease):
+    # ReadLease of the grpc.aio branch, sync() is a coroutine
+
+    def __init__(self, sync, duration=READ_LEASE):
+        super().__init__(sync, duration)
+        self.lock = asyncio.Lock()
+
+    async def hold(self):
+        held = self.check()
+        if held is not None:
+            return held
+        async with self.lock:
+            held = self.check()
+            if held is not None:
+                return held
+            started = time.monotonic()
+            return self.renewed(started, await self.sync())
@@ -0,0 +1,157 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+# responses kept for requests that may be sent again, beyond it the least recently used are dropped;
+# 0 turns the cache off, a branch only keeps them when it is asked to
+DEDUP_CAPACITY = 0
+# seconds a response is kept, a request sent again after that is handled as a new one; None keeps it until
+# it is dropped for capacity
+DEDUP_TTL = 300.0
+
+
+class CachedResponse:
+
+    def __init__(self, fingerprint):
+        # the serialized request, a different request under the same key is not a duplicate
+        self.fingerprint = fingerprint
+        self.created = time.monotonic()
+        # None until the first request is answered
+        self.response = None
+        self.done = threading.Event()
+
+
+class RequestCache:
+    # The responses of the requests a branch answered, by (type, sender, request ids). A request that comes
+    # again, because the sender's call timed out after the branch applied it, a retry policy resent it or a
+    # propagation was delivered twice, gets the response of the first one instead of being applied again.
+    # A copy that arrives while the first one is still being handled waits for its response. If handling the
+    # first one fails nothing is kept and the copy is handled as if it was the first. The cache is in memory
+    # only, a restarted branch applies a request it answered before it stopped again.
+
+    def __init__(self, key, capacity=DEDUP_CAPACITY, ttl=DEDUP_TTL):
+        # returns the key of a request, None for the requests that are not cached
+        self.key = key
+        self.capacity = capacity
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> CachedResponse, the least recently used first
+        self.entries = OrderedDict()
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        self.conflicts = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def create_entry(self, fingerprint):
+        return CachedResponse(fingerprint)
+
+    def expired(self, entry, now):
+        return self.ttl is not None and now - entry.created > self.ttl
+
+    def begin(self, key, request):
+        # Returns (entry, True) for a new request, which the caller handles and finish()es, and
+        # (entry, False) for a copy of one, whose response the entry holds once it is done
+        fingerprint = request.SerializeToString(deterministic=True)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.expired(entry, now):
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is not None and entry.fingerprint == fingerprint:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry, False
+            if entry is not None:
+                # the sender reused a request id for another request
+                self.conflicts += 1
+            entry = self.entries[key] = self.create_entry(fingerprint)
+            self.entries.move_to_end(key)
+            self.misses += 1
+            self.evict(now)
+            return entry, True
+
+    def evict(self, now):
+        # the least recently used beyond the capacity and the expired ones in front of them
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if len(self.entries) > self.capacity:
+                self.evictions += 1
+            elif self.expired(entry, now):
+                self.expirations += 1
+            else:
+                break
+            del self.entries[key]
+
+    def finish(self, key, entry, response):
+        # a request that failed leaves no response for its copies
+        entry.response = response
+        if response is None:
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+        entry.done.set()
+
+    def handle(self, request, process):
+        # The response of process(), or of the same request handled before
+        key = self.key(request)
+        if key is None:
+            return process()
+        entry, new = self.begin(key, request)
+        if not new:
+            entry.done.wait()
+            if entry.response is not None:
+                return entry.response
+            return self.handle(request, process)
+        response = None
+        try:
+            response = process()
+            return response
+        finally:
+            self.finish(key, entry, response)
+
+    def snapshot(self):
+        with self.lock:
+            return {"capacity": self.capacity,
+                    "ttl": self.ttl,
+                    "cached": len(self.entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "conflicts": self.conflicts,
+                    "expirations": self.expirations,
+                    "evictions": self.evictions}
+
+
+class AsyncCachedResponse(CachedResponse):
+
+    def __init__(self, fingerprint):
+        super().__init__(fingerprint)
+        self.done = asyncio.Event()
+
+
+class AsyncRequestCache(RequestCache):
+    # RequestCache of the grpc.aio branch, process() is a coroutine and copies wait on the event loop
+
+    def create_entry(self, fingerprint):
+        return AsyncCachedResponse(fingerprint)
+
+    async def handle(self, request, process):
+        key = self.key(request)
+        if key is None:
+            return await process()
+        entry, new = self.begin(key, request)
+        if not new:
+            await entry.done.wait()
+            if entry.response is not None:
+                return entry.response
+            return await self.handle(request, process)
+        response = None
+        try:
+            response = await process()
+            return response
+        finally:
+            self.finish(key, entry, response)
@@ -0,0 +1,105 @@
+import threading
+
+import grpc
+import pytest
+
+import Branch
+import distributed_banking_system_pb2
+
+
+class Unavailable(grpc.RpcError):
+
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+
+class FailedCall:
+
+    def cancelled(self):
+        return False
+
+    def exception(self):
+        return Unavailable()
+
+    def add_done_callback(self, callback):
+        callback(self)
+
+
+class MsgDelivery:
+    # Fails the background propagations and the first `failures` resends, hands the other calls to the peer
+
+    def __init__(self, peer, failures):
+        self.peer = peer
+        self.failures = failures
+        self.resends = []
+        self.acknowledged = threading.Event()
+
+    def future(self, request):
+        return FailedCall()
+
+    def __call__(self, request, wait_for_ready=None):
+        self.resends.append(request)
+        if self.failures:
+            self.failures -= 1
+            raise Unavailable()
+        response = self.peer.MsgDelivery(request, None)
+        self.acknowledged.set()
+        return response
+
+
+class PeerStub:
+
+    def __init__(self, peer, failures=0):
+        self.MsgDelivery = MsgDelivery(peer, failures)
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    delays = []
+    monkeypatch.setattr(Branch.time, "sleep", delays.append)
+    return delays
+
+
+@pytest.fixture
+def branches():
+    created = []
+
+    def create(id):
+        branch = Branch.Branch(id, 100, [1, 2], escrow=True)
+        created.append(branch)
+        return branch
+
+    yield create
+    for branch in created:
+        branch.channels.close()
+
+
+def deposit(branch, money):
+    request = distributed_banking_system_pb2.BankingOperationRequest(id=1, type="customer", events=[
+        distributed_banking_system_pb2.Event(id=1, interface="deposit", money=money, customer=1)])
+    return branch.MsgDelivery(request, None)
+
+
+def test_failed_background_propagation_is_resent_until_acknowledged(branches, delays):
+    sender, peer = branches(1), branches(2)
+    stub = sender.channels.stubs[2] = PeerStub(peer, failures=2)
+    assert deposit(sender, 10).recv[0].result == "success"
+    assert stub.MsgDelivery.acknowledged.wait(5)
+
+    # the resends back off and then bring the peer the counters it missed
+    assert delays == [Branch.ESCROW_RESEND_BACKOFF, 2 * Branch.ESCROW_RESEND_BACKOFF]
+    assert [event.interface for event in stub.MsgDelivery.resends[-1].events] == ["counters"]
+    assert peer.balance == 110
+    assert sender.escrow.snapshot()["stale_accounts"] == 0
+
+
+def test_resend_carries_the_latest_counters(branches, delays):
+    sender, peer = branches(1), branches(2)
+    stub = sender.channels.stubs[2] = PeerStub(peer)
+    # the second deposit fails while the resend of the first is yet to start, the resend covers both
+    sender.resend_in_background = lambda branch_id: None
+    deposit(sender, 10)
+    deposit(sender, 5)
+    sender.resend_counters(2)
+    assert len(stub.MsgDelivery.resends) == 1
+    assert peer.balance == 115
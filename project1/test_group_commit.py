@@ -0,0 +1,77 @@
+import threading
+
+import grpc
+import pytest
+
+import Branch
+import distributed_banking_system_pb2
+
+
+class Unavailable(grpc.RpcError):
+
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+
+class PeerStub:
+    # Holds the first propagation until `release` is set and then fails it; the others go through
+
+    def __init__(self):
+        self.sending = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def MsgDelivery(self, request):
+        self.calls += 1
+        if self.calls == 1:
+            self.sending.set()
+            self.release.wait(5)
+            raise Unavailable()
+        recv = [distributed_banking_system_pb2.EventResult(interface=event.interface, result="success")
+                for event in request.events]
+        return distributed_banking_system_pb2.BankingOperationResponse(id=2, recv=recv)
+
+
+@pytest.fixture(params=["integer", "counter"])
+def branch(request):
+    branch = Branch.Branch(1, 0, [1, 2], group_commit=True, balance_mode=request.param)
+    branch.stubList[0] = PeerStub()
+    yield branch
+    branch.channels.close()
+
+
+def customer_request(customer, *events):
+    return distributed_banking_system_pb2.BankingOperationRequest(id=1, type="customer", events=[
+        distributed_banking_system_pb2.Event(id=index + 1, interface=interface, money=money, customer=customer)
+        for index, (interface, money) in enumerate(events)])
+
+
+def test_roll_back_alongside_a_withdrawal_of_the_uncommitted_deposit(branch):
+    stub = branch.stubList[0]
+    responses = {}
+    depositor = threading.Thread(target=lambda: responses.update(
+        deposit=branch.MsgDelivery(customer_request(1, ("deposit", 100)), None)))
+    depositor.start()
+    assert stub.sending.wait(5)
+
+    # the deposit is not replicated yet, another customer may not spend it
+    withdrawal = branch.MsgDelivery(customer_request(2, ("withdraw", 50)), None)
+    assert withdrawal.recv[0].result == "failed"
+
+    stub.release.set()
+    depositor.join(5)
+    assert responses["deposit"].recv[0].result == "failed"
+    assert branch.balance == 0
+    assert branch.accounts.withdraw(0, 1) is False
+
+
+def test_batch_spends_its_own_deposit_and_frees_it_once_replicated(branch):
+    stub = branch.stubList[0]
+    stub.calls = 1
+    response = branch.MsgDelivery(customer_request(1, ("deposit", 100), ("withdraw", 70), ("withdraw", 40)), None)
+    assert [event_result.result for event_result in response.recv] == ["success", "success", "failed"]
+    assert branch.balance == 30
+    # replicated, so the rest of the deposit may be spent by anyone
+    response = branch.MsgDelivery(customer_request(2, ("withdraw", 30)), None)
+    assert response.recv[0].result == "success"
+    assert branch.balance == 0
@@ -0,0 +1,48 @@
+import threading
+
+import Branch
+import distributed_banking_system_pb2
+
+
+class PeerStub:
+    # Holds the first propagation until `release` is set; the others go through
+
+    def __init__(self):
+        self.sending = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def MsgDelivery(self, request):
+        self.calls += 1
+        if self.calls == 1:
+            self.sending.set()
+            self.release.wait(5)
+        recv = [distributed_banking_system_pb2.EventResult(interface=event.interface, result="success")
+                for event in request.events]
+        return distributed_banking_system_pb2.BankingOperationResponse(id=2, recv=recv)
+
+
+def withdrawal(customer, money):
+    return distributed_banking_system_pb2.BankingOperationRequest(id=1, type="customer", events=[
+        distributed_banking_system_pb2.Event(id=1, interface="withdraw", money=money, customer=customer)])
+
+
+def test_concurrent_withdrawals_do_not_overdraw():
+    branch = Branch.Branch(1, 100, [1, 2], group_commit=False, balance_mode="integer")
+    stub = branch.stubList[0] = PeerStub()
+    try:
+        responses = {}
+        first = threading.Thread(target=lambda: responses.update(first=branch.MsgDelivery(withdrawal(1, 70), None)))
+        first.start()
+        assert stub.sending.wait(5)
+
+        # the first withdrawal holds its money while it replicates
+        assert branch.MsgDelivery(withdrawal(2, 70), None).recv[0].result == "failed"
+        assert branch.MsgDelivery(withdrawal(2, 30), None).recv[0].result == "success"
+
+        stub.release.set()
+        first.join(5)
+        assert responses["first"].recv[0].result == "success"
+        assert branch.balance == 0
+    finally:
+        branch.channels.close()
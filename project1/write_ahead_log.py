@@ -0,0 +1,188 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from account_table import DEFAULT_ACCOUNT
+
+# a snapshot is taken (and older log segments dropped) after this many records
+SNAPSHOT_EVERY = 10000
+# seconds the flusher waits for more records before it writes and fsyncs a group
+GROUP_SYNC_DELAY = 0.001
+
+# record: length and crc32 of the payload, then the payload (interface code, event id, money), followed by
+# the account for a change to any account but the default one
+_HEADER = struct.Struct("<II")
+_PAYLOAD = struct.Struct("<Bqq")
+_ACCOUNT_PAYLOAD = struct.Struct("<Bqqq")
+# snapshot: first log segment that is not covered yet and the balance up to it, then (account, balance)
+# of every other account
+_SNAPSHOT = struct.Struct("<Qq")
+_ACCOUNT_BALANCE = struct.Struct("<qq")
+_SIGNS = {"deposit": 1, "propagate_deposit": 1, "withdraw": -1, "propagate_withdraw": -1}
+_CODES = {"deposit": 1, "withdraw": 2, "propagate_deposit": 3, "propagate_withdraw": 4}
+_INTERFACES = {code: interface for interface, code in _CODES.items()}
+
+
+class WriteAheadLog:
+    # Append-only, length-prefixed log of every balance change of one branch, split into segments
+    # wal.<n>. A single flusher thread writes whatever records are waiting and fsyncs them together, so
+    # concurrent requests share one fsync. Every SNAPSHOT_EVERY records the flusher starts a new segment,
+    # stores the balance up to it in `snapshot` and deletes the older segments, so recovery only replays
+    # the tail written since the last snapshot.
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.condition = threading.Condition()
+        self.buffer = bytearray()
+        # records appended / made durable so far
+        self.appended = 0
+        self.synced = 0
+        # balance of every account as of the last appended record
+        self.balances = {DEFAULT_ACCOUNT: 0}
+        self.since_snapshot = 0
+        self.segment = 0
+        self.file = None
+        self.closed = False
+        self.flusher = None
+
+    def recover(self, initial_balance):
+        # Load the newest snapshot, replay the log tail after it and start appending; returns the balance
+        # of the default account, the other accounts are in `balances`
+        self.segment, self.balances = self.read_snapshot(initial_balance)
+        for segment in self.segments():
+            if segment >= self.segment:
+                for account, change in self.replay(segment).items():
+                    self.balances[account] = self.balances.get(account, 0) + change
+                self.segment = segment
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+        return self.balances[DEFAULT_ACCOUNT]
+
+    def append(self, interface, event_id, money, account=DEFAULT_ACCOUNT):
+        # Queue a record and return its sequence number, wait_durable() blocks until it is on disk
+        if account == DEFAULT_ACCOUNT:
+            payload = _PAYLOAD.pack(_CODES[interface], event_id, money)
+        else:
+            payload = _ACCOUNT_PAYLOAD.pack(_CODES[interface], event_id, money, account)
+        with self.condition:
+            self.buffer += _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+            self.balances[account] = self.balances.get(account, 0) + _SIGNS[interface] * money
+            self.appended += 1
+            self.since_snapshot += 1
+            self.condition.notify_all()
+            return self.appended
+
+    def wait_durable(self, sequence):
+        with self.condition:
+            self.condition.wait_for(lambda: self.synced >= sequence or self.closed)
+
+    def flush_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.buffer or self.closed)
+                if not self.buffer and self.closed:
+                    return
+            # let the other requests in flight add their records to this group
+            time.sleep(GROUP_SYNC_DELAY)
+            self.flush()
+
+    def flush(self):
+        with self.condition:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            sequence = self.appended
+            snapshot_due = self.since_snapshot >= SNAPSHOT_EVERY
+            if snapshot_due:
+                self.since_snapshot = 0
+                balances = dict(self.balances)
+        if data:
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        if snapshot_due:
+            self.take_snapshot(balances)
+        with self.condition:
+            self.synced = max(self.synced, sequence)
+            self.condition.notify_all()
+
+    def take_snapshot(self, balances):
+        # Everything up to the current segment is in `balances`: continue in a new segment and drop the old ones
+        self.file.close()
+        self.segment += 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        temporary_path = os.path.join(self.directory, "snapshot.tmp")
+        with open(temporary_path, "wb") as snapshot_file:
+            snapshot_file.write(_SNAPSHOT.pack(self.segment, balances[DEFAULT_ACCOUNT]))
+            for account, balance in balances.items():
+                if account != DEFAULT_ACCOUNT:
+                    snapshot_file.write(_ACCOUNT_BALANCE.pack(account, balance))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, os.path.join(self.directory, "snapshot"))
+        for segment in self.segments():
+            if segment < self.segment:
+                os.remove(self.segment_path(segment))
+
+    def read_snapshot(self, initial_balance):
+        try:
+            with open(os.path.join(self.directory, "snapshot"), "rb") as snapshot_file:
+                data = snapshot_file.read()
+            segment, balance = _SNAPSHOT.unpack_from(data)
+        except (FileNotFoundError, struct.error):
+            return 0, {DEFAULT_ACCOUNT: initial_balance}
+        balances = {DEFAULT_ACCOUNT: balance}
+        for account, balance in _ACCOUNT_BALANCE.iter_unpack(data[_SNAPSHOT.size:]):
+            balances[account] = balance
+        return segment, balances
+
+    def replay(self, segment):
+        # Sum the changes per account of one segment through a memory map, cutting off a torn record at the end
+        path = self.segment_path(segment)
+        changes = dict()
+        if os.path.getsize(path) == 0:
+            return changes
+        offset = 0
+        with open(path, "r+b") as segment_file:
+            with mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+                while offset + _HEADER.size <= len(log):
+                    length, crc = _HEADER.unpack_from(log, offset)
+                    payload = log[offset + _HEADER.size:offset + _HEADER.size + length]
+                    if len(payload) != length or zlib.crc32(payload) != crc:
+                        break
+                    if length == _PAYLOAD.size:
+                        code, _, money = _PAYLOAD.unpack(payload)
+                        account = DEFAULT_ACCOUNT
+                    elif length == _ACCOUNT_PAYLOAD.size:
+                        code, _, money, account = _ACCOUNT_PAYLOAD.unpack(payload)
+                    else:
+                        break
+                    changes[account] = changes.get(account, 0) + _SIGNS[_INTERFACES[code]] * money
+                    offset += _HEADER.size + length
+                size = len(log)
+            if offset < size:
+                print(f"Dropping {size - offset} bytes of a torn record at the end of {path}")
+                segment_file.truncate(offset)
+        return changes
+
+    def segments(self):
+        return sorted(int(name.split(".")[1]) for name in os.listdir(self.directory) if name.startswith("wal."))
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"wal.{segment}")
+
+    def close(self):
+        # Write what is left and take a final snapshot, so the next start has nothing to replay
+        if self.flusher is None:
+            return
+        with self.condition:
+            self.closed = True
+            self.since_snapshot = SNAPSHOT_EVERY
+            self.condition.notify_all()
+        self.flusher.join()
+        self.flush()
+        self.file.close()
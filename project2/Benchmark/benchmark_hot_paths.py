@@ -0,0 +1,225 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent import futures
+
+import grpc
+
+PROJECT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIRECTORY)
+
+import Branch
+import Customer
+from Checker.verifier import verify
+import distributed_banking_system_pb2
+import distributed_banking_system_pb2_grpc
+
+# Times the code that runs on every request or every output: Branch dispatch through MsgDelivery,
+# protobuf_to_dict, the three output builders of Customer, the checker scripts and the verifier. Everything runs in
+# this process against local servers, so it needs no input file and no network.
+#
+#   python3 ./Benchmark/benchmark_hot_paths.py
+#   python3 ./Benchmark/benchmark_hot_paths.py --compare ./Benchmark/Results/hot_paths_<commit>.json
+#
+# The results are written to Benchmark/Results/hot_paths_<commit>.json, so two commits can be compared.
+
+# (branches, customer requests per customer); every branch has one customer, as in the input files
+SCALES = [(2, 10), (4, 20), (8, 40)]
+CHECKERS = [("checker_part_1", "output1.json"), ("checker_part_2", "output2.json"),
+            ("checker_part_3", "output3.json")]
+
+
+def start_branches(branch_id_list):
+    # returns (server, branch) per branch
+    servers = []
+    for id in branch_id_list:
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+        branch = Branch.Branch(id, 0, branch_id_list)
+        distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(branch, server)
+        server.add_insecure_port(f"[::]:{50050 + id}")
+        server.start()
+        servers.append((server, branch))
+    return servers
+
+
+def customer_requests(customer_id, requests):
+    # deposits and withdrawals alternate, so every withdrawal is covered by the deposit before it
+    return [{"customer-request-id": customer_id * requests + i,
+             "interface": "deposit" if i % 2 == 0 else "withdraw",
+             "money": 10}
+            for i in range(requests)]
+
+
+def run_customers(customers, requests):
+    # Same steps as start_customer_process, without the process and the queue
+    results = []
+    responses = []
+    for customer in customers:
+        branch_response, customer_response = customer.executeEvents()
+        responses.extend(branch_response)
+        json_response = Customer.transform_branch_response_to_json(branch_response)
+        Customer.merge_customer_and_branch_response(customer_response, json_response)
+        results.append(json_response)
+    return results, responses
+
+
+def time_dispatch(branch_id_list, requests):
+    # Round trip of single customer requests through MsgDelivery, including the propagation to the peers
+    latencies = []
+    with grpc.insecure_channel(f"localhost:{50050 + branch_id_list[0]}") as channel:
+        stub = distributed_banking_system_pb2_grpc.BankingServiceStub(channel)
+        for i in range(requests):
+            customer_request = distributed_banking_system_pb2.CustomerRequest(
+                customer_request_id=i, interface="deposit", logical_clock=i + 1, money=1)
+            request = distributed_banking_system_pb2.BankingOperationRequest(
+                id=branch_id_list[0], type="customer", customer_requests=[customer_request])
+            start = time.perf_counter()
+            stub.MsgDelivery(request)
+            latencies.append(time.perf_counter() - start)
+    return summarize(latencies, 1)
+
+
+def time_calls(function, arguments, repeat):
+    # Runs function over every argument `repeat` times, returns the timings per call
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for argument in arguments:
+            function(argument)
+        timings.append(time.perf_counter() - start)
+    return summarize(timings, len(arguments))
+
+
+def time_checker(name, path, repeat):
+    checker_path = os.path.join(PROJECT_DIRECTORY, "Checker", f"{name}.py")
+    argv = sys.argv
+    timings = []
+    try:
+        sys.argv = [checker_path, path]
+        for _ in range(repeat):
+            start = time.perf_counter()
+            runpy.run_path(checker_path, run_name="__main__")
+            timings.append(time.perf_counter() - start)
+    finally:
+        sys.argv = argv
+    return summarize(timings, 1)
+
+
+def summarize(timings, calls):
+    # Per-call times in microseconds
+    per_call = sorted(timing / calls * 1e6 for timing in timings)
+    return {"calls": calls,
+            "samples": len(per_call),
+            "min_us": per_call[0],
+            "mean_us": sum(per_call) / len(per_call),
+            "p50_us": per_call[len(per_call) // 2],
+            "p99_us": per_call[min(len(per_call) - 1, int(0.99 * len(per_call)))]}
+
+
+def benchmark(branches, requests, repeat):
+    branch_id_list = list(range(1, branches + 1))
+    timings = dict()
+    servers = start_branches(branch_id_list)
+    customers = []
+    try:
+        for id in branch_id_list:
+            customers.append(Customer.Customer(id, customer_requests(id, requests)))
+        start = time.perf_counter()
+        results, responses = run_customers(customers, requests)
+        timings["customer_session"] = summarize([time.perf_counter() - start], branches * requests)
+        timings["msg_delivery"] = time_dispatch(branch_id_list, requests)
+    finally:
+        # close the channels while the branches are up, the manager keeps reconnecting to a stopped branch
+        for customer in customers:
+            customer.channels.close()
+        for server, branch in servers:
+            server.stop(None)
+            branch.channels.close()
+
+    timings["protobuf_to_dict"] = time_calls(Customer.protobuf_to_dict, responses, repeat)
+    for builder in (Customer.generate_customer_output, Customer.generate_branch_output,
+                    Customer.generate_event_output):
+        timings[builder.__name__] = time_calls(builder, [results], repeat)
+
+    with tempfile.TemporaryDirectory() as directory:
+        outputs = {"output1.json": Customer.generate_customer_output(results),
+                   "output2.json": Customer.generate_branch_output(results),
+                   "output3.json": Customer.generate_event_output(results)}
+        for file_name, output in outputs.items():
+            with open(os.path.join(directory, file_name), "w", encoding="utf-8") as output_file:
+                json.dump(output, output_file, ensure_ascii=False, indent=4)
+        for name, file_name in CHECKERS:
+            timings[name] = time_checker(name, os.path.join(directory, file_name), repeat)
+        paths = [os.path.join(directory, file_name) for _, file_name in CHECKERS]
+        timings["verifier"] = time_calls(verify, [paths], repeat)
+
+    return {"branches": branches,
+            "customers": branches,
+            "requests_per_customer": requests,
+            "events": sum(len(customer_event) for customer_events in results for customer_event in customer_events),
+            "timings": timings}
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_DIRECTORY,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(report, previous_path):
+    with open(previous_path, "r") as previous_file:
+        previous = json.load(previous_file)
+    previous_scales = {(scale["branches"], scale["requests_per_customer"]): scale["timings"]
+                       for scale in previous["scales"]}
+    print(f"\nCompared with {previous['commit']} (ratio of mean times, above 1 is slower now)")
+    for scale in report["scales"]:
+        previous_timings = previous_scales.get((scale["branches"], scale["requests_per_customer"]))
+        if previous_timings is None:
+            continue
+        for name, timing in scale["timings"].items():
+            if name in previous_timings and previous_timings[name]["mean_us"] > 0:
+                ratio = timing["mean_us"] / previous_timings[name]["mean_us"]
+                print(f"  {scale['branches']} branches x {scale['requests_per_customer']} requests "
+                      f"{name:>24}: {ratio:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-request hot paths of project2")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="JSON file, Benchmark/Results/hot_paths_<commit>.json by default")
+    parser.add_argument("--compare", default=None, help="results of an earlier commit to compare against")
+    args = parser.parse_args()
+
+    report = {"commit": current_commit(),
+              "python": platform.python_version(),
+              "grpc": grpc.__version__,
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "scales": []}
+    for branches, requests in SCALES:
+        # the branches, the customers and the checkers print every event, keep that out of the measurement
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = benchmark(branches, requests, args.repeat)
+        report["scales"].append(result)
+        print(f"{branches} branches x {requests} requests ({result['events']} events):")
+        for name, timing in result["timings"].items():
+            print(f"  {name:>24}: mean {timing['mean_us']:10.1f} us, min {timing['min_us']:10.1f} us")
+
+    output_path = args.output or os.path.join(PROJECT_DIRECTORY, "Benchmark", "Results",
+                                              f"hot_paths_{report['commit']}.json")
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as output_file:
+        json.dump(report, output_file, indent=4)
+    print(f"Results written to {output_path}")
+
+    if args.compare:
+        compare(report, args.compare)
@@ -1,29 +1,58 @@
+import asyncio
+import functools
 import json
 import multiprocessing
+import os
+import signal
 import sys
+import threading
 import time
 from concurrent import futures
 import logging
-import datetime
 
 import grpc
 import distributed_banking_system_pb2
 import distributed_banking_system_pb2_grpc
-
-_ONE_DAY = datetime.timedelta(days=1)
+from account_table import AccountTable, DEFAULT_ACCOUNT
+from causal_delivery import CausalDelivery
+from channel_manager import ChannelManager, SERVER_OPTIONS
+from request_cache import RequestCache, AsyncRequestCache, DEDUP_CAPACITY, DEDUP_TTL
+from latency_stats import (LatencyStats, ServerLatencyInterceptor, AsyncServerLatencyInterceptor,
+                           ClientLatencyInterceptor, AsyncClientLatencyInterceptor)
+from write_ahead_log import WriteAheadLog
+import vector_clock
+
+# "thread" serves MsgDelivery from a thread pool, "aio" serves it from an asyncio event loop
+SERVER_MODE = "thread"
+# "lamport" keeps the scalar logical_clock only, "vector" also stamps every event with a vector clock
+CLOCK_MODE = "lamport"
+# times a propagation that failed is sent again before the customer request fails
+PROPAGATION_RETRIES = 2
+# seconds before the first retry of a failed propagation, doubled for every further one
+PROPAGATION_RETRY_BACKOFF = 0.1
+# directory for each branch's write-ahead log and snapshots, None keeps the balance in memory only
+STATE_DIRECTORY = None
+# record per-RPC latency histograms, printed on SIGUSR1 and when the branch stops; the interceptors add
+# to every call, so only the benchmarks turn it on
+LATENCY_STATS = False
 
 
 class Branch(distributed_banking_system_pb2_grpc.BankingServiceServicer):
 
-    def __init__(self, id, balance, branches):
+    def __init__(self, id, balance, branches, clock_mode=CLOCK_MODE, wal=None, stats=None,
+                 dedup_capacity=DEDUP_CAPACITY, dedup_ttl=DEDUP_TTL):
         # unique ID of the Branch
         self.id = id
-        # replica of the Branch's balance
-        self.balance = balance
+        # replica of the balances of the Branch's accounts, `balance` is the default account
+        self.accounts = AccountTable(balance)
         # the list of process IDs of the branches
         self.branches = branches
         # the list of Client stubs to communicate with the branches
         self.stubList = list()
+        # latency histograms of the served and the sent calls, None when they are not recorded
+        self.stats = stats
+        # the channels behind the stubs, shared per peer and kept connected
+        self.channels = self.create_channel_manager()
         # a list of received messages used for debugging purpose
         self.recvMsg = list()
         # iterate the processID of the branches
@@ -31,35 +60,114 @@ class Branch(distributed_banking_system_pb2_grpc.BankingServiceServicer):
         self.initialize_stubs()
         # logical clock
         self.logical_clock = 0
-
-    def update_logical_clock(self, event_ts):
+        # vector clock with one entry per branch of `branches`, None in "lamport" mode
+        self.vector_clock = None
+        # entries of this branch's vector clock each peer has acknowledged, a propagation carries the rest
+        self.peer_vector_clocks = dict()
+        if clock_mode == "vector":
+            self.vector_clock = [0] * len(branches)
+            self.vector_index = branches.index(id)
+            self.peer_vector_clocks = {branch_id: [0] * len(branches) for branch_id in self.branch_id_list}
+        # propagations sent so far to each peer, they are numbered 1, 2, 3, ... per peer
+        self.propagations_sent = {branch_id: 0 for branch_id in self.branch_id_list}
+        self.propagations_sent_lock = threading.Lock()
+        # the numbering starts over whenever the branch starts, a peer tells the runs apart by their epoch
+        self.epoch = time.time_ns()
+        # numbers per peer of the propagations that failed for good, the next propagation to the peer releases
+        # them so the ones after them are not held back
+        self.unreleased = {branch_id: set() for branch_id in self.branch_id_list}
+        # applies the propagations of each peer in the order the peer numbered them
+        self.delivery = CausalDelivery(self.deliver_propagation)
+        # responses of the customer requests and propagations, for the copies a sender resends; None when not
+        # cached
+        self.requests = self.create_request_cache(dedup_capacity, dedup_ttl) if dedup_capacity else None
+        # write-ahead log of the balance changes, None when the balance is not persisted
+        self.wal = wal
+        self.restore_accounts()
+
+    @property
+    def balance(self):
+        # the only account unless the customer requests name one
+        return self.accounts.balance()
+
+    def restore_accounts(self):
+        # the default account is recovered into `balance` already, the others come from the log
+        if self.wal is not None:
+            for account, balance in self.wal.balances.items():
+                if account != DEFAULT_ACCOUNT:
+                    self.accounts.add(account, balance)
+
+    def update_logical_clock(self, event_ts, event_vector_clock=()):
         self.logical_clock = 1 + max(self.logical_clock, event_ts)
+        if self.vector_clock is not None:
+            vector_clock.merge_pairs(self.vector_clock, event_vector_clock)
+            self.vector_clock[self.vector_index] += 1
 
     def increment_logical_clock(self):
         self.logical_clock += 1
+        if self.vector_clock is not None:
+            self.vector_clock[self.vector_index] += 1
+
+    def stamp(self, event):
+        # Add the vector clock to an event of this branch, encoded like on the wire
+        if self.vector_clock is not None:
+            event["vector_clock"] = vector_clock.encode(self.vector_clock)
+        return event
+
+    def acknowledge_vector_clock(self, id, replica_branch_response):
+        # The peer's reception event covers everything the propagation carried
+        if self.vector_clock is not None:
+            vector_clock.merge_pairs(self.peer_vector_clocks[id], replica_branch_response.event_result[0].vector_clock)
+
+    def create_request_cache(self, capacity, ttl):
+        return RequestCache(self.request_key, capacity, ttl)
+
+    def request_key(self, request):
+        # (type, sender, request ids, interfaces and sequence numbers); the customer request ids are unique per
+        # customer only, and a branch forwards the requests of all of its customers, so a propagation is told
+        # apart by the epoch and sequence number its sender gave it for this peer. A resent propagation keeps
+        # them. Queries alone are not cached, a query reads the current balance
+        ids = tuple((customer_request.customer_request_id, customer_request.interface, customer_request.epoch,
+                     customer_request.sequence) for customer_request in request.customer_requests)
+        if request.type not in ("customer", "branch") or not any(
+                id and interface != "query" for id, interface, _, _ in ids):
+            return None
+        return request.type, request.id, ids
 
     def initialize_stubs(self):
         # Initialize gRPC stubs for communication with other branches
         for branch_id in self.branches:
             if branch_id != self.id:
-                port = str(50050 + int(branch_id))
-                address = f"localhost:{port}"
-                channel = grpc.insecure_channel(address)
-                stub = distributed_banking_system_pb2_grpc.BankingServiceStub(channel)
+                stub = self.channels.stub(branch_id)
                 self.stubList.append(stub)
+                self.branch_id_list.append(branch_id)
+
+    def create_channel_manager(self):
+        return ChannelManager(interceptors=self.client_interceptors)
+
+    def client_interceptors(self, branch_id):
+        if self.stats is None:
+            return []
+        return [ClientLatencyInterceptor(self.stats, branch_id)]
 
     def record_event_reception(self, request):
         customer_request = request.customer_requests[0]
-        self.update_logical_clock(customer_request.logical_clock)
+        self.update_logical_clock(customer_request.logical_clock, customer_request.vector_clock)
         event = {"id": self.id,
                  "customer_request_id": customer_request.customer_request_id,
                  "type": "branch",
                  "logical_clock": self.logical_clock,
                  "interface": customer_request.interface,
                  "comment": f"event_received from {request.type} {request.id}"}
-        return event
+        return self.stamp(event)
 
     def MsgDelivery(self, request, context):
+        # a request that is sent again, after a timeout or by a retry policy, gets the response of the first
+        if self.requests is None:
+            return self.deliver(request)
+        return self.requests.handle(request, functools.partial(self.deliver, request))
+
+    def deliver(self, request):
         type = request.type
         response = [self.record_event_reception(request)]
 
@@ -69,8 +177,24 @@ class Branch(distributed_banking_system_pb2_grpc.BankingServiceServicer):
             case "branch":
                 self.process_branch_events(request)
 
+        self.wait_durable()
         return distributed_banking_system_pb2.BankingOperationResponse(event_result=response)
 
+    def log_change(self, interface, event_id, money, account=DEFAULT_ACCOUNT):
+        # Write a balance change ahead to the log, it is on disk once wait_durable() returns
+        if self.wal is not None:
+            self.wal.append(interface, event_id, money, account)
+
+    def wait_durable(self):
+        # Block until every logged change is fsynced, concurrent requests share one group fsync
+        if self.wal is not None:
+            self.wal.wait_durable(self.wal.appended)
+
+    def MsgStream(self, request_iterator, context):
+        # A customer session over one stream: each request is handled exactly like a MsgDelivery call, in order
+        for request in request_iterator:
+            yield self.MsgDelivery(request, context)
+
     def process_customer_events(self, request):
         response = list()
         replica_branch_responses = list()
@@ -93,14 +217,16 @@ class Branch(distributed_banking_system_pb2_grpc.BankingServiceServicer):
         return replica_branch_responses
 
     def query(self, request, id, type):
-        return {'interface': 'query', 'result': None, 'balance': self.balance}
+        return {'interface': 'query', 'result': None, 'balance': self.accounts.balance(request.account)}
 
     def deposit(self, customer_request, id, type):
         # result = "failed"
         replica_branch_responses = []
         try:
             replica_branch_responses = self.replicate_deposit(customer_request)
-            self.balance += customer_request.money
+            self.accounts.add(customer_request.account, customer_request.money)
+            self.log_change("deposit", customer_request.customer_request_id, customer_request.money,
+                            customer_request.account)
             # result = "success"
         except Exception as e:
             print(e)
@@ -118,9 +244,11 @@ class Branch(distributed_banking_system_pb2_grpc.BankingServiceServicer):
         result = "failed"
         replica_branch_responses = []
         try:
-            if self.balance >= customer_request.money:
+            if self.accounts.balance(customer_request.account) >= customer_request.money:
                 replica_branch_responses = self.replicate_withdraw(customer_request)
-                self.balance -= customer_request.money
+                self.accounts.add(customer_request.account, -customer_request.money)
+                self.log_change("withdraw", customer_request.customer_request_id, customer_request.money,
+                                customer_request.account)
                 result = "success"
         except  Exception as e:
             print(e)
@@ -130,86 +258,318 @@ class Branch(distributed_banking_system_pb2_grpc.BankingServiceServicer):
         return response, replica_branch_responses
 
     def process_branch_events(self, request):
-        response = list()
+        # a propagation is applied once every propagation the peer numbered before it in the same run is
         for event in request.customer_requests:
-            match event.interface:
-                case "withdraw":
-                    response.append(self.propagate_withdraw(event))
-                case "deposit":
-                    response.append(self.propagate_deposit(event))
-        return response
+            self.delivery.receive((request.id, event.epoch), event.sequence, event)
+
+    def deliver_propagation(self, event):
+        # the sender renames the interface to propagate_*, older senders did not
+        match event.interface:
+            case "propagate_withdraw" | "withdraw":
+                self.propagate_withdraw(event)
+            case "propagate_deposit" | "deposit":
+                self.propagate_deposit(event)
+            case "release":
+                # a number the sender gave up on, it only lets the propagations after it through
+                pass
 
     def propagate_deposit(self, event):
-        self.balance += event.money
+        self.accounts.add(event.account, event.money)
+        self.log_change("propagate_deposit", event.customer_request_id, event.money, event.account)
         return {'interface': 'propagate_deposit', 'result': 'success'}
 
     def propagate_withdraw(self, request):
-        self.balance -= request.money
+        self.accounts.add(request.account, -request.money)
+        self.log_change("propagate_withdraw", request.customer_request_id, request.money, request.account)
         return {'interface': 'propagate_withdraw', 'result': 'success'}
 
     def replicate_deposit(self, customer_request):
         replica_branch_responses = []
-        for id, stub in enumerate(self.stubList, 1):
-            if id >= self.id:
-                id += 1
-            self.increment_logical_clock()
-            customer_request.logical_clock = self.logical_clock
-            customer_request.interface = "propagate_deposit"
-
-            event_ack = {"id": self.id,
-                         "customer_request_id": customer_request.customer_request_id,
-                         "type": "branch",
-                         "logical_clock": self.logical_clock,
-                         "interface": "propagate_deposit",
-                         "comment": f"event_sent to branch {id}"}
-            replica_branch_responses.append(event_ack)
-            replica_branch_response = stub.MsgDelivery(
-                distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="branch",
-                                                                       customer_requests=[customer_request]))
-            dict_response = protobuf_to_dict(replica_branch_response)
-            replica_branch_responses.extend(dict_response["event_result"])
+        for id, stub in zip(self.branch_id_list, self.stubList):
+            request = self.prepare_propagation(customer_request, "propagate_deposit", id, replica_branch_responses)
+            replica_branch_response = self.send_propagation(id, stub, request)
+            self.acknowledge_vector_clock(id, replica_branch_response)
+            # the peer's EventResult messages go into this branch's response as they are
+            replica_branch_responses.extend(replica_branch_response.event_result)
 
         return replica_branch_responses
 
     def replicate_withdraw(self, customer_request):
         replica_branch_responses = []
-        for id, stub in enumerate(self.stubList, 1):
-            if id >= self.id:
-                id += 1
-            self.increment_logical_clock()
-            customer_request.logical_clock = self.logical_clock
-            customer_request.interface = "propagate_withdraw"
-            event_ack = {"id": self.id,
-                         "customer_request_id": customer_request.customer_request_id,
-                         "type": "branch",
-                         "logical_clock": self.logical_clock,
-                         "interface": "propagate_withdraw",
-                         "comment": f"event_sent to branch {id}"}
-            replica_branch_responses.append(event_ack)
-            replica_branch_response=stub.MsgDelivery(
-                distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="branch",
-                                                                       customer_requests=[customer_request]))
-            dict_response=protobuf_to_dict(replica_branch_response)
-            replica_branch_responses.extend(dict_response["event_result"])
+        for id, stub in zip(self.branch_id_list, self.stubList):
+            request = self.prepare_propagation(customer_request, "propagate_withdraw", id, replica_branch_responses)
+            replica_branch_response = self.send_propagation(id, stub, request)
+            self.acknowledge_vector_clock(id, replica_branch_response)
+            # the peer's EventResult messages go into this branch's response as they are
+            replica_branch_responses.extend(replica_branch_response.event_result)
 
         return replica_branch_responses
 
+    def send_propagation(self, id, stub, request):
+        # the peer drops a propagation it has received already, so a failed call can simply be sent again
+        for attempt in range(PROPAGATION_RETRIES + 1):
+            try:
+                response = stub.MsgDelivery(request)
+            except grpc.RpcError as e:
+                if attempt == PROPAGATION_RETRIES:
+                    self.release_later(id, request)
+                    raise
+                print(f"Retrying propagation to branch {id}: {e.code()}")
+                time.sleep(retry_delay(attempt))
+            else:
+                self.released(id, request)
+                return response
+
+    def release_later(self, id, request):
+        # the peer never gets this number, the next propagation to it carries its release
+        with self.propagations_sent_lock:
+            self.unreleased[id].add(request.customer_requests[0].sequence)
+
+    def released(self, id, request):
+        with self.propagations_sent_lock:
+            self.unreleased[id].difference_update(release.sequence for release in request.customer_requests[1:])
+
+    def prepare_propagation(self, customer_request, interface, id, replica_branch_responses):
+        # Tick the clock for the send event, record it and build the request for branch `id`
+        self.increment_logical_clock()
+        customer_request.logical_clock = self.logical_clock
+        customer_request.interface = interface
+        with self.propagations_sent_lock:
+            self.propagations_sent[id] += 1
+            customer_request.sequence = self.propagations_sent[id]
+            customer_request.epoch = self.epoch
+            # after the propagation, so the peer records its reception like before
+            releases = [distributed_banking_system_pb2.CustomerRequest(interface="release", epoch=self.epoch,
+                                                                       sequence=sequence)
+                        for sequence in sorted(self.unreleased[id])]
+        if self.vector_clock is not None:
+            customer_request.ClearField("vector_clock")
+            customer_request.vector_clock.extend(vector_clock.encode(self.vector_clock, self.peer_vector_clocks[id]))
+        event_ack = {"id": self.id,
+                     "customer_request_id": customer_request.customer_request_id,
+                     "type": "branch",
+                     "logical_clock": self.logical_clock,
+                     "interface": interface,
+                     "comment": f"event_sent to branch {id}"}
+        replica_branch_responses.append(self.stamp(event_ack))
+        return distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="branch",
+                                                                      customer_requests=[customer_request] + releases)
+
+
+class AsyncBranch(Branch):
+    # Branch served by grpc.aio: peer propagation is awaited on the event loop instead of holding a thread
+
+    def create_channel_manager(self):
+        return ChannelManager(aio=True, interceptors=self.client_interceptors)
+
+    def client_interceptors(self, branch_id):
+        if self.stats is None:
+            return []
+        return [AsyncClientLatencyInterceptor(self.stats, branch_id)]
+
+    def create_request_cache(self, capacity, ttl):
+        return AsyncRequestCache(self.request_key, capacity, ttl)
+
+    async def MsgDelivery(self, request, context):
+        if self.requests is None:
+            return await self.deliver(request)
+        return await self.requests.handle(request, functools.partial(self.deliver, request))
+
+    async def deliver(self, request):
+        type = request.type
+        response = [self.record_event_reception(request)]
+
+        match type:
+            case "customer":
+                response.extend(await self.process_customer_events(request))
+            case "branch":
+                self.process_branch_events(request)
+
+        if self.wal is not None:
+            await asyncio.to_thread(self.wait_durable)
+        return distributed_banking_system_pb2.BankingOperationResponse(event_result=response)
+
+    async def MsgStream(self, request_iterator, context):
+        async for request in request_iterator:
+            yield await self.MsgDelivery(request, context)
+
+    async def process_customer_events(self, request):
+        replica_branch_responses = list()
+        id = request.id
+        type = request.type
+        for customer_request in request.customer_requests:
+            match customer_request.interface:
+                case "deposit":
+                    _, propagate_deposit_response = await self.deposit(customer_request, id, type)
+                    replica_branch_responses.extend(propagate_deposit_response)
+                case "withdraw":
+                    _, propagate_withdraw_response = await self.withdraw(customer_request, id, type)
+                    replica_branch_responses.extend(propagate_withdraw_response)
+
+        return replica_branch_responses
 
-def serve(port, id, balance, branch_id_list, result_queue):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(Branch(id, balance, branch_id_list),
-                                                                             server)
+    async def deposit(self, customer_request, id, type):
+        replica_branch_responses = []
+        try:
+            replica_branch_responses = await self.replicate_deposit(customer_request)
+            self.accounts.add(customer_request.account, customer_request.money)
+            self.log_change("deposit", customer_request.customer_request_id, customer_request.money,
+                            customer_request.account)
+        except Exception as e:
+            print(e)
+            replica_branch_responses = []
+        response = {"id": id,
+                    "customer_request_id": customer_request.customer_request_id,
+                    "type": "branch",
+                    "logical_clock": self.logical_clock,
+                    "interface": customer_request.interface,
+                    "comment": f"event_sent to {type} {id}"}
+        return response, replica_branch_responses
+
+    async def withdraw(self, customer_request, id, type):
+        result = "failed"
+        replica_branch_responses = []
+        try:
+            if self.accounts.balance(customer_request.account) >= customer_request.money:
+                replica_branch_responses = await self.replicate_withdraw(customer_request)
+                self.accounts.add(customer_request.account, -customer_request.money)
+                self.log_change("withdraw", customer_request.customer_request_id, customer_request.money,
+                                customer_request.account)
+                result = "success"
+        except Exception as e:
+            print(e)
+            result = "failed"
+            replica_branch_responses = []
+        response = {'interface': 'withdraw', 'result': result}
+        return response, replica_branch_responses
+
+    async def replicate_deposit(self, customer_request):
+        replica_branch_responses = []
+        for id, stub in zip(self.branch_id_list, self.stubList):
+            request = self.prepare_propagation(customer_request, "propagate_deposit", id, replica_branch_responses)
+            replica_branch_response = await self.send_propagation(id, stub, request)
+            self.acknowledge_vector_clock(id, replica_branch_response)
+            # the peer's EventResult messages go into this branch's response as they are
+            replica_branch_responses.extend(replica_branch_response.event_result)
+
+        return replica_branch_responses
+
+    async def replicate_withdraw(self, customer_request):
+        replica_branch_responses = []
+        for id, stub in zip(self.branch_id_list, self.stubList):
+            request = self.prepare_propagation(customer_request, "propagate_withdraw", id, replica_branch_responses)
+            replica_branch_response = await self.send_propagation(id, stub, request)
+            self.acknowledge_vector_clock(id, replica_branch_response)
+            # the peer's EventResult messages go into this branch's response as they are
+            replica_branch_responses.extend(replica_branch_response.event_result)
+
+        return replica_branch_responses
+
+    async def send_propagation(self, id, stub, request):
+        for attempt in range(PROPAGATION_RETRIES + 1):
+            try:
+                response = await stub.MsgDelivery(request)
+            except grpc.RpcError as e:
+                if attempt == PROPAGATION_RETRIES:
+                    self.release_later(id, request)
+                    raise
+                print(f"Retrying propagation to branch {id}: {e.code()}")
+                await asyncio.sleep(retry_delay(attempt))
+            else:
+                self.released(id, request)
+                return response
+
+
+def retry_delay(attempt):
+    return PROPAGATION_RETRY_BACKOFF * 2 ** attempt
+
+
+def serve(port, id, balance, branch_id_list, result_queue, server_mode=SERVER_MODE):
+    wal, balance = open_write_ahead_log(id, balance)
+    if server_mode == "aio":
+        asyncio.run(serve_async(port, id, balance, branch_id_list, wal))
+        return
+
+    stats = LatencyStats() if LATENCY_STATS else None
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), options=SERVER_OPTIONS,
+                         interceptors=[ServerLatencyInterceptor(stats)] if stats is not None else None)
+    branch = Branch(id, balance, branch_id_list, wal=wal, stats=stats)
+    dump_stats_on_signal(id, stats, branch)
+    distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(branch, server)
     server.add_insecure_port("[::]:" + port)
     server.start()
     print("Server started, listening on " + port)
+    # connect to the peers before the first customer request needs them
+    branch.channels.warm_up(branch.branch_id_list)
+    print(f"Branch {id} peer channels: {branch.channels.connection_states()}")
+    branch.delivery.start()
     wait_for_termination(server)
+    branch.delivery.close()
+    branch.channels.close()
+    dump_stats(id, stats, branch)
+    if wal is not None:
+        wal.close()
     result_queue.put(server)
 
 
+def dump_stats(id, stats, branch):
+    if stats is not None:
+        stats.dump(f"Branch {id} latency")
+    print(f"Branch {id} hold-back: {json.dumps(branch.delivery.snapshot())}")
+    if branch.requests is not None:
+        print(f"Branch {id} request cache: {json.dumps(branch.requests.snapshot())}")
+
+
+def dump_stats_on_signal(id, stats, branch, loop=None):
+    # kill -USR1 <pid> prints the branch's p50/p99/p999 per request type, interface and peer, the depth of
+    # its hold-back queue and the requests it answered from its request cache
+    # With an event loop the dump runs as one of its callbacks: a signal.signal() handler would interrupt the
+    # loop's thread, which may hold the locks the dump takes, and wait for them forever
+    if hasattr(signal, "SIGUSR1"):
+        if loop is not None:
+            loop.add_signal_handler(signal.SIGUSR1, dump_stats, id, stats, branch)
+        else:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: dump_stats(id, stats, branch))
+
+
+def open_write_ahead_log(id, balance):
+    # Recover the branch from its newest snapshot and log tail, returns (log, balance)
+    if STATE_DIRECTORY is None:
+        return None, balance
+    wal = WriteAheadLog(os.path.join(STATE_DIRECTORY, f"branch_{id}"))
+    recovered_balance = wal.recover(balance)
+    print(f"Branch {id} recovered balance {recovered_balance}")
+    return wal, recovered_balance
+
+
+async def serve_async(port, id, balance, branch_id_list, wal=None):
+    # the aio channels of the peer stubs bind to the running loop, so the servicer is built in here
+    stats = LatencyStats() if LATENCY_STATS else None
+    server = grpc.aio.server(options=SERVER_OPTIONS,
+                             interceptors=[AsyncServerLatencyInterceptor(stats)] if stats is not None else None)
+    branch = AsyncBranch(id, balance, branch_id_list, wal=wal, stats=stats)
+    dump_stats_on_signal(id, stats, branch, asyncio.get_running_loop())
+    distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(branch, server)
+    server.add_insecure_port("[::]:" + port)
+    await server.start()
+    print("Async server started, listening on " + port)
+    await branch.channels.warm_up_async(branch.branch_id_list)
+    print(f"Branch {id} peer channels: {branch.channels.connection_states()}")
+    branch.delivery.start()
+    try:
+        await server.wait_for_termination()
+    finally:
+        await server.stop(None)
+        branch.delivery.close()
+        await branch.channels.close_async()
+        dump_stats(id, stats, branch)
+        if wal is not None:
+            wal.close()
+
+
 def wait_for_termination(server):
     try:
-        while True:
-            time.sleep(_ONE_DAY.total_seconds())
+        server.wait_for_termination()
     except KeyboardInterrupt:
         server.stop(None)
 
@@ -277,19 +637,6 @@ def populate_branch_id_list(branch_id_list):
         print(f"An error occurred: {str(e)}")
 
 
-def protobuf_to_dict(message):
-    result = {}
-    for field, value in message.ListFields():
-        if field.type == field.TYPE_MESSAGE:
-            if field.label == field.LABEL_REPEATED:
-                result[field.name] = [protobuf_to_dict(item) for item in value]
-            else:
-                result[field.name] = protobuf_to_dict(value)
-        else:
-            result[field.name] = value
-    return result
-
-
 if __name__ == "__main__":
     logging.basicConfig()
     branch_id_list = []
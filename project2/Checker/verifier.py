@@ -0,0 +1,155 @@
+import argparse
+import json
+import re
+
+# Checks what checker_part_1.py, checker_part_2.py and checker_part_3.py check, in one pass that decodes
+# one list element at a time, and prints the same summaries.
+#
+#   python3 ./Checker/verifier.py ./Output/output1.json ./Output/output2.json ./Output/output3.json
+#   python3 ./Checker/verifier.py ./Output/output.json
+#
+# A file with "// Part N" titles, like output.json, switches to part N at every title; a plain JSON list
+# is the part of its position among the arguments. Part 3 keeps the clocks of every customer request, so
+# the requests may come in any order and interleave. The events of one request at one branch are expected in
+# the order of their logical clocks, as every branch records them; checker_part_3.py sorts all events by
+# clock first, so only a file that breaks this passes there and fails here.
+
+# characters read from a file at a time
+READ_SIZE = 1 << 20
+PART_TITLE = re.compile(r"// Part (\d+):")
+
+
+def read_items(path, part):
+    # Yields (part, element) for every element of the JSON lists in the file
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    with open(path, "r", encoding="utf-8") as file:
+        while True:
+            # whitespace and the punctuation of the lists between their elements
+            while position < len(buffer) and buffer[position] in " \t\r\n[],":
+                position += 1
+            title_end = buffer.find("\n", position) if buffer.startswith("/", position) else 0
+            if position == len(buffer) or title_end < 0:
+                chunk = file.read(READ_SIZE)
+                if not chunk:
+                    return
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            if title_end:
+                title = PART_TITLE.match(buffer, position)
+                if title:
+                    part = int(title.group(1))
+                position = title_end + 1
+                continue
+            try:
+                element, position_after = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the element goes on in the next chunk
+                chunk = file.read(READ_SIZE)
+                if not chunk:
+                    raise
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield part, element
+            position = position_after
+
+
+class Verifier:
+    def __init__(self, verbose=False):
+        # print every event, not only the ones that fail
+        self.verbose = verbose
+        self.parts = set()
+        # part 1: answers per customer
+        self.answers = 0
+        self.correct_answers = 0
+        # part 2: last logical clock per branch
+        self.branch_clocks = {}
+        self.branch_events = 0
+        self.correct_branch_events = 0
+        # part 3: last logical clock per branch of every customer request
+        self.request_clocks = {}
+        self.request_events = 0
+        self.correct_request_events = 0
+
+    def check(self, part, element):
+        self.parts.add(part)
+        match part:
+            case 1:
+                self.check_customer(element)
+            case 2:
+                self.check_branch(element)
+            case 3:
+                self.check_event(element)
+
+    def check_customer(self, customer):
+        # The logical clock grows with every event of a customer
+        logical_clock = 0
+        for event in customer["events"]:
+            correct = event["logical_clock"] > logical_clock
+            if correct:
+                logical_clock = event["logical_clock"]
+                self.correct_answers += 1
+            self.answers += 1
+            self.report(correct, f"Customer ID: {customer['id']}, Event ID: {event['customer-request-id']}, "
+                                 f"Logical Clock: {event['logical_clock']}")
+
+    def check_branch(self, branch):
+        # The logical clock grows with every event of a branch. checker_part_2.py never carries its
+        # propagate flag over to the next event, so the order of propagations is not checked there either.
+        for event in branch["events"]:
+            correct = event["logical_clock"] > self.branch_clocks.get(branch["id"], -1)
+            self.branch_clocks[branch["id"]] = event["logical_clock"]
+            if correct:
+                self.correct_branch_events += 1
+            self.branch_events += 1
+            self.report(correct, f"Branch ID: {branch['id']}, Event ID: {event['customer-request-id']}")
+
+    def check_event(self, event):
+        # The logical clock of a branch does not go back within a customer request. checker_part_3.py
+        # compares propagations by a misspelled prefix that matches none, so that is not checked either.
+        request_id = event["customer-request-id"]
+        branch_clocks = self.request_clocks.setdefault(request_id, {})
+        correct = event["logical_clock"] >= branch_clocks.get(event["id"], 0)
+        if correct:
+            branch_clocks[event["id"]] = event["logical_clock"]
+            self.correct_request_events += 1
+        self.request_events += 1
+        self.report(correct, f"customer-request-id: {request_id}, Branch ID: {event['id']}, "
+                             f"Logical Clock: {event['logical_clock']}")
+
+    def report(self, correct, description):
+        if not correct:
+            print(f"{description} (Error)")
+        elif self.verbose:
+            print(f"{description} (OK)")
+
+    def summary(self):
+        if 1 in self.parts:
+            print(f"\nPart 1 Summary: {self.correct_answers} out of {self.answers} answers are correct.")
+        for part, total, correct in [(2, self.branch_events, self.correct_branch_events),
+                                     (3, self.request_events, self.correct_request_events)]:
+            if part in self.parts:
+                print(f"\nPart {part} Summary:")
+                print(f"Total Events: {total}")
+                print(f"Correct Events: {correct}")
+                print(f"Incorrect Events: {total - correct}")
+
+
+def verify(paths, verbose=False):
+    verifier = Verifier(verbose)
+    for part, path in enumerate(paths, start=1):
+        for element_part, element in read_items(path, part):
+            verifier.check(element_part, element)
+    verifier.summary()
+    return verifier
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks the project2 output files in one pass")
+    parser.add_argument("paths", nargs="+", help="output1.json output2.json output3.json, or output.json")
+    parser.add_argument("--verbose", action="store_true", help="print every event, not only the errors")
+    args = parser.parse_args()
+    verify(args.paths, args.verbose)
@@ -1,51 +1,63 @@
+import asyncio
+import functools
+import heapq
 import json
 import multiprocessing
 import os
+import queue
 import sys
-import grpc
+from operator import itemgetter
+
 import distributed_banking_system_pb2
-import distributed_banking_system_pb2_grpc
+from channel_manager import ChannelManager, CUSTOMER_CHANNEL_OPTIONS, CUSTOMER_WARM_UP_TIMEOUT
+from customer_driver import run_customers
+from protobuf_conversion import protobuf_to_dict
+import vector_clock
 
 OUTPUT_FILE_PATH = "./Output/output.json"
-
-
-def protobuf_to_dict(message):
-    result = {}
-    for field, value in message.ListFields():
-        if field.type == field.TYPE_MESSAGE:
-            if field.label == field.LABEL_REPEATED:
-                result[field.name] = [protobuf_to_dict(item) for item in value]
-            else:
-                result[field.name] = protobuf_to_dict(value)
-        else:
-            result[field.name] = value
-    return result
+# "unary" sends one MsgDelivery call per customer request, "stream" pushes the whole
+# customer-requests list over one long-lived MsgStream call
+REQUEST_MODE = "unary"
+# "process" starts one process per customer, "pool" runs all customers on a few worker processes
+# with an event loop each
+DRIVER_MODE = "process"
 
 
 class Customer:
-    def __init__(self, id, customer_requests):
+    def __init__(self, id, customer_requests, request_mode=REQUEST_MODE, channels=None, branch_count=0):
         # unique ID of the Customer
         self.id = id
         # events from the input
         self.customer_requests = customer_requests
         # a list of received messages used for debugging purpose
         self.recvMsg = list()
+        # the channel to the branch, kept connected by the manager; a pool worker shares its manager
+        self.channels = channels if channels is not None else ChannelManager(options=CUSTOMER_CHANNEL_OPTIONS)
         # pointer for the stub
         self.stub = self.createStub()
         # logical clock
         self.logical_clock = 0
+        # vector clock of every branch event the customer has seen, stays empty unless the branches keep one
+        self.vector_clock = []
+        # the part of it the customer's branch is known to have, a request carries the rest
+        self.branch_vector_clock = []
+        # branches in the input, the customer's vector clocks have one entry for each
+        self.branch_count = branch_count
+        # "unary" or "stream" delivery of the customer requests
+        self.request_mode = request_mode
 
     def createStub(self):
-        port = str(50050 + int(id))
-
-        address = f"localhost:{port}"
-        channel = grpc.insecure_channel(address)
-        return distributed_banking_system_pb2_grpc.BankingServiceStub(channel)
+        # the customer talks to the branch with the same id
+        self.channels.warm_up([self.id], CUSTOMER_WARM_UP_TIMEOUT)
+        return self.channels.stub(self.id)
 
     def executeEvents(self):
         banking_service_stub = self.stub
         customer_requests = self.customer_requests
         id = self.id
+        if self.request_mode == "stream":
+            return self.streamEvents()
+
         event_response = []
         event_sent_ack = []
         for customer_request in customer_requests:
@@ -59,14 +71,61 @@ class Customer:
         self.logical_clock += 1
 
     def executeEvent(self, banking_service_stub, customer_request, id):
+        customer_event, request = self.prepare_request(customer_request, id)
+        response = banking_service_stub.MsgDelivery(request)
+        self.observe_vector_clocks(response)
+        return customer_event, response
+
+    def streamEvents(self):
+        # Send every customer request over a single MsgStream call; the branch answers them in order
+        event_sent_ack = []
+        event_response = []
+        # one item per observed response, for the requests that have to wait for it
+        observed = queue.Queue()
+        try:
+            for response in self.stub.MsgStream(self.stream_requests(event_sent_ack, observed)):
+                self.observe_vector_clocks(response)
+                event_response.append(response)
+                observed.put(None)
+        finally:
+            # a request still waiting when the call ends is not sent
+            observed.put(None)
+        return event_response, event_sent_ack
+
+    def stream_requests(self, event_sent_ack, observed):
+        # gRPC takes the requests on its own thread; a request that waits for the previous response takes the
+        # vector clocks after that response is merged into them, and the caller's thread no longer changes them
+        for index, customer_request in enumerate(self.customer_requests):
+            if self.waits_for_response(index):
+                observed.get()
+            customer_event, request = self.prepare_request(customer_request, self.id)
+            event_sent_ack.append(customer_event)
+            yield request
+
+    def waits_for_response(self, index):
+        # The second request waits for the first response, which tells whether the branches keep vector clocks.
+        # With vector clocks every request carries the clock of all responses before it, without them the rest
+        # of the requests are sent without waiting
+        return index == 1 or (index > 1 and bool(self.vector_clock))
+
+    def prepare_request(self, customer_request, id):
         self.increment_logical_clock()
         customer_event = self.append_customer_event_to_recvMsg(customer_request, id)
         customer_request["logical_clock"] = self.logical_clock
         customer_request["customer_request_id"] = customer_request.pop("customer-request-id")
-        response = banking_service_stub.MsgDelivery(
-            distributed_banking_system_pb2.BankingOperationRequest(id=id, type="customer",
-                                                                   customer_requests=[customer_request]))
-        return customer_event, response
+        if self.vector_clock:
+            customer_request["vector_clock"] = vector_clock.encode(self.vector_clock, self.branch_vector_clock)
+        request = distributed_banking_system_pb2.BankingOperationRequest(id=id, type="customer",
+                                                                         customer_requests=[customer_request])
+        return customer_event, request
+
+    def observe_vector_clocks(self, response):
+        # The customer has seen every event of the response, its branch the ones up to its reception event
+        if response.event_result and response.event_result[0].vector_clock:
+            for event_result in response.event_result:
+                vector_clock.merge_pairs(self.vector_clock, event_result.vector_clock)
+            vector_clock.merge_pairs(self.branch_vector_clock, response.event_result[0].vector_clock)
+            vector_clock.pad(self.vector_clock, self.branch_count)
 
     def update_recvMsg(self, branch_response):
         branch_dict_response = protobuf_to_dict(branch_response)
@@ -80,21 +139,78 @@ class Customer:
                           "logical_clock": self.logical_clock,
                           "interface": customer_request["interface"],
                           "comment": f"event_sent from customer {customer_id}"}
+        if self.vector_clock:
+            customer_event["vector_clock"] = list(self.vector_clock)
         self.recvMsg.append(customer_event)
         return customer_event
 
 
-def transform_branch_response_to_json(customer_response):
+class AsyncCustomer(Customer):
+    # Customer session of the pool driver, on the worker's shared grpc.aio channels
+
+    def createStub(self):
+        # the driver warmed up the channels to every branch before the sessions start
+        return self.channels.stub(self.id)
+
+    async def executeEvents(self):
+        if self.request_mode == "stream":
+            return await self.streamEvents()
+
+        event_response = []
+        event_sent_ack = []
+        for customer_request in self.customer_requests:
+            customer_event, request = self.prepare_request(customer_request, self.id)
+            response = await self.stub.MsgDelivery(request)
+            self.observe_vector_clocks(response)
+            event_response.append(response)
+            event_sent_ack.append(customer_event)
+
+        return event_response, event_sent_ack
+
+    async def streamEvents(self):
+        event_sent_ack = []
+        event_response = []
+        observed = asyncio.Queue()
+        async for response in self.stub.MsgStream(self.stream_requests_async(event_sent_ack, observed)):
+            self.observe_vector_clocks(response)
+            event_response.append(response)
+            observed.put_nowait(None)
+        return event_response, event_sent_ack
+
+    async def stream_requests_async(self, event_sent_ack, observed):
+        for index, customer_request in enumerate(self.customer_requests):
+            if self.waits_for_response(index):
+                await observed.get()
+            customer_event, request = self.prepare_request(customer_request, self.id)
+            event_sent_ack.append(customer_event)
+            yield request
+
+
+async def run_customer_session(item, channels, branch_count=0):
+    customer = AsyncCustomer(item["id"], item["customer-requests"], channels=channels, branch_count=branch_count)
+    branch_response, customer_response = await customer.executeEvents()
+    json_response = transform_branch_response_to_json(branch_response, branch_count)
+    merge_customer_and_branch_response(customer_response, json_response)
+    return json_response
+
+
+def transform_branch_response_to_json(customer_response, branch_count=0):
     result = []
     for response in customer_response:
-        result.append(protobuf_to_dict(response)["event_result"])
+        events = protobuf_to_dict(response)["event_result"]
+        if events[0].get("vector_clock"):
+            # the output lists the whole vector of every event, so tools can order events without the pairs
+            for event in events:
+                event["vector_clock"] = vector_clock.decode(event["vector_clock"], branch_count)
+        result.append(events)
     return result
 
 
-def start_customer_process(id, events, result_queue):
-    customer = Customer(id, events)
+def start_customer_process(id, events, result_queue, branch_count=0):
+    customer = Customer(id, events, branch_count=branch_count)
     branch_response, customer_response = customer.executeEvents()
-    json_response = transform_branch_response_to_json(branch_response)
+    customer.channels.close()
+    json_response = transform_branch_response_to_json(branch_response, branch_count)
     merge_customer_and_branch_response(customer_response, json_response)
     result_queue.put(json_response)
 
@@ -104,119 +220,127 @@ def merge_customer_and_branch_response(customer_response, json_response):
         json_response[i].insert(0, customer_response[i])
 
 
-def get_filtered_results(event_type, results):
-    filtered_results = []
+class SortedRuns:
+    # Events in the order they were scanned, cut into runs that are already sorted by `key` (the events of
+    # one branch mostly arrive in logical-clock order); merging the runs with a heap gives the order of a
+    # stable sort without sorting
+    def __init__(self, key):
+        self.key = key
+        self.runs = []
+        self.last_key = None
+
+    def append(self, event):
+        key = self.key(event)
+        if not self.runs or key < self.last_key:
+            self.runs.append([])
+        self.runs[-1].append(event)
+        self.last_key = key
+
+    def __iter__(self):
+        # equal keys come out in scan order, heapq.merge prefers the earlier run
+        return heapq.merge(*self.runs, key=self.key)
+
+
+def group_events(results):
+    # One scan over the results: the customer events by customer id, the branch events by branch id and
+    # all events, each ordered as their output part lists them
+    customer_groups = {}
+    branch_groups = {}
+    all_events = SortedRuns(itemgetter("customer_request_id", "logical_clock"))
     for customer_events in results:
         for customer_event in customer_events:
             for event in customer_event:
-                if event['type'] == event_type:
-                    filtered_results.append(event)
-    return filtered_results
-
-
-def get_customer_id_events_aggregated_map(filtered_results):
-    aggregated_data = {}
-
-    for item in filtered_results:
-        id = item['id']
-        if id not in aggregated_data:
-            aggregated_data[id] = []
-        aggregated_data[id].append(item)
-    return aggregated_data
-
-
-def get_sorted_customer_branch_format(aggregated_data, sort_key):
-    output = []
-    for id, events in aggregated_data.items():
-        events = sorted(events, key=lambda d: d[sort_key])
-        output.append({"id": id,
-                       "type": events[0]["type"],
-                       "events": [{"customer-request-id": item["customer_request_id"],
-                                   "logical_clock": item["logical_clock"],
-                                   "interface": item["interface"],
-                                   "comment": item["comment"]}
-                                  for item in events]
-                       })
-    return output
+                all_events.append(event)
+                match event["type"]:
+                    case "customer":
+                        groups, key = customer_groups, itemgetter("customer_request_id")
+                    case "branch":
+                        groups, key = branch_groups, itemgetter("logical_clock")
+                    case _:
+                        continue
+                group = groups.get(event["id"])
+                if group is None:
+                    group = groups[event["id"]] = SortedRuns(key)
+                group.append(event)
+    return customer_groups, branch_groups, all_events
+
+
+def format_groups(groups):
+    for id, events in groups.items():
+        events = list(events)
+        yield {"id": id,
+               "type": events[0]["type"],
+               "events": [format_group_event(item) for item in events]
+               }
+
+
+def format_group_event(item):
+    event = {"customer-request-id": item["customer_request_id"],
+             "logical_clock": item["logical_clock"],
+             "interface": item["interface"],
+             "comment": item["comment"]}
+    if "vector_clock" in item:
+        event["vector_clock"] = item["vector_clock"]
+    return event
+
+
+def format_events(events):
+    for item in events:
+        yield {k.replace('_', '-') if k == 'customer_request_id' else k: v for k, v in item.items()}
 
 
 def generate_customer_output(results):
-    filtered_results = get_filtered_results("customer", results)
-    aggregated_data = get_customer_id_events_aggregated_map(filtered_results)
-    customer_output = get_sorted_customer_branch_format(aggregated_data, 'customer_request_id')
-
-    return customer_output
+    customer_groups, _, _ = group_events(results)
+    return list(format_groups(customer_groups))
 
 
 def generate_branch_output(results):
-    filtered_results = get_filtered_results("branch", results)
-    aggregated_data = get_customer_id_events_aggregated_map(filtered_results)
-    branch_output = get_sorted_customer_branch_format(aggregated_data, 'logical_clock')
-
-    return branch_output
+    _, branch_groups, _ = group_events(results)
+    return list(format_groups(branch_groups))
 
 
 def generate_event_output(results):
-    flattened_results = []
-    for customer_events in results:
-        for customer_event in customer_events:
-            for event in customer_event:
-                flattened_results.append(event)
-    events = sorted(flattened_results, key=lambda d: (d['customer_request_id'], d['logical_clock']))
-    event_key_transformed_data = [{k.replace('_', '-') if k == 'customer_request_id' else k: v for k, v in item.items()}
-                                  for item
-                                  in events]
-    return event_key_transformed_data
+    _, _, all_events = group_events(results)
+    return list(format_events(all_events))
+
+
+def write_json_list(items, output_files):
+    # Writes the items as json.dumps(list(items), ensure_ascii=False, indent=4) would, one item at a time,
+    # encoding every item once for all the files
+    separator = "[\n    "
+    for item in items:
+        chunk = separator + json.dumps(item, ensure_ascii=False, indent=4).replace("\n", "\n    ")
+        for output_file in output_files:
+            output_file.write(chunk)
+        separator = ",\n    "
+    for output_file in output_files:
+        output_file.write("[]" if separator == "[\n    " else "\n]")
 
 
 def generate_output(results):
     directory = os.path.dirname(OUTPUT_FILE_PATH)
     if not os.path.exists(directory):
         os.makedirs(directory)
-    output_file = open(OUTPUT_FILE_PATH, "a", encoding='utf-8')
-    output_file.write(f"// Part 1: List all the events taken place on each customer\n")
-    customer_output = generate_customer_output(results)
-    output_file.write(json.dumps(customer_output, ensure_ascii=False, indent=4))
-    # Testing
-    open("./Output/output1.json", "w", encoding='utf-8').write(
-        json.dumps(customer_output, ensure_ascii=False, indent=4))
-
-    output_file.write(f"\n// Part 2: List all the events taken place on each branch\n")
-    branch_output = generate_branch_output(results)
-    output_file.write(json.dumps(branch_output, ensure_ascii=False, indent=4))
-    # Testing
-    open("./Output/output2.json", "w", encoding='utf-8').write(json.dumps(branch_output, ensure_ascii=False, indent=4))
-
-    output_file.write(
-        f"\n// Part 3: List all the events (along with their logical times) triggered by each customer Deposit/Withdraw request\n")
-    event_output = generate_event_output(results)
-    output_file.write(json.dumps(event_output, ensure_ascii=False, indent=4))
-    # Testing
-    open("./Output/output3.json", "w", encoding='utf-8').write(json.dumps(event_output, ensure_ascii=False, indent=4))
-
-    output_file.close()
+    customer_groups, branch_groups, all_events = group_events(results)
+    parts = [("// Part 1: List all the events taken place on each customer\n",
+              format_groups(customer_groups), "./Output/output1.json"),
+             ("\n// Part 2: List all the events taken place on each branch\n",
+              format_groups(branch_groups), "./Output/output2.json"),
+             ("\n// Part 3: List all the events (along with their logical times) triggered by each customer Deposit/Withdraw request\n",
+              format_events(all_events), "./Output/output3.json")]
+    with open(OUTPUT_FILE_PATH, "a", encoding='utf-8') as output_file:
+        for title, items, part_file_path in parts:
+            output_file.write(title)
+            # Testing
+            with open(part_file_path, "w", encoding='utf-8') as part_file:
+                write_json_list(items, [output_file, part_file])
 
 
 def run_checker_scripts():
-    import subprocess
-
-    # Replace 'your-shell-command' with the actual shell command you want to run
-    shell_commands = ['python3 ./Checker/checker_part_1.py ./Output/output1.json',
-                      'python3 ./Checker/checker_part_2.py ./Output/output2.json',
-                      'python3 ./Checker/checker_part_3.py ./Output/output3.json']
-    for shell_command in shell_commands:
-        # Run the shell command
-        result = subprocess.run(shell_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-        # Check if the command was successful
-        if result.returncode == 0:
-            print("Command executed successfully")
-            print("Standard Output:")
-            print(result.stdout)
-        else:
-            print("Error executing the command")
-            print("Standard Error:")
-            print(result.stderr)
+    # the checks of the three Checker/checker_part_*.py scripts, in one pass over the output files and
+    # without starting a python3 process per script
+    from Checker.verifier import verify
+    verify(["./Output/output1.json", "./Output/output2.json", "./Output/output3.json"])
 
 
 if __name__ == '__main__':
@@ -233,30 +357,34 @@ if __name__ == '__main__':
         processes = []
         result_queue = multiprocessing.Queue()
         parsed_data = json.load(input_file)
-        customers = []
-        for item in parsed_data:
-            if item["type"] != "customer":
-                continue
-
-            id = item["id"]
-            type = item["type"]
-            customer_requests = item["customer-requests"]
-            process = multiprocessing.Process(target=start_customer_process,
-                                              args=(id, customer_requests, result_queue))
-            processes.append(process)
-            process.start()
-
-            # sleep for 3 seconds for event propagation
-            # time.sleep(3)
-
-        for process in processes:
-            process.join()
-
-        # Retrieve results from the queue
-        results = []
-        while not result_queue.empty():
-            result = result_queue.get()
-            results.append(result)
+        customers = [item for item in parsed_data if item["type"] == "customer"]
+        # the vector clocks in the output have one entry per branch
+        branch_count = sum(1 for item in parsed_data if item["type"] == "branch")
+        if DRIVER_MODE == "pool":
+            # every customer talks to the branch with its own id
+            results = run_customers(customers, functools.partial(run_customer_session, branch_count=branch_count),
+                                    sorted({item["id"] for item in customers}))
+        else:
+            for item in customers:
+                id = item["id"]
+                type = item["type"]
+                customer_requests = item["customer-requests"]
+                process = multiprocessing.Process(target=start_customer_process,
+                                                  args=(id, customer_requests, result_queue, branch_count))
+                processes.append(process)
+                process.start()
+
+                # sleep for 3 seconds for event propagation
+                # time.sleep(3)
+
+            for process in processes:
+                process.join()
+
+            # Retrieve results from the queue
+            results = []
+            while not result_queue.empty():
+                result = result_queue.get()
+                results.append(result)
         generate_output(results)
         print("Customer process completed\n")
         # run_checker_scripts()
@@ -0,0 +1,138 @@
+import threading
+import time
+
+# propagations held back per sender at most; beyond it the oldest gap is given up on
+HOLD_BACK_LIMIT = 256
+# seconds a gap may hold back the propagations after it before it is given up on
+HOLD_BACK_TIMEOUT = 5.0
+# seconds between the timer's checks for expired gaps, so a gap is given up on without another propagation
+HOLD_BACK_CHECK_INTERVAL = 1.0
+
+
+class CausalDelivery:
+    # Delivers the propagations of every sender in the order the sender numbered them (1, 2, 3, ... per
+    # receiver). A propagation that arrives ahead of a gap waits in the hold-back queue of its sender until
+    # the gap closes; one that was delivered already is dropped, so a sender may send it again. A gap that
+    # stays open past HOLD_BACK_TIMEOUT, or while HOLD_BACK_LIMIT propagations wait behind it, is skipped:
+    # the waiting propagations are delivered and the missing ones are still delivered if they turn up. Expired
+    # gaps are found when the next propagation arrives and, once start() was called, by a timer; close() delivers
+    # whatever is still held.
+
+    def __init__(self, deliver, limit=HOLD_BACK_LIMIT, timeout=HOLD_BACK_TIMEOUT,
+                 check_interval=HOLD_BACK_CHECK_INTERVAL):
+        # called with every propagation in delivery order, under the lock
+        self.deliver = deliver
+        self.limit = limit
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.timer = None
+        # highest sequence per sender up to which every propagation was delivered or skipped
+        self.delivered = dict()
+        # skipped sequences per sender that have not turned up yet
+        self.skipped = dict()
+        # sender -> {sequence: propagation} and the time the oldest of them started to wait
+        self.held = dict()
+        self.held_since = dict()
+        # metrics
+        self.depth = 0
+        self.max_depth = 0
+        self.held_total = 0
+        self.gaps_skipped = 0
+        self.duplicates = 0
+
+    def receive(self, sender, sequence, propagation):
+        with self.lock:
+            if sequence == 0:
+                # the sender does not number its propagations
+                self.deliver(propagation)
+            else:
+                self.receive_numbered(sender, sequence, propagation)
+            self.skip_expired_gaps()
+
+    def receive_numbered(self, sender, sequence, propagation):
+        held = self.held.setdefault(sender, dict())
+        delivered = self.delivered.get(sender, 0)
+        if sequence <= delivered:
+            skipped = self.skipped.get(sender, set())
+            if sequence in skipped:
+                # late, but never lost
+                skipped.remove(sequence)
+                self.deliver(propagation)
+            else:
+                self.duplicates += 1
+            return
+        if sequence in held:
+            self.duplicates += 1
+            return
+        if sequence != delivered + 1:
+            if not held:
+                self.held_since[sender] = time.monotonic()
+            held[sequence] = propagation
+            self.depth += 1
+            self.held_total += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            if len(held) > self.limit:
+                self.skip_gap(sender)
+            return
+        self.deliver(propagation)
+        self.delivered[sender] = sequence
+        self.deliver_held(sender)
+
+    def deliver_held(self, sender):
+        held = self.held[sender]
+        delivered = self.delivered[sender]
+        while delivered + 1 in held:
+            delivered += 1
+            self.deliver(held.pop(delivered))
+            self.depth -= 1
+        self.delivered[sender] = delivered
+        if held:
+            self.held_since[sender] = time.monotonic()
+
+    def skip_gap(self, sender):
+        # Give up on the sequences missing before the first held propagation of the sender
+        held = self.held[sender]
+        first = min(held)
+        self.skipped.setdefault(sender, set()).update(range(self.delivered.get(sender, 0) + 1, first))
+        self.delivered[sender] = first - 1
+        self.gaps_skipped += 1
+        self.deliver_held(sender)
+
+    def skip_expired_gaps(self):
+        now = time.monotonic()
+        for sender, held in self.held.items():
+            if held and now - self.held_since[sender] > self.timeout:
+                self.skip_gap(sender)
+
+    def start(self):
+        self.timer = threading.Thread(target=self.check_expired_gaps, daemon=True)
+        self.timer.start()
+
+    def check_expired_gaps(self):
+        while not self.stopped.wait(self.check_interval):
+            with self.lock:
+                self.skip_expired_gaps()
+
+    def close(self):
+        self.stopped.set()
+        if self.timer is not None:
+            self.timer.join()
+        self.drain()
+
+    def drain(self):
+        # Give up on every open gap and deliver all held propagations
+        with self.lock:
+            for sender, held in self.held.items():
+                while held:
+                    self.skip_gap(sender)
+
+    def snapshot(self):
+        with self.lock:
+            return {"depth": self.depth,
+                    "max_depth": self.max_depth,
+                    "held": self.held_total,
+                    "gaps_skipped": self.gaps_skipped,
+                    "duplicates": self.duplicates,
+                    "depth_per_sender": {str(sender): len(held) for sender, held in self.held.items() if held}}
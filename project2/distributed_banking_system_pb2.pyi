@@ -22,29 +22,39 @@ class BankingOperationResponse(_message.Message):
     def __init__(self, event_result: _Optional[_Iterable[_Union[EventResult, _Mapping]]] = ...) -> None: ...
 
 class CustomerRequest(_message.Message):
-    __slots__ = ["customer_request_id", "interface", "logical_clock", "money"]
+    __slots__ = ["customer_request_id", "interface", "logical_clock", "money", "account", "vector_clock", "sequence", "epoch"]
     CUSTOMER_REQUEST_ID_FIELD_NUMBER: _ClassVar[int]
     INTERFACE_FIELD_NUMBER: _ClassVar[int]
     LOGICAL_CLOCK_FIELD_NUMBER: _ClassVar[int]
     MONEY_FIELD_NUMBER: _ClassVar[int]
+    ACCOUNT_FIELD_NUMBER: _ClassVar[int]
+    VECTOR_CLOCK_FIELD_NUMBER: _ClassVar[int]
+    SEQUENCE_FIELD_NUMBER: _ClassVar[int]
+    EPOCH_FIELD_NUMBER: _ClassVar[int]
     customer_request_id: int
     interface: str
     logical_clock: int
     money: int
-    def __init__(self, customer_request_id: _Optional[int] = ..., interface: _Optional[str] = ..., logical_clock: _Optional[int] = ..., money: _Optional[int] = ...) -> None: ...
+    account: int
+    vector_clock: _containers.RepeatedScalarFieldContainer[int]
+    sequence: int
+    epoch: int
+    def __init__(self, customer_request_id: _Optional[int] = ..., interface: _Optional[str] = ..., logical_clock: _Optional[int] = ..., money: _Optional[int] = ..., account: _Optional[int] = ..., vector_clock: _Optional[_Iterable[int]] = ..., sequence: _Optional[int] = ..., epoch: _Optional[int] = ...) -> None: ...
 
 class EventResult(_message.Message):
-    __slots__ = ["id", "customer_request_id", "type", "logical_clock", "interface", "comment"]
+    __slots__ = ["id", "customer_request_id", "type", "logical_clock", "interface", "comment", "vector_clock"]
     ID_FIELD_NUMBER: _ClassVar[int]
     CUSTOMER_REQUEST_ID_FIELD_NUMBER: _ClassVar[int]
     TYPE_FIELD_NUMBER: _ClassVar[int]
     LOGICAL_CLOCK_FIELD_NUMBER: _ClassVar[int]
     INTERFACE_FIELD_NUMBER: _ClassVar[int]
     COMMENT_FIELD_NUMBER: _ClassVar[int]
+    VECTOR_CLOCK_FIELD_NUMBER: _ClassVar[int]
     id: int
     customer_request_id: int
     type: str
     logical_clock: int
     interface: str
     comment: str
-    def __init__(self, id: _Optional[int] = ..., customer_request_id: _Optional[int] = ..., type: _Optional[str] = ..., logical_clock: _Optional[int] = ..., interface: _Optional[str] = ..., comment: _Optional[str] = ...) -> None: ...
+    vector_clock: _containers.RepeatedScalarFieldContainer[int]
+    def __init__(self, id: _Optional[int] = ..., customer_request_id: _Optional[int] = ..., type: _Optional[str] = ..., logical_clock: _Optional[int] = ..., interface: _Optional[str] = ..., comment: _Optional[str] = ..., vector_clock: _Optional[_Iterable[int]] = ...) -> None: ...
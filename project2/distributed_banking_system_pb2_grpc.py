@@ -19,6 +19,11 @@ class BankingServiceStub(object):
                 request_serializer=distributed__banking__system__pb2.BankingOperationRequest.SerializeToString,
                 response_deserializer=distributed__banking__system__pb2.BankingOperationResponse.FromString,
                 )
+        self.MsgStream = channel.stream_stream(
+                '/distributed_banking.BankingService/MsgStream',
+                request_serializer=distributed__banking__system__pb2.BankingOperationRequest.SerializeToString,
+                response_deserializer=distributed__banking__system__pb2.BankingOperationResponse.FromString,
+                )
 
 
 class BankingServiceServicer(object):
@@ -30,6 +35,12 @@ class BankingServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def MsgStream(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_BankingServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -38,6 +49,11 @@ def add_BankingServiceServicer_to_server(servicer, server):
                     request_deserializer=distributed__banking__system__pb2.BankingOperationRequest.FromString,
                     response_serializer=distributed__banking__system__pb2.BankingOperationResponse.SerializeToString,
             ),
+            'MsgStream': grpc.stream_stream_rpc_method_handler(
+                    servicer.MsgStream,
+                    request_deserializer=distributed__banking__system__pb2.BankingOperationRequest.FromString,
+                    response_serializer=distributed__banking__system__pb2.BankingOperationResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'distributed_banking.BankingService', rpc_method_handlers)
@@ -64,3 +80,20 @@ class BankingService(object):
             distributed__banking__system__pb2.BankingOperationResponse.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def MsgStream(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(request_iterator, target, '/distributed_banking.BankingService/MsgStream',
+            distributed__banking__system__pb2.BankingOperationRequest.SerializeToString,
+            distributed__banking__system__pb2.BankingOperationResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
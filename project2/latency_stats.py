@@ -0,0 +1,183 @@
+import json
+import threading
+import time
+
+import grpc
+
+# latencies are recorded in microseconds; below 2 ** (SUB_BUCKET_BITS + 1) every value has its own bucket,
+# above it every power of two is split into 2 ** SUB_BUCKET_BITS buckets (about 6% relative error)
+SUB_BUCKET_BITS = 4
+_SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+PERCENTILES = [("p50", 0.50), ("p99", 0.99), ("p999", 0.999)]
+
+
+def bucket_index(value):
+    shift = max(value.bit_length() - SUB_BUCKET_BITS - 1, 0)
+    return shift * _SUB_BUCKETS + (value >> shift)
+
+
+def bucket_highest_value(index):
+    # largest value that falls into the bucket
+    shift = max(index // _SUB_BUCKETS - 1, 0)
+    return ((index - shift * _SUB_BUCKETS + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    # HDR-style histogram: log buckets with a fixed number of linear sub-buckets, so recording is an
+    # integer shift and a dict increment and the percentiles keep a bounded relative error
+
+    def __init__(self):
+        self.counts = dict()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, microseconds):
+        index = bucket_index(microseconds)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += microseconds
+        if microseconds > self.max:
+            self.max = microseconds
+
+    def percentile(self, fraction):
+        rank = max(1, int(fraction * self.count + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(bucket_highest_value(index), self.max)
+        return self.max
+
+
+class LatencyStats:
+    # Histograms keyed by (side, type, interface, peer): "server" for the requests a branch answers,
+    # "client" for the propagations it sends to its peers
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = dict()
+
+    def record(self, side, type, interface, peer, seconds):
+        key = (side, type, interface, peer)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.record(int(seconds * 1e6))
+
+    def snapshot(self):
+        # One row per key, latencies in milliseconds
+        rows = []
+        with self.lock:
+            for (side, type, interface, peer), histogram in sorted(self.histograms.items(), key=str):
+                row = {"side": side, "type": type, "interface": interface, "peer": peer,
+                       "count": histogram.count, "mean_ms": histogram.total / histogram.count / 1000}
+                for name, fraction in PERCENTILES:
+                    row[f"{name}_ms"] = histogram.percentile(fraction) / 1000
+                row["max_ms"] = histogram.max / 1000
+                rows.append(row)
+        return rows
+
+    def dump(self, title):
+        print(f"{title}: {json.dumps(self.snapshot())}")
+
+
+def request_events(request):
+    # the repeated event field of BankingOperationRequest, whatever its name is in this project
+    for field in request.DESCRIPTOR.fields:
+        if field.label == field.LABEL_REPEATED:
+            return getattr(request, field.name)
+    return ()
+
+
+def request_interface(request):
+    interfaces = {event.interface for event in request_events(request)}
+    if len(interfaces) == 1:
+        return interfaces.pop()
+    return "mixed" if interfaces else ""
+
+
+def request_peer(request):
+    # propagations carry the id of the sending branch, customers are not counted as peers
+    return request.id if request.type == "branch" else None
+
+
+class ServerLatencyInterceptor(grpc.ServerInterceptor):
+    # Times every unary call from the moment its handler starts until the response is returned;
+    # streaming calls are passed through untouched
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or handler.unary_unary is None:
+            return handler
+        behavior = handler.unary_unary
+
+        def timed_behavior(request, context):
+            # the key is taken before the handler runs, Branch may rewrite the request while it is handled
+            key = ("server", request.type, request_interface(request), request_peer(request))
+            start = time.perf_counter()
+            try:
+                return behavior(request, context)
+            finally:
+                self.stats.record(*key, time.perf_counter() - start)
+
+        return grpc.unary_unary_rpc_method_handler(timed_behavior,
+                                                   request_deserializer=handler.request_deserializer,
+                                                   response_serializer=handler.response_serializer)
+
+
+class AsyncServerLatencyInterceptor(grpc.aio.ServerInterceptor):
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None or handler.unary_unary is None:
+            return handler
+        behavior = handler.unary_unary
+
+        async def timed_behavior(request, context):
+            key = ("server", request.type, request_interface(request), request_peer(request))
+            start = time.perf_counter()
+            try:
+                return await behavior(request, context)
+            finally:
+                self.stats.record(*key, time.perf_counter() - start)
+
+        return grpc.unary_unary_rpc_method_handler(timed_behavior,
+                                                   request_deserializer=handler.request_deserializer,
+                                                   response_serializer=handler.response_serializer)
+
+
+class ClientLatencyInterceptor(grpc.UnaryUnaryClientInterceptor):
+    # Times the calls on the channel to one peer branch, blocking calls and .future() calls alike
+
+    def __init__(self, stats, peer):
+        self.stats = stats
+        self.peer = peer
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        key = ("client", request.type, request_interface(request), self.peer)
+        start = time.perf_counter()
+        call = continuation(client_call_details, request)
+        call.add_done_callback(lambda _: self.stats.record(*key, time.perf_counter() - start))
+        return call
+
+
+class AsyncClientLatencyInterceptor(grpc.aio.UnaryUnaryClientInterceptor):
+
+    def __init__(self, stats, peer):
+        self.stats = stats
+        self.peer = peer
+
+    async def intercept_unary_unary(self, continuation, client_call_details, request):
+        key = ("client", request.type, request_interface(request), self.peer)
+        start = time.perf_counter()
+        call = await continuation(client_call_details, request)
+        call.add_done_callback(lambda _: self.stats.record(*key, time.perf_counter() - start))
+        return call
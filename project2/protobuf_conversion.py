@@ -0,0 +1,52 @@
+import functools
+
+from google.protobuf.descriptor import FieldDescriptor
+
+# protobuf_to_dict() returns the same dict as walking ListFields(): only the fields that are set, in field-number
+# order; proto3 scalars are set when they differ from their default, lists when they are not empty and fields
+# with presence (`optional` ones and messages) when they were assigned. The fields come from the message's
+# descriptor, so a field added to the schema is converted without touching this module.
+
+# how a field is read, see field_kind()
+SCALAR = 0
+PRESENCE = 1
+MESSAGE = 2
+REPEATED = 3
+REPEATED_MESSAGE = 4
+
+
+@functools.cache
+def field_kinds(message_type):
+    # (name, kind) per field of the message type, in field-number order; built once per type
+    fields = sorted(message_type.DESCRIPTOR.fields, key=lambda field: field.number)
+    return tuple((field.name, field_kind(field)) for field in fields)
+
+
+def field_kind(field):
+    is_message = field.type == FieldDescriptor.TYPE_MESSAGE
+    if field.label == FieldDescriptor.LABEL_REPEATED:
+        return REPEATED_MESSAGE if is_message else REPEATED
+    if is_message:
+        return MESSAGE
+    return PRESENCE if field.has_presence else SCALAR
+
+
+def protobuf_to_dict(message):
+    result = {}
+    for name, kind in field_kinds(type(message)):
+        if kind == SCALAR:
+            value = getattr(message, name)
+            if value:
+                result[name] = value
+        elif kind == REPEATED_MESSAGE:
+            items = getattr(message, name)
+            if items:
+                result[name] = [protobuf_to_dict(item) for item in items]
+        elif kind == REPEATED:
+            items = getattr(message, name)
+            if items:
+                result[name] = list(items)
+        elif message.HasField(name):
+            value = getattr(message, name)
+            result[name] = protobuf_to_dict(value) if kind == MESSAGE else value
+    return result
@@ -0,0 +1,43 @@
+import time
+
+from causal_delivery import CausalDelivery
+
+
+def test_timer_delivers_held_propagations_without_another_arrival():
+    delivered = []
+    delivery = CausalDelivery(delivered.append, timeout=0.05, check_interval=0.01)
+    delivery.start()
+    try:
+        # propagation 1 of the sender is lost, nothing arrives after 3
+        delivery.receive(2, 2, "second")
+        delivery.receive(2, 3, "third")
+        assert delivered == []
+        deadline = time.monotonic() + 2
+        while len(delivered) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert delivered == ["second", "third"]
+        assert delivery.snapshot()["gaps_skipped"] == 1
+    finally:
+        delivery.close()
+
+
+def test_close_drains_every_held_propagation():
+    delivered = []
+    delivery = CausalDelivery(delivered.append, timeout=60)
+    delivery.receive(2, 2, "a2")
+    delivery.receive(2, 4, "a4")
+    delivery.receive(3, 3, "b3")
+    delivery.close()
+    assert delivered == ["a2", "a4", "b3"]
+    assert delivery.snapshot()["depth"] == 0
+
+
+def test_lost_propagation_is_still_delivered_after_its_gap_was_skipped():
+    delivered = []
+    delivery = CausalDelivery(delivered.append, timeout=60)
+    delivery.receive(2, 2, "second")
+    delivery.drain()
+    delivery.receive(2, 1, "first")
+    delivery.receive(2, 2, "second")
+    assert delivered == ["second", "first"]
+    assert delivery.snapshot()["duplicates"] == 1
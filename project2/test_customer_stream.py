@@ -0,0 +1,64 @@
+import queue
+import threading
+
+import distributed_banking_system_pb2
+import vector_clock
+from Customer import Customer
+
+
+class StreamingStub:
+    # Takes the requests on its own thread, as gRPC does, and answers each one with the branch's clock after it
+
+    def __init__(self, clock_mode):
+        self.clock_mode = clock_mode
+        self.clock = [0, 0]
+
+    def MsgStream(self, requests):
+        received = queue.Queue()
+
+        def consume():
+            for request in requests:
+                received.put(request)
+
+        threading.Thread(target=consume, daemon=True).start()
+        for _ in range(3):
+            received.get(timeout=5)
+            self.clock[0] += 1
+            result = distributed_banking_system_pb2.EventResult(id=1, interface="deposit")
+            if self.clock_mode == "vector":
+                result.vector_clock.extend(vector_clock.encode(self.clock))
+            yield distributed_banking_system_pb2.BankingOperationResponse(event_result=[result])
+
+
+class Channels:
+
+    def __init__(self, stub):
+        self.channel_stub = stub
+
+    def warm_up(self, branch_ids, timeout):
+        return []
+
+    def stub(self, branch_id):
+        return self.channel_stub
+
+
+def customer_requests():
+    return [{"customer-request-id": index, "interface": "deposit", "money": 10} for index in range(1, 4)]
+
+
+def test_stream_requests_carry_the_clock_of_every_earlier_response():
+    customer = Customer(1, customer_requests(), request_mode="stream", channels=Channels(StreamingStub("vector")),
+                        branch_count=2)
+    responses, customer_events = customer.executeEvents()
+    assert len(responses) == 3
+    # the first request goes before any response, every later one after the response to the request before it
+    assert "vector_clock" not in customer_events[0]
+    assert [event["vector_clock"] for event in customer_events[1:]] == [[1, 0], [2, 0]]
+
+
+def test_stream_requests_without_vector_clocks_do_not_wait_after_the_first_response():
+    customer = Customer(1, customer_requests(), request_mode="stream", channels=Channels(StreamingStub("lamport")))
+    responses, customer_events = customer.executeEvents()
+    assert len(responses) == 3
+    assert not customer.waits_for_response(2)
+    assert all("vector_clock" not in event for event in customer_events)
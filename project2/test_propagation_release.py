@@ -0,0 +1,88 @@
+import grpc
+import pytest
+
+import Branch
+import distributed_banking_system_pb2
+
+
+class Unavailable(grpc.RpcError):
+
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+
+class PeerStub:
+    # Hands the propagations to the peer's MsgDelivery, after failing the first `failures` calls
+
+    def __init__(self, peer, failures=0):
+        self.peer = peer
+        self.failures = failures
+        self.requests = []
+
+    def MsgDelivery(self, request):
+        self.requests.append(request)
+        if self.failures:
+            self.failures -= 1
+            raise Unavailable()
+        return self.peer.MsgDelivery(request, None)
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    delays = []
+    monkeypatch.setattr(Branch.time, "sleep", delays.append)
+    return delays
+
+
+@pytest.fixture
+def branches():
+    created = []
+
+    def create(id):
+        branch = Branch.Branch(id, 100, [1, 2])
+        created.append(branch)
+        return branch
+
+    yield create
+    for branch in created:
+        branch.channels.close()
+
+
+def deposit(branch, customer_request_id, money):
+    request = distributed_banking_system_pb2.BankingOperationRequest(
+        id=branch.id, type="customer", customer_requests=[distributed_banking_system_pb2.CustomerRequest(
+            customer_request_id=customer_request_id, interface="deposit", money=money)])
+    branch.MsgDelivery(request, None)
+
+
+def test_failed_propagation_is_released_by_the_next_one(branches, delays):
+    sender, peer = branches(1), branches(2)
+    stub = sender.stubList[0] = PeerStub(peer, failures=Branch.PROPAGATION_RETRIES + 1)
+    deposit(sender, 1, 10)
+    assert sender.balance == 100 and peer.balance == 100
+    # the retries back off instead of firing back to back
+    assert delays == [Branch.retry_delay(attempt) for attempt in range(Branch.PROPAGATION_RETRIES)]
+    assert delays[0] > 0 and delays[1] > delays[0]
+    assert sender.unreleased[2] == {1}
+
+    deposit(sender, 2, 5)
+    # the propagation carries the release of number 1, so the peer does not hold it back
+    assert [(event.interface, event.sequence) for event in stub.requests[-1].customer_requests] == [
+        ("propagate_deposit", 2), ("release", 1)]
+    assert sender.balance == 105 and peer.balance == 105
+    assert peer.delivery.snapshot()["depth"] == 0
+    assert sender.unreleased[2] == set()
+
+
+def test_restarted_sender_is_not_taken_for_a_duplicate(branches, delays):
+    peer = branches(2)
+    sender = branches(1)
+    sender.stubList[0] = PeerStub(peer)
+    deposit(sender, 1, 10)
+    restarted = branches(1)
+    restarted.stubList[0] = PeerStub(peer)
+    assert restarted.epoch != sender.epoch
+    # the restarted sender numbers its propagations from 1 again
+    deposit(restarted, 2, 10)
+    assert peer.balance == 120
+    assert peer.delivery.snapshot()["duplicates"] == 0
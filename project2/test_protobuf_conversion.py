@@ -0,0 +1,50 @@
+import pytest
+
+import distributed_banking_system_pb2
+from protobuf_conversion import field_kinds, protobuf_to_dict
+
+MESSAGE_TYPES = [getattr(distributed_banking_system_pb2, name)
+                 for name in distributed_banking_system_pb2.DESCRIPTOR.message_types_by_name]
+
+
+def list_fields_to_dict(message):
+    result = {}
+    for field, value in message.ListFields():
+        if field.type == field.TYPE_MESSAGE:
+            value = [list_fields_to_dict(item) for item in value] if field.label == field.LABEL_REPEATED \
+                else list_fields_to_dict(value)
+        elif field.label == field.LABEL_REPEATED:
+            value = list(value)
+        result[field.name] = value
+    return result
+
+
+def filled(message_type, depth=0):
+    # every field of the message set to a value that is not its default
+    message = message_type()
+    for field in message_type.DESCRIPTOR.fields:
+        if field.type == field.TYPE_MESSAGE:
+            if depth < 1:
+                item_type = getattr(distributed_banking_system_pb2, field.message_type.name)
+                getattr(message, field.name).append(filled(item_type, depth + 1))
+        elif field.label == field.LABEL_REPEATED:
+            getattr(message, field.name).extend([1, 2])
+        elif field.type == field.TYPE_STRING:
+            setattr(message, field.name, "deposit")
+        else:
+            setattr(message, field.name, 3)
+    return message
+
+
+@pytest.mark.parametrize("message_type", MESSAGE_TYPES, ids=lambda message_type: message_type.__name__)
+def test_converter_covers_every_field_of_the_schema(message_type):
+    assert [name for name, _ in field_kinds(message_type)] == [
+        field.name for field in sorted(message_type.DESCRIPTOR.fields, key=lambda field: field.number)]
+    message = filled(message_type)
+    assert list(protobuf_to_dict(message)) == [field.name for field in message_type.DESCRIPTOR.fields]
+    assert protobuf_to_dict(message) == list_fields_to_dict(message)
+
+
+@pytest.mark.parametrize("message_type", MESSAGE_TYPES, ids=lambda message_type: message_type.__name__)
+def test_unset_fields_are_left_out(message_type):
+    assert protobuf_to_dict(message_type()) == {}
@@ -0,0 +1,34 @@
+import vector_clock
+
+
+def test_decode_pads_a_short_delta_to_the_branch_count():
+    # the sender's clock is zero past index 1, so its pairs stop there
+    pairs = vector_clock.encode([0, 3, 0, 0])
+    assert pairs == [1, 3]
+    assert vector_clock.decode(pairs, 4) == [0, 3, 0, 0]
+
+
+def test_decode_of_a_sparse_delta_fills_the_missing_entries():
+    known = [2, 1, 4, 0, 0]
+    pairs = vector_clock.encode([2, 5, 4, 1, 0], known)
+    assert pairs == [1, 5, 3, 1]
+    assert vector_clock.decode(pairs, 5) == [0, 5, 0, 1, 0]
+
+
+def test_decode_of_an_empty_delta_is_the_zero_clock():
+    assert vector_clock.decode([], 3) == [0, 0, 0]
+
+
+def test_decoded_clocks_merge_and_compare_entry_by_entry():
+    local = [1, 0, 2]
+    vector_clock.merge_pairs(local, vector_clock.encode([0, 4]))
+    assert local == [1, 4, 2]
+    received = vector_clock.decode(vector_clock.encode([1, 4]), 3)
+    assert vector_clock.compare(received, local) == -1
+    assert vector_clock.compare(vector_clock.decode([2, 1], 3), [1, 0, 0]) is None
+
+
+def test_pad_keeps_a_longer_clock():
+    entries = [1, 2, 3]
+    assert vector_clock.pad(entries, 2) is entries
+    assert entries == [1, 2, 3]
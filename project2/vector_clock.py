@@ -0,0 +1,50 @@
+from itertools import zip_longest
+
+# A vector clock is a list of ints with one entry per branch, in the order of the branch list. On the wire
+# it is a packed repeated int64 of (index, value) pairs that leaves out the entries the receiver is known
+# to have, so a clock costs the entries that changed instead of one entry per branch. The pairs leave out the
+# trailing zero entries too, a receiver pads a decoded clock back to the number of branches.
+
+
+def encode(entries, known=None):
+    # (index, value) pairs of the entries above `known`, of every non-zero entry without it
+    pairs = []
+    for index, value in enumerate(entries):
+        if value > (known[index] if known is not None and index < len(known) else 0):
+            pairs += (index, value)
+    return pairs
+
+
+def decode(pairs, size=0):
+    # The clock of `size` branches at least, or as long as its highest index needs without it
+    entries = [0] * size
+    merge_pairs(entries, pairs)
+    return entries
+
+
+def pad(entries, size):
+    # Extend `entries` with zeros to `size` entries, in place
+    if len(entries) < size:
+        entries.extend([0] * (size - len(entries)))
+    return entries
+
+
+def merge_pairs(entries, pairs):
+    # Element-wise maximum of `entries` and the encoded clock, in place
+    for index, value in zip(pairs[0::2], pairs[1::2]):
+        pad(entries, index + 1)
+        if value > entries[index]:
+            entries[index] = value
+
+
+def compare(a, b):
+    # -1 if a happened before b, 1 if b happened before a, 0 if they are equal, None if they are concurrent
+    less = greater = False
+    for x, y in zip_longest(a, b, fillvalue=0):
+        if x < y:
+            less = True
+        elif x > y:
+            greater = True
+    if less and greater:
+        return None
+    return -1 if less else 1 if greater else 0
@@ -0,0 +1,119 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent import futures
+
+import grpc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Branch
+from channel_manager import SERVER_OPTIONS
+from write_versions import encode_token
+import distributed_banking_system_pb2
+import distributed_banking_system_pb2_grpc
+
+# Throughput of the global Branch lock against write-version and session-token ordering. Every customer
+# alternates deposits and queries on its branch and carries its session token like Customer does; at the
+# end all branches must report the same balance.
+#
+#   python3 ./Benchmark/benchmark_ordering.py --branches 5 --customers 20 --requests 50
+#
+# With the lock, customers on different branches can deadlock each other (both branches hold their lock
+# while replicating to the other one), so the lock only runs with every customer on the first branch.
+SCENARIOS = [("lock", False), ("versions", False), ("versions", True), ("session", False), ("session", True)]
+
+
+def run_branch(port, id, branch_id_list, ordering):
+    sys.stdout = open(os.devnull, "w")
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), options=SERVER_OPTIONS)
+    branch = Branch.Branch(id, 0, branch_id_list, ordering=ordering)
+    distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(branch, server)
+    server.add_insecure_port("[::]:" + port)
+    server.start()
+    branch.channels.warm_up(branch.branch_id_list)
+    server.wait_for_termination()
+
+
+def start_branches(branch_id_list, ordering):
+    processes = []
+    for id in branch_id_list:
+        process = multiprocessing.Process(target=run_branch, args=(str(50050 + id), id, branch_id_list, ordering))
+        process.start()
+        processes.append(process)
+
+    for id in branch_id_list:
+        channel = grpc.insecure_channel(f"localhost:{50050 + id}")
+        grpc.channel_ready_future(channel).result(timeout=10)
+        channel.close()
+    return processes
+
+
+def run_customer(customer_id, branch_id, requests):
+    channel = grpc.insecure_channel(f"localhost:{50050 + branch_id}")
+    stub = distributed_banking_system_pb2_grpc.BankingServiceStub(channel)
+    session = dict()
+    for i in range(requests):
+        interface = "deposit" if i % 2 == 0 else "query"
+        event = distributed_banking_system_pb2.Event(id=customer_id * requests + i, interface=interface, money=1,
+                                                     session=encode_token(session) if interface == "query" else [])
+        response = stub.MsgDelivery(distributed_banking_system_pb2.BankingOperationRequest(
+            id=customer_id, type="customer", events=[event]))
+        if response.recv[0].version:
+            session[response.recv[0].branch] = response.recv[0].version
+    channel.close()
+
+
+def query_balances(branch_id_list):
+    balances = []
+    for id in branch_id_list:
+        with grpc.insecure_channel(f"localhost:{50050 + id}") as channel:
+            stub = distributed_banking_system_pb2_grpc.BankingServiceStub(channel)
+            response = stub.MsgDelivery(distributed_banking_system_pb2.BankingOperationRequest(
+                id=0, type="customer", events=[distributed_banking_system_pb2.Event(interface="query")]))
+            balances.append(response.recv[0].balance)
+    return balances
+
+
+def benchmark(ordering, spread, branches, customers, requests):
+    branch_id_list = list(range(1, branches + 1))
+    processes = start_branches(branch_id_list, ordering)
+    try:
+        start = time.perf_counter()
+        with futures.ThreadPoolExecutor(max_workers=customers) as executor:
+            calls = [executor.submit(run_customer, customer_id,
+                                     branch_id_list[customer_id % branches] if spread else branch_id_list[0],
+                                     requests)
+                     for customer_id in range(customers)]
+            for call in calls:
+                call.result()
+        elapsed = time.perf_counter() - start
+        balances = query_balances(branch_id_list)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    expected = customers * ((requests + 1) // 2)
+    return {"ordering": ordering,
+            "customers_on": "all branches" if spread else "branch 1",
+            "requests": customers * requests,
+            "seconds": elapsed,
+            "requests_per_second": customers * requests / elapsed,
+            "consistent": all(balance == expected for balance in balances)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Global lock vs write-version vs session-token ordering in Branch")
+    parser.add_argument("--branches", type=int, default=5)
+    parser.add_argument("--customers", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    for ordering, spread in SCENARIOS:
+        result = benchmark(ordering, spread, args.branches, args.customers, args.requests)
+        print(f"{result['ordering']:>8} ({result['customers_on']}): {result['requests']} requests in "
+              f"{result['seconds']:.2f}s, {result['requests_per_second']:.0f} req/s, "
+              f"balances consistent: {result['consistent']}")
@@ -0,0 +1,101 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent import futures
+
+import grpc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Branch
+import distributed_banking_system_pb2
+import distributed_banking_system_pb2_grpc
+
+# Compares the thread-pool Branch server with the grpc.aio one: every customer keeps one deposit
+# in flight at a time and each deposit is propagated to all the other branches before it is answered.
+#
+#   python3 ./Benchmark/benchmark_server.py --branches 5 --customers 32 --requests 50
+#   python3 ./Benchmark/benchmark_server.py --latency-stats    # with the branches' latency interceptors
+
+
+def run_branch(port, id, balance, branch_id_list, server_mode, latency_stats):
+    # the branches print every propagation, keep that out of the measurement
+    sys.stdout = open(os.devnull, "w")
+    Branch.LATENCY_STATS = latency_stats
+    Branch.serve(port, id, balance, branch_id_list, None, server_mode)
+
+
+def start_branches(branch_id_list, server_mode, latency_stats):
+    processes = []
+    for id in branch_id_list:
+        process = multiprocessing.Process(target=run_branch,
+                                          args=(str(50050 + id), id, 0, branch_id_list, server_mode, latency_stats))
+        process.start()
+        processes.append(process)
+
+    for id in branch_id_list:
+        channel = grpc.insecure_channel(f"localhost:{50050 + id}")
+        grpc.channel_ready_future(channel).result(timeout=10)
+        channel.close()
+    return processes
+
+
+def run_customer(customer_id, branch_id, requests):
+    channel = grpc.insecure_channel(f"localhost:{50050 + branch_id}")
+    stub = distributed_banking_system_pb2_grpc.BankingServiceStub(channel)
+    latencies = []
+    for i in range(requests):
+        event = distributed_banking_system_pb2.Event(id=customer_id * requests + i, interface="deposit", money=1)
+        start = time.perf_counter()
+        stub.MsgDelivery(distributed_banking_system_pb2.BankingOperationRequest(id=customer_id, type="customer",
+                                                                                events=[event]))
+        latencies.append(time.perf_counter() - start)
+    channel.close()
+    return latencies
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def benchmark(server_mode, branches, customers, requests, latency_stats):
+    branch_id_list = list(range(1, branches + 1))
+    processes = start_branches(branch_id_list, server_mode, latency_stats)
+    try:
+        start = time.perf_counter()
+        with futures.ThreadPoolExecutor(max_workers=customers) as executor:
+            # every branch holds its lock while replicating, so customers on different branches
+            # could deadlock each other: send all of them to the first branch
+            calls = [executor.submit(run_customer, customer_id, branch_id_list[0], requests)
+                     for customer_id in range(customers)]
+            latencies = sorted(latency for call in calls for latency in call.result())
+        elapsed = time.perf_counter() - start
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    return {"server": server_mode,
+            "requests": len(latencies),
+            "seconds": elapsed,
+            "requests_per_second": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Thread-pool vs grpc.aio Branch server")
+    parser.add_argument("--branches", type=int, default=5)
+    parser.add_argument("--customers", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--latency-stats", action="store_true",
+                        help="record per-RPC latency histograms in the branches, to measure what they cost")
+    args = parser.parse_args()
+
+    for server_mode in ("thread", "aio"):
+        result = benchmark(server_mode, args.branches, args.customers, args.requests, args.latency_stats)
+        print(f"{result['server']:>6}: {result['requests']} deposits in {result['seconds']:.2f}s, "
+              f"{result['requests_per_second']:.0f} req/s, "
+              f"p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms")
@@ -1,166 +1,895 @@
+import asyncio
+import contextlib
+import functools
 import json
 import multiprocessing
+import os
+import signal
 import sys
-import time
+import threading
 from concurrent import futures
 import logging
-import datetime
 
 import grpc
 import distributed_banking_system_pb2
 import distributed_banking_system_pb2_grpc
-
-_ONE_DAY = datetime.timedelta(days=1)
+from account_table import AccountTable, DEFAULT_ACCOUNT
+from channel_manager import ChannelManager, SERVER_OPTIONS
+from protobuf_conversion import protobuf_to_dict
+from quorum_replicator import QuorumReplicator, WRITE_QUORUM
+from read_lease import ReadLease, AsyncReadLease, READ_LEASE, SYNC_TIMEOUT
+from request_cache import RequestCache, AsyncRequestCache, DEDUP_CAPACITY, DEDUP_TTL
+from latency_stats import (LatencyStats, ServerLatencyInterceptor, AsyncServerLatencyInterceptor,
+                           ClientLatencyInterceptor, AsyncClientLatencyInterceptor)
+from write_ahead_log import WriteAheadLog
+from write_versions import WriteVersions, encode_token, decode_token
+from gossip import OperationLog, GOSSIP_INTERVAL, GOSSIP_TIMEOUT
+
+# how propagation is sent to the peers: "sequential" calls one peer after another,
+# "parallel" sends to all peers at once and gathers the acks, "quorum" sends to all peers at once and
+# commits once WRITE_QUORUM branches have the write, the other peers get it in the background, "chain"
+# passes the write from the head of the branch list to its tail, each branch to the next one, and serves
+# the queries at the tail
+REPLICATION_MODE = "sequential"
+# "thread" serves MsgDelivery from a thread pool, "aio" serves it from an asyncio event loop
+SERVER_MODE = "thread"
+# "session" answers a query once the writes in the customer's session token are applied here and waits on
+# nothing else, "versions" lets requests run concurrently and orders writes with per-branch write versions
+# that queries wait on, "lock" serializes every MsgDelivery behind one lock that is held across replication
+ORDERING = "session"
+# seconds a query waits for the writes of its session token, a branch that lost them (say, in a restart)
+# answers with what it has after that
+SESSION_TIMEOUT = 5.0
+# directory for each branch's write-ahead log and snapshots, None keeps the balance in memory only
+STATE_DIRECTORY = None
+# record per-RPC latency histograms, printed on SIGUSR1 and when the branch stops; the interceptors add
+# to every call, so only the benchmarks turn it on
+LATENCY_STATS = False
 
 
 class Branch(distributed_banking_system_pb2_grpc.BankingServiceServicer):
 
-    def __init__(self, id, balance, branches):
+    def __init__(self, id, balance, branches, replication_mode=REPLICATION_MODE, ordering=ORDERING, wal=None, stats=None,
+                 write_quorum=WRITE_QUORUM, read_lease=READ_LEASE, gossip_interval=GOSSIP_INTERVAL,
+                 dedup_capacity=DEDUP_CAPACITY, dedup_ttl=DEDUP_TTL):
         # unique ID of the Branch
         self.id = id
-        # replica of the Branch's balance
-        self.balance = balance
+        # replica of the balances of the Branch's accounts, `balance` is the default account; each account
+        # is guarded by the lock of its shard, so writes to accounts of different shards run in parallel
+        self.accounts = AccountTable(balance)
         # the list of process IDs of the branches
         self.branches = branches
         # the list of Client stubs to communicate with the branches
         self.stubList = list()
+        # latency histograms of the served and the sent calls, None when they are not recorded
+        self.stats = stats
+        # the channels behind the stubs, shared per peer and kept connected
+        self.channels = self.create_channel_manager()
         # a list of received messages used for debugging purpose
         self.recvMsg = list()
         # iterate the processID of the branches
         self.branch_id_list = list()
+        # "sequential", "parallel" or "quorum" propagation to the peers
+        self.replication_mode = replication_mode
+        # acknowledgements and stragglers of the quorum writes, None unless replication_mode is "quorum"
+        self.quorum = QuorumReplicator(len(branches), write_quorum) if replication_mode == "quorum" else None
+        # how long queries are answered from the local balances before the branch syncs with its peers
+        self.lease = self.create_read_lease(read_lease)
+        # responses of the balance changing requests, for the copies a sender resends; None when not cached
+        self.requests = self.create_request_cache(dedup_capacity, dedup_ttl) if dedup_capacity else None
         self.initialize_stubs()
-        self.lock = multiprocessing.Lock()
+        # "session", "versions" or "lock" ordering of the requests
+        self.ordering = ordering
+        self.lock = threading.Lock() if ordering == "lock" else contextlib.nullcontext()
+        # write versions applied at this branch per origin branch
+        self.versions = WriteVersions(branches)
+        # releases of failed writes' versions that are still on their way to the peers
+        self.releases = set()
+        # seconds between the gossip rounds and the operations the peers catch up from; None when gossip is
+        # off or the balances are recovered from the write-ahead log, which does not record their versions
+        self.gossip_interval = gossip_interval
+        self.operations = None
+        if gossip_interval is not None and wal is None:
+            self.operations = OperationLog(branches, [branch_id for branch_id in branches if branch_id != id])
+        self.gossip_stopped = threading.Event()
+        # write-ahead log of the balance changes, None when the balance is not persisted
+        self.wal = wal
+        self.restore_accounts()
+
+    @property
+    def balance(self):
+        # the only account unless the events name one
+        return self.accounts.balance()
+
+    def restore_accounts(self):
+        # the default account is recovered into `balance` already, the others come from the log
+        if self.wal is not None:
+            for account, balance in self.wal.balances.items():
+                if account != DEFAULT_ACCOUNT:
+                    self.accounts.add(account, balance)
 
     def initialize_stubs(self):
-        # Initialize gRPC stubs for communication with other branches
+        # Initialize gRPC stubs for communication with other branches, in a chain only with its neighbours
+        links = self.chain_links() if self.replication_mode == "chain" else self.branches
         for branch_id in self.branches:
-            if branch_id != self.id:
-                port = str(50050 + int(branch_id))
-                address = f"localhost:{port}"
-                channel = grpc.insecure_channel(address)
-                stub = distributed_banking_system_pb2_grpc.BankingServiceStub(channel)
+            if branch_id != self.id and branch_id in links:
+                stub = self.channels.stub(branch_id)
                 self.stubList.append(stub)
+                self.branch_id_list.append(branch_id)
+
+    def chain_links(self):
+        # A write enters the chain at the head and every branch passes it on to the next one; the origin of
+        # the write applies it last, so the branch after it is skipped to. Queries go to the tail
+        position = self.branches.index(self.id)
+        return set(self.branches[:2] + self.branches[position + 1:position + 3] + self.branches[-1:])
+
+    def next_in_chain(self, position, origin):
+        # the branch after `position` in the chain that is not the origin of the write, None after the tail
+        for branch_id in self.branches[position + 1:position + 3]:
+            if branch_id != origin:
+                return branch_id
+        return None
+
+    def stub_for(self, branch_id):
+        return self.stubList[self.branch_id_list.index(branch_id)]
+
+    def create_channel_manager(self):
+        return ChannelManager(interceptors=self.client_interceptors)
+
+    def client_interceptors(self, branch_id):
+        if self.stats is None:
+            return []
+        return [ClientLatencyInterceptor(self.stats, branch_id)]
+
+    def create_read_lease(self, duration):
+        return ReadLease(self.sync_with_peers, duration)
+
+    def create_request_cache(self, capacity, ttl):
+        return RequestCache(self.request_key, capacity, ttl)
+
+    def request_key(self, request):
+        # Customer requests, propagations and releases by (type, sender, customer, event ids and interfaces); the
+        # event ids are unique per customer only, and a branch forwards the events of all of its customers. Syncs,
+        # gossip, requests without ids and queries alone are not cached, a query reads the current balance
+        if request.type not in ("customer", "branch", "chain") or not any(
+                event.id and event.interface != "query" for event in request.events):
+            return None
+        return request.type, request.id, tuple((event.customer, event.id, event.interface) for event in request.events)
+
+    def stamp_customer(self, request):
+        # the propagations of a customer's events carry the customer, for the request keys of the peers
+        for event in request.events:
+            event.customer = request.id
 
     def MsgDelivery(self, request, context):
+        # a request that is sent again, after a timeout or by a retry policy, gets the response of the first
+        if self.requests is None:
+            return self.deliver(request)
+        return self.requests.handle(request, functools.partial(self.deliver, request))
+
+    def deliver(self, request):
         type = request.type
         response = []
-        with self.lock:
-            match type:
-                case "customer":
-                    response = self.process_customer_events(request)
-                case "branch":
-                    response = self.process_branch_events(request)
-
+        if type == "sync":
+            # never behind the lock, the peer that syncs may hold its own lock while this branch waits for it
+            response = [self.flush_to(request.id)]
+            return distributed_banking_system_pb2.BankingOperationResponse(id=self.id, recv=response)
+        if type == "gossip":
+            with self.lock:
+                events, digest = self.process_gossip(request)
+            return distributed_banking_system_pb2.BankingOperationResponse(id=self.id, events=events, digest=digest)
+        if type == "chain":
+            # takes the lock itself, it is not held while the rest of the chain is waited for
+            response = self.process_chain_events(request)
+        else:
+            with self.lock:
+                match type:
+                    case "customer":
+                        response = self.process_customer_events(request)
+                    case "branch":
+                        response = self.process_branch_events(request)
+
+        self.wait_durable()
         return distributed_banking_system_pb2.BankingOperationResponse(id=self.id, recv=response)
 
+    def log_change(self, interface, event_id, money, account=DEFAULT_ACCOUNT):
+        # Write a balance change ahead to the log, it is on disk once wait_durable() returns
+        if self.wal is not None:
+            self.wal.append(interface, event_id, money, account)
+
+    def wait_durable(self):
+        # Block until every logged change is fsynced, concurrent requests share one group fsync
+        if self.wal is not None:
+            self.wal.wait_durable(self.wal.appended)
+
     def process_customer_events(self, request):
+        self.stamp_customer(request)
+        self.hold_read_lease(request)
         response = list()
         replica_branch_responses = list()
         for event in request.events:
             match event.interface:
                 case "query":
                     response.append(self.query(event))
-                case "deposit":
-                    deposit_response, propagate_deposit_response = self.deposit(event)
-                    response.append(deposit_response)
-                    replica_branch_responses.extend(propagate_deposit_response)
-                case "withdraw":
-                    withdraw_response, propagate_withdraw_response = self.withdraw(event)
-                    response.append(withdraw_response)
-                    replica_branch_responses.extend(propagate_withdraw_response)
+                case "deposit" | "withdraw":
+                    write_response, propagate_write_response = self.write(event)
+                    response.append(write_response)
+                    replica_branch_responses.extend(propagate_write_response)
 
+        self.record_replica_responses(replica_branch_responses)
+        return response
+
+    def record_replica_responses(self, replica_branch_responses):
         replica_branch_dict_responses = []
         for replica_branch_response in replica_branch_responses:
             replica_branch_dict_responses.append(protobuf_to_dict(replica_branch_response))
 
         self.recvMsg.extend(replica_branch_dict_responses)
         print(replica_branch_dict_responses)
-        return response
 
-    def query(self, request):
-        return {'interface': 'query', 'result': None, 'balance': self.balance, 'branch': self.id}
+    def hold_read_lease(self, request):
+        # queries are answered from the local balances, the lease bounds how stale they may be
+        if has_queries(request) and not self.lease.hold():
+            print(f"Branch {self.id} answers a query without having synced with its peers")
+
+    def sync_with_peers(self):
+        # Without quorum writes a write commits only once every peer has it, so the balances are up to date
+        if self.quorum is None:
+            return True
+        request = self.sync_request()
+        calls = [stub.MsgDelivery.future(request, timeout=SYNC_TIMEOUT) for stub in self.stubList]
+        return self.synced(outcome(call) for call in calls)
+
+    def sync_request(self):
+        return distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="sync")
+
+    def synced(self, results):
+        # Whether every peer has the writes that committed there, from its response or the RpcError it failed with
+        for result in results:
+            if isinstance(result, grpc.RpcError):
+                print(f"Failed to sync with the peers: {result.code()}")
+                return False
+            if isinstance(result, BaseException):
+                raise result
+            if result.recv[0].result != "success":
+                return False
+        return True
+
+    def flush_to(self, branch_id):
+        # The peer renews its read lease: wait until it has every write that committed here
+        flushed = self.quorum is None or self.quorum.flush(branch_id, SYNC_TIMEOUT)
+        return self.sync_response(flushed)
+
+    def sync_response(self, flushed):
+        return {'interface': 'sync', 'result': 'success' if flushed else 'failed', 'branch': self.id}
 
-    def deposit(self, event):
+    def query(self, request):
+        # In a chain the tail has every write that went through, so it answers the queries
+        tail = self.read_from()
+        if tail is not None:
+            try:
+                return protobuf_to_dict(self.stub_for(tail).MsgDelivery(self.tail_request(request)).recv[0])
+            except grpc.RpcError as e:
+                print(f"Failed to reach the tail of the chain, branch {tail}: {e.code()}")
+        written, timeout = self.read_barrier(request)
+        if not self.versions.wait_until(written, timeout):
+            print(f"Branch {self.id} answered a query before the writes of its session {decode_token(request.session)}")
+        return self.balance_response(request)
+
+    def read_from(self):
+        # the branch that answers this branch's queries, None when it answers them itself
+        tail = self.branches[-1]
+        return tail if self.replication_mode == "chain" and tail != self.id else None
+
+    def tail_request(self, event):
+        return distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="customer", events=[event])
+
+    def read_barrier(self, request):
+        # Read-your-writes, as (predicate on the applied versions, timeout): with "session" ordering the query
+        # waits for the writes of the customer's session only, otherwise for this branch's own writes that
+        # were admitted before it
+        if self.ordering == "session":
+            token = decode_token(request.session)
+            return (lambda: self.versions.covers(token)), SESSION_TIMEOUT
+        required = self.versions.issued
+        return (lambda: self.versions.applied.get(self.id, 0) >= required), None
+
+    def balance_response(self, request):
+        return {'interface': 'query', 'result': None, 'balance': self.accounts.balance(request.account),
+                'branch': self.id}
+
+    def write(self, event):
+        # Replicate a deposit, or a withdrawal the balance covers, to the peers; a write that did not go
+        # through releases its version
+        if not self.begin_write(event):
+            return self.write_response(event.interface, "failed", event), []
         result = "failed"
         replica_branch_responses = []
         try:
-            replica_branch_responses = self.replicate_deposit(event)
-            self.balance += event.money
+            replica_branch_responses = self.replicate(event)
             result = "success"
         except:
             result = "failed"
             replica_branch_responses = []
-        response = {'interface': 'deposit', 'result': result, 'branch': self.id}
-        return response, replica_branch_responses
+        finally:
+            self.finish_write(event, result == "success")
+        return self.write_response(event.interface, result, event), replica_branch_responses
+
+    def begin_write(self, event):
+        # A withdrawal holds its money while it replicates, so concurrent withdrawals cannot overdraw; one the
+        # balance does not cover is refused. The write gets the next version of this branch
+        if event.interface == "withdraw" and not self.accounts.reserve(event.account, event.money):
+            return False
+        event.version = self.versions.issue()
+        return True
+
+    def finish_write(self, event, replicated):
+        if event.interface == "withdraw":
+            self.accounts.settle(event.account, event.money, replicated)
+        elif replicated:
+            self.accounts.add(event.account, event.money)
+        if replicated:
+            self.log_change(event.interface, event.id, event.money, event.account)
+            self.record_operation(self.id, event)
+        else:
+            self.release_version(event)
+        self.versions.mark_applied(self.id, event.version)
+
+    def write_response(self, interface, result, event):
+        # a write that went through tells the customer its version, for the customer's session token
+        response = {'interface': interface, 'result': result, 'branch': self.id}
+        if result == "success":
+            response['version'] = event.version
+        return response
 
-    def withdraw(self, event):
-        result = "failed"
-        replica_branch_responses = []
-        try:
-            if self.balance >= event.money:
-                replica_branch_responses = self.replicate_withdraw(event)
-                self.balance -= event.money
-                result = "success"
-        except:
-            result = "failed"
-            replica_branch_responses = []
-        response = {'interface': 'withdraw', 'result': result, 'branch': self.id}
-        return response, replica_branch_responses
+    def release_request(self, event):
+        # The peers never get the version of a failed write, and every later version of this branch would
+        # wait behind the gap at them; the release closes it. Peers that cannot be reached miss it
+        release = distributed_banking_system_pb2.Event(id=event.id, interface="release", version=event.version,
+                                                       customer=event.customer)
+        return distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="branch", events=[release])
+
+    def release_version(self, event):
+        request, stubs = self.start_release(event)
+        for stub in stubs:
+            call = stub.MsgDelivery.future(request)
+            self.releases.add(call)
+            call.add_done_callback(self.release_done)
+
+    def start_release(self, event):
+        # the release of a failed write and the stubs it goes to, a chain passes it on like a write
+        request = self.release_request(event)
+        self.record_operation(self.id, request.events[0])
+        if self.replication_mode != "chain":
+            return request, self.stubList
+        first = self.start_chain(request)
+        return request, [] if first is None else [self.stub_for(first)]
+
+    def release_done(self, call):
+        self.releases.discard(call)
+        if not call.cancelled() and call.exception() is not None:
+            print(f"Failed to release a version: {call.exception().code()}")
 
     def process_branch_events(self, request):
         response = list()
         for event in request.events:
             match event.interface:
                 case "withdraw":
-                    response.append(self.propagate_withdraw(event))
+                    response.append(self.propagate_withdraw(event, request.id))
                 case "deposit":
-                    response.append(self.propagate_deposit(event))
+                    response.append(self.propagate_deposit(event, request.id))
+                case "release":
+                    response.append(self.apply_release(event, request.id))
+        return response
+
+    def process_chain_events(self, request):
+        # The write of branch `request.id` on its way down the chain: apply it here and pass it on, the call
+        # returns once the tail has it
+        with self.lock:
+            response = self.process_branch_events(request)
+        successor = self.chain_successor(request)
+        if successor is not None:
+            self.stub_for(successor).MsgDelivery(request)
         return response
 
-    def propagate_deposit(self, event):
-        self.balance += event.money
+    def chain_successor(self, request):
+        return self.next_in_chain(self.branches.index(self.id), request.id)
+
+    def propagate_deposit(self, event, origin):
+        if self.claim(origin, event.version):
+            self.accounts.add(event.account, event.money)
+            self.log_change("propagate_deposit", event.id, event.money, event.account)
+            self.record_operation(origin, event)
+            self.versions.mark_applied(origin, event.version)
         return {'interface': 'propagate_deposit', 'result': 'success', 'branch': self.id}
 
-    def propagate_withdraw(self, request):
-        self.balance -= request.money
+    def propagate_withdraw(self, request, origin):
+        if self.claim(origin, request.version):
+            self.accounts.add(request.account, -request.money)
+            self.log_change("propagate_withdraw", request.id, request.money, request.account)
+            self.record_operation(origin, request)
+            self.versions.mark_applied(origin, request.version)
         return {'interface': 'propagate_withdraw', 'result': 'success', 'branch': self.id}
 
-    def replicate_deposit(self, event):
+    def apply_release(self, event, origin):
+        if self.claim(origin, event.version):
+            self.record_operation(origin, event)
+            self.versions.mark_applied(origin, event.version)
+        return {'interface': 'release', 'result': 'success', 'branch': self.id}
+
+    def claim(self, origin, version):
+        # With gossip a write may reach a branch more than once, from its origin and from the peers. Without
+        # it every write arrives once, and a branch that restarted from its log numbers its writes from 1 again
+        return self.operations is None or self.versions.claim(origin, version)
+
+    def record_operation(self, origin, event):
+        if self.operations is not None:
+            self.operations.record(origin, event)
+
+    def start_gossip(self):
+        if self.operations is not None:
+            threading.Thread(target=self.gossip_loop, daemon=True).start()
+
+    def stop_gossip(self):
+        self.gossip_stopped.set()
+
+    def gossip_loop(self):
+        # a round that fails for another reason than an RPC error is reported and the next one runs anyway
+        while not self.gossip_stopped.wait(self.gossip_interval):
+            for branch_id in self.operations.pick_peers():
+                try:
+                    self.gossip_with(branch_id)
+                except Exception as e:
+                    print(f"Gossip with branch {branch_id} failed: {e!r}")
+
+    def gossip_with(self, branch_id):
+        # Pull the operations the peer has above this branch's digest, then push the ones the peer is missing.
+        # Any two branches gossip, in a chain too; an unreachable peer is not waited for
+        stub = self.channels.stub(branch_id)
+        try:
+            missing = self.catch_up(stub.MsgDelivery(self.gossip_request(), timeout=GOSSIP_TIMEOUT,
+                                                     wait_for_ready=False))
+            if missing:
+                self.catch_up(stub.MsgDelivery(self.gossip_request(missing), timeout=GOSSIP_TIMEOUT,
+                                               wait_for_ready=False))
+        except grpc.RpcError as e:
+            self.operations.exchange_failed()
+            print(f"Failed to gossip with branch {branch_id}: {e.code()}")
+
+    def gossip_request(self, events=()):
+        return distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="gossip", events=events,
+                                                                      digest=encode_token(self.versions.digest()))
+
+    def catch_up(self, response):
+        with self.lock:
+            self.apply_operations(response.events)
+        return self.observe_peer(response)
+
+    def observe_peer(self, response):
+        # returns the operations the peer that answered is missing
+        peer_digest = decode_token(response.digest)
+        self.operations.observe(response.id, peer_digest)
+        return self.operations.missing(peer_digest)
+
+    def process_gossip(self, request):
+        # A peer's gossip: apply what it pushed, answer with what it is missing and this branch's digest
+        if self.operations is None:
+            return [], encode_token(self.versions.digest())
+        self.apply_operations(request.events)
+        return self.observe_peer(request), encode_token(self.versions.digest())
+
+    def apply_operations(self, events):
+        # The operations of other origins the peers caught this branch up with; its own writes count in its
+        # digest only once they are applied here, a peer may send back one that is still replicating
+        self.operations.caught_up(len(events))
+        for event in events:
+            if event.origin == self.id:
+                continue
+            match event.interface:
+                case "deposit":
+                    self.propagate_deposit(event, event.origin)
+                case "withdraw":
+                    self.propagate_withdraw(event, event.origin)
+                case "release":
+                    self.apply_release(event, event.origin)
+
+    def replicate(self, event):
+        return self.check_replicas(event, self.send_to_peers(event))
+
+    def check_replicas(self, event, responses):
+        # the responses of the peers that have the event, those that refused it are reported
         replica_branch_responses = []
-        for stub in self.stubList:
-            response = stub.MsgDelivery(
-                distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="branch", events=[event]))
+        for branch_id, response in responses:
             if response.recv[0].result != "success":
-                print(f"Failed to replicate deposit to branch {self.stubList.index(stub) + 1}")
+                print(f"Failed to replicate {event.interface} {event.id} to branch {branch_id}")
             replica_branch_responses.append(response)
         return replica_branch_responses
 
-    def replicate_withdraw(self, event):
+    def send_to_peers(self, event):
+        # Propagate the event to every peer and return (branch_id, response) pairs in peer order
+        return self.peer_sender()(self.propagation_request(event))
+
+    def propagation_request(self, event):
+        return distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="branch", events=[event])
+
+    def peer_sender(self):
+        match self.replication_mode:
+            case "parallel":
+                return self.fan_out
+            case "quorum":
+                return self.send_to_quorum
+            case "chain":
+                return self.send_down_chain
+        return self.send_in_turn
+
+    def send_in_turn(self, request):
+        return [(branch_id, stub.MsgDelivery(request)) for branch_id, stub in self.peer_stubs()]
+
+    def peer_stubs(self):
+        return zip(self.branch_id_list, self.stubList)
+
+    def send_to_quorum(self, request):
+        return self.quorum.replicate(describe_write(request.events), self.quorum_peers(request))
+
+    def quorum_peers(self, request):
+        return [(branch_id, functools.partial(stub.MsgDelivery, request)) for branch_id, stub in self.peer_stubs()]
+
+    def send_down_chain(self, request):
+        # The first branch of the chain answers once the tail has the event, this branch applies it after
+        first = self.start_chain(request)
+        if first is None:
+            return []
+        return [(first, self.stub_for(first).MsgDelivery(request))]
+
+    def start_chain(self, request):
+        # the first branch of the chain the request goes to, None when this branch is the whole chain
+        first = self.next_in_chain(-1, self.id)
+        if first is not None:
+            request.type = "chain"
+        return first
+
+    def fan_out(self, request):
+        # Send the request to all peers at once, so latency tracks the slowest peer instead of the sum
+        calls = [(branch_id, stub.MsgDelivery.future(request)) for branch_id, stub in self.peer_stubs()]
+        return self.gathered((branch_id, outcome(call)) for branch_id, call in calls)
+
+    def gathered(self, results):
+        # (branch_id, response) of every peer from its response or the RpcError it failed with; once every peer
+        # has answered, the first error fails the operation like the sequential path does
+        responses = []
+        error = None
+        for branch_id, result in results:
+            if isinstance(result, grpc.RpcError):
+                print(f"Failed to reach branch {branch_id}: {result.code()}")
+                error = error or result
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                responses.append((branch_id, result))
+        if error is not None:
+            raise error
+        return responses
+
+
+class AsyncBranch(Branch):
+    # Branch served by grpc.aio: peer propagation is awaited on the event loop instead of holding a thread.
+    # Only the methods that call the peers, lock or wait are overridden, everything they decide on comes
+    # from Branch
+
+    def __init__(self, id, balance, branches, replication_mode=REPLICATION_MODE, ordering=ORDERING, wal=None, stats=None,
+                 write_quorum=WRITE_QUORUM, read_lease=READ_LEASE, gossip_interval=GOSSIP_INTERVAL,
+                 dedup_capacity=DEDUP_CAPACITY, dedup_ttl=DEDUP_TTL):
+        super().__init__(id, balance, branches, replication_mode, ordering, wal, stats, write_quorum, read_lease,
+                         gossip_interval, dedup_capacity, dedup_ttl)
+        # a thread lock would block the whole event loop
+        if ordering == "lock":
+            self.lock = asyncio.Lock()
+        # wakes up the queries waiting for writes
+        self.write_applied = asyncio.Condition()
+        self.gossip_task = None
+
+    def create_channel_manager(self):
+        return ChannelManager(aio=True, interceptors=self.client_interceptors)
+
+    def client_interceptors(self, branch_id):
+        if self.stats is None:
+            return []
+        return [AsyncClientLatencyInterceptor(self.stats, branch_id)]
+
+    def create_read_lease(self, duration):
+        return AsyncReadLease(self.sync_with_peers, duration)
+
+    def create_request_cache(self, capacity, ttl):
+        return AsyncRequestCache(self.request_key, capacity, ttl)
+
+    async def MsgDelivery(self, request, context):
+        if self.requests is None:
+            return await self.deliver(request)
+        return await self.requests.handle(request, functools.partial(self.deliver, request))
+
+    async def deliver(self, request):
+        type = request.type
+        response = []
+        if type == "sync":
+            response = [await self.flush_to(request.id)]
+            return distributed_banking_system_pb2.BankingOperationResponse(id=self.id, recv=response)
+        if type == "gossip":
+            async with self.lock:
+                events, digest = self.process_gossip(request)
+                await self.notify_write_applied()
+            return distributed_banking_system_pb2.BankingOperationResponse(id=self.id, events=events, digest=digest)
+        if type == "chain":
+            response = await self.process_chain_events(request)
+        else:
+            async with self.lock:
+                match type:
+                    case "customer":
+                        response = await self.process_customer_events(request)
+                    case "branch":
+                        response = self.process_branch_events(request)
+                        # queries of other branches' customers may be waiting for these writes
+                        await self.notify_write_applied()
+
+        if self.wal is not None:
+            await asyncio.to_thread(self.wait_durable)
+        return distributed_banking_system_pb2.BankingOperationResponse(id=self.id, recv=response)
+
+    async def process_customer_events(self, request):
+        self.stamp_customer(request)
+        await self.hold_read_lease(request)
+        response = list()
+        replica_branch_responses = list()
+        for event in request.events:
+            match event.interface:
+                case "query":
+                    response.append(await self.query(event))
+                case "deposit" | "withdraw":
+                    write_response, propagate_write_response = await self.write(event)
+                    response.append(write_response)
+                    replica_branch_responses.extend(propagate_write_response)
+
+        self.record_replica_responses(replica_branch_responses)
+        return response
+
+    async def hold_read_lease(self, request):
+        if has_queries(request) and not await self.lease.hold():
+            print(f"Branch {self.id} answers a query without having synced with its peers")
+
+    async def sync_with_peers(self):
+        if self.quorum is None:
+            return True
+        request = self.sync_request()
+        return self.synced(await asyncio.gather(*(stub.MsgDelivery(request, timeout=SYNC_TIMEOUT)
+                                                  for stub in self.stubList), return_exceptions=True))
+
+    async def flush_to(self, branch_id):
+        flushed = self.quorum is None or await self.quorum.flush_async(branch_id, SYNC_TIMEOUT)
+        return self.sync_response(flushed)
+
+    async def query(self, request):
+        tail = self.read_from()
+        if tail is not None:
+            try:
+                return protobuf_to_dict((await self.stub_for(tail).MsgDelivery(self.tail_request(request))).recv[0])
+            except grpc.RpcError as e:
+                print(f"Failed to reach the tail of the chain, branch {tail}: {e.code()}")
+        written, timeout = self.read_barrier(request)
+        if not await self.wait_for_writes(written, timeout):
+            print(f"Branch {self.id} answered a query before the writes of its session {decode_token(request.session)}")
+        return self.balance_response(request)
+
+    async def write(self, event):
+        if not self.begin_write(event):
+            return self.write_response(event.interface, "failed", event), []
+        result = "failed"
         replica_branch_responses = []
-        for stub in self.stubList:
-            response = stub.MsgDelivery(
-                distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="branch", events=[event]))
-            if response.recv[0].result != "success":
-                print(f"Failed to replicate withdrawal to branch {self.stubList.index(stub) + 1}")
-            replica_branch_responses.append(response)
-        return replica_branch_responses
+        try:
+            replica_branch_responses = await self.replicate(event)
+            result = "success"
+        except Exception:
+            result = "failed"
+            replica_branch_responses = []
+        finally:
+            self.finish_write(event, result == "success")
+            await self.notify_write_applied()
+        return self.write_response(event.interface, result, event), replica_branch_responses
+
+    async def process_chain_events(self, request):
+        async with self.lock:
+            response = self.process_branch_events(request)
+            await self.notify_write_applied()
+        successor = self.chain_successor(request)
+        if successor is not None:
+            await self.stub_for(successor).MsgDelivery(request)
+        return response
+
+    async def wait_for_writes(self, predicate, timeout=None):
+        # WriteVersions.wait_until on the event loop, returns False on timeout
+        try:
+            await asyncio.wait_for(self.writes_applied(predicate), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def writes_applied(self, predicate):
+        async with self.write_applied:
+            await self.write_applied.wait_for(predicate)
+
+    async def notify_write_applied(self):
+        async with self.write_applied:
+            self.write_applied.notify_all()
 
+    def start_gossip(self):
+        if self.operations is not None:
+            self.gossip_task = asyncio.ensure_future(self.gossip_loop())
 
-def serve(port, id, balance, branch_id_list, result_queue):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(Branch(id, balance, branch_id_list),
-                                                                             server)
+    def stop_gossip(self):
+        if self.gossip_task is not None:
+            self.gossip_task.cancel()
+
+    async def gossip_loop(self):
+        while True:
+            await asyncio.sleep(self.gossip_interval)
+            for branch_id in self.operations.pick_peers():
+                try:
+                    await self.gossip_with(branch_id)
+                except Exception as e:
+                    print(f"Gossip with branch {branch_id} failed: {e!r}")
+
+    async def gossip_with(self, branch_id):
+        stub = self.channels.stub(branch_id)
+        try:
+            missing = await self.catch_up(await stub.MsgDelivery(self.gossip_request(), timeout=GOSSIP_TIMEOUT,
+                                                                 wait_for_ready=False))
+            if missing:
+                await self.catch_up(await stub.MsgDelivery(self.gossip_request(missing), timeout=GOSSIP_TIMEOUT,
+                                                           wait_for_ready=False))
+        except grpc.RpcError as e:
+            self.operations.exchange_failed()
+            print(f"Failed to gossip with branch {branch_id}: {e.code()}")
+
+    async def catch_up(self, response):
+        async with self.lock:
+            self.apply_operations(response.events)
+            await self.notify_write_applied()
+        return self.observe_peer(response)
+
+    def release_version(self, event):
+        request, stubs = self.start_release(event)
+        for stub in stubs:
+            task = asyncio.ensure_future(stub.MsgDelivery(request))
+            self.releases.add(task)
+            task.add_done_callback(self.release_done)
+
+    async def replicate(self, event):
+        return self.check_replicas(event, await self.send_to_peers(event))
+
+    async def send_to_peers(self, event):
+        return await self.peer_sender()(self.propagation_request(event))
+
+    async def send_in_turn(self, request):
+        return [(branch_id, await stub.MsgDelivery(request)) for branch_id, stub in self.peer_stubs()]
+
+    async def send_to_quorum(self, request):
+        return await self.quorum.replicate_async(describe_write(request.events), self.quorum_peers(request))
+
+    async def send_down_chain(self, request):
+        first = self.start_chain(request)
+        if first is None:
+            return []
+        return [(first, await self.stub_for(first).MsgDelivery(request))]
+
+    async def fan_out(self, request):
+        results = await asyncio.gather(*(stub.MsgDelivery(request) for stub in self.stubList), return_exceptions=True)
+        return self.gathered(zip(self.branch_id_list, results))
+
+
+def has_queries(request):
+    return any(event.interface == "query" for event in request.events)
+
+
+def outcome(call):
+    # the response of a grpc future, or the RpcError it failed with, once it is done
+    error = call.exception()
+    return error if error is not None else call.result()
+
+
+def describe_write(events):
+    # how the quorum records name a write
+    return ", ".join(f"{event.interface} {event.id}" for event in events)
+
+
+def serve(port, id, balance, branch_id_list, result_queue, server_mode=SERVER_MODE):
+    wal, balance = open_write_ahead_log(id, balance)
+    if server_mode == "aio":
+        asyncio.run(serve_async(port, id, balance, branch_id_list, wal))
+        return
+
+    stats = LatencyStats() if LATENCY_STATS else None
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), options=SERVER_OPTIONS,
+                         interceptors=[ServerLatencyInterceptor(stats)] if stats is not None else None)
+    branch = Branch(id, balance, branch_id_list, wal=wal, stats=stats)
+    dump_stats_on_signal(id, stats, branch)
+    distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(branch, server)
     server.add_insecure_port("[::]:" + port)
     server.start()
     print("Server started, listening on " + port)
+    # connect to the peers before the first customer request needs them
+    branch.channels.warm_up(branch.branch_id_list)
+    print(f"Branch {id} peer channels: {branch.channels.connection_states()}")
+    branch.start_gossip()
     wait_for_termination(server)
+    branch.stop_gossip()
+    branch.channels.close()
+    dump_stats(id, stats, branch)
+    if wal is not None:
+        wal.close()
     result_queue.put(server)
 
 
+def dump_stats(id, stats, branch):
+    if stats is not None:
+        stats.dump(f"Branch {id} latency")
+    if branch.quorum is not None:
+        print(f"Branch {id} quorum writes: {json.dumps(branch.quorum.snapshot())}")
+    print(f"Branch {id} read lease: {json.dumps(branch.lease.snapshot())}")
+    if branch.operations is not None:
+        print(f"Branch {id} gossip: {json.dumps(branch.operations.snapshot())}")
+    if branch.requests is not None:
+        print(f"Branch {id} request cache: {json.dumps(branch.requests.snapshot())}")
+
+
+def dump_stats_on_signal(id, stats, branch, loop=None):
+    # kill -USR1 <pid> prints the branch's p50/p99/p999 per request type, interface and peer, what its
+    # quorum writes left unacknowledged, its read lease renewals and expirations, its gossip exchanges and the
+    # requests it answered from its request cache
+    # With an event loop the dump runs as one of its callbacks: a signal.signal() handler would interrupt the
+    # loop's thread, which may hold the locks the dump takes, and wait for them forever
+    if hasattr(signal, "SIGUSR1"):
+        if loop is not None:
+            loop.add_signal_handler(signal.SIGUSR1, dump_stats, id, stats, branch)
+        else:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: dump_stats(id, stats, branch))
+
+
+def open_write_ahead_log(id, balance):
+    # Recover the branch from its newest snapshot and log tail, returns (log, balance)
+    if STATE_DIRECTORY is None:
+        return None, balance
+    wal = WriteAheadLog(os.path.join(STATE_DIRECTORY, f"branch_{id}"))
+    recovered_balance = wal.recover(balance)
+    print(f"Branch {id} recovered balance {recovered_balance}")
+    return wal, recovered_balance
+
+
+async def serve_async(port, id, balance, branch_id_list, wal=None):
+    # the aio channels of the peer stubs bind to the running loop, so the servicer is built in here
+    stats = LatencyStats() if LATENCY_STATS else None
+    server = grpc.aio.server(options=SERVER_OPTIONS,
+                             interceptors=[AsyncServerLatencyInterceptor(stats)] if stats is not None else None)
+    branch = AsyncBranch(id, balance, branch_id_list, wal=wal, stats=stats)
+    dump_stats_on_signal(id, stats, branch, asyncio.get_running_loop())
+    distributed_banking_system_pb2_grpc.add_BankingServiceServicer_to_server(branch, server)
+    server.add_insecure_port("[::]:" + port)
+    await server.start()
+    print("Async server started, listening on " + port)
+    await branch.channels.warm_up_async(branch.branch_id_list)
+    print(f"Branch {id} peer channels: {branch.channels.connection_states()}")
+    branch.start_gossip()
+    try:
+        await server.wait_for_termination()
+    finally:
+        branch.stop_gossip()
+        await server.stop(None)
+        await branch.channels.close_async()
+        dump_stats(id, stats, branch)
+        if wal is not None:
+            wal.close()
+
+
 def wait_for_termination(server):
     try:
-        while True:
-            time.sleep(_ONE_DAY.total_seconds())
+        server.wait_for_termination()
     except KeyboardInterrupt:
         server.stop(None)
 
@@ -228,19 +957,6 @@ def populate_branch_id_list(branch_id_list):
         print(f"An error occurred: {str(e)}")
 
 
-def protobuf_to_dict(message):
-    result = {}
-    for field, value in message.ListFields():
-        if field.type == field.TYPE_MESSAGE:
-            if field.label == field.LABEL_REPEATED:
-                result[field.name] = [protobuf_to_dict(item) for item in value]
-            else:
-                result[field.name] = protobuf_to_dict(value)
-        else:
-            result[field.name] = value
-    return result
-
-
 if __name__ == "__main__":
     logging.basicConfig()
     branch_id_list = []
@@ -1,41 +1,39 @@
 import multiprocessing
-import os
 import sys
 
-import grpc
 import distributed_banking_system_pb2
-import distributed_banking_system_pb2_grpc
+from channel_manager import ChannelManager, CUSTOMER_CHANNEL_OPTIONS, CUSTOMER_WARM_UP_TIMEOUT
+from customer_driver import run_customers
+from output_collector import OutputCollector
+from protobuf_conversion import protobuf_to_dict
+from write_versions import encode_token
 import json
 import time
 
 OUTPUT_FILE_PATH = "./Output/output.json"
+# "process" starts one process per customer, "pool" runs all customers on a few worker processes
+# with an event loop each
+DRIVER_MODE = "process"
+# "json" writes one JSON list of the responses of every customer, "ndjson" one JSON object per line
+OUTPUT_FORMAT = "json"
 
 
 def dict_to_str(response):
     return str(protobuf_to_dict(response)) + "\n"
 
 
-def protobuf_to_dict(message):
-    result = {}
-    for field, value in message.ListFields():
-        if field.type == field.TYPE_MESSAGE:
-            if field.label == field.LABEL_REPEATED:
-                result[field.name] = [protobuf_to_dict(item) for item in value]
-            else:
-                result[field.name] = protobuf_to_dict(value)
-        else:
-            result[field.name] = value
-    return result
-
-
 class Customer:
-    def __init__(self, id, events):
+    def __init__(self, id, events, channels=None):
         # unique ID of the Customer
         self.id = id
         # events from the input
         self.events = events
         # a list of received messages used for debugging purpose
         self.recvMsg = list()
+        # the channels to the branches, kept connected by the manager; a pool worker shares its manager
+        self.channels = channels if channels is not None else ChannelManager(options=CUSTOMER_CHANNEL_OPTIONS)
+        # session token: the highest version of the customer's writes per branch that originated them
+        self.session = dict()
         # pointer for the stub
         self.stub = self.createStub(events)
 
@@ -45,28 +43,35 @@ class Customer:
         for event in events:
             branch_ids.add(event["branch"])
 
-        for id in branch_ids:
-            port = str(50050 + int(id))
-
-            address = f"localhost:{port}"
-            channel = grpc.insecure_channel(address)
-            stub_dict[id] = distributed_banking_system_pb2_grpc.BankingServiceStub(channel)
+        self.channels.warm_up(branch_ids, CUSTOMER_WARM_UP_TIMEOUT)
+        for branch_id in branch_ids:
+            stub_dict[branch_id] = self.channels.stub(branch_id)
 
         return stub_dict
 
     def executeEvents(self):
         banking_service_stub_dict = self.stub
         events = self.events
-        id = self.id
         responses = []
         for event in events:
             branch_id = event["branch"]
             event.pop('branch', None)
-            response = banking_service_stub_dict[branch_id].MsgDelivery(
-                distributed_banking_system_pb2.BankingOperationRequest(id=id, type="customer", events=[event]))
+            response = banking_service_stub_dict[branch_id].MsgDelivery(self.prepare_request(event))
+            self.observe_session(response)
             responses.append(response)
         return responses
 
+    def prepare_request(self, event):
+        # a query carries the session token, the branch answers it once it has applied the customer's writes
+        if event["interface"] == "query" and self.session:
+            event = dict(event, session=encode_token(self.session))
+        return distributed_banking_system_pb2.BankingOperationRequest(id=self.id, type="customer", events=[event])
+
+    def observe_session(self, response):
+        for result in response.recv:
+            if result.version > self.session.get(result.branch, 0):
+                self.session[result.branch] = result.version
+
     def update_recvMsg(self, branch_response):
         for response in branch_response:
             branch_dict_response = protobuf_to_dict(response)
@@ -75,19 +80,45 @@ class Customer:
         return self.recvMsg
 
 
-def start_customer_process(id, events):
+class AsyncCustomer(Customer):
+    # Customer session of the pool driver, on the worker's shared grpc.aio channels
+
+    def createStub(self, events):
+        # the driver warmed up the channels to every branch before the sessions start
+        return {event["branch"]: self.channels.stub(event["branch"]) for event in events}
+
+    async def executeEvents(self):
+        responses = []
+        for event in self.events:
+            branch_id = event["branch"]
+            event.pop('branch', None)
+            response = await self.stub[branch_id].MsgDelivery(self.prepare_request(event))
+            self.observe_session(response)
+            responses.append(response)
+        return responses
+
+
+async def run_customer_session(item, channels):
+    customer = AsyncCustomer(item["id"], item["events"], channels)
+    branch_response = await customer.executeEvents()
+    return customer.update_recvMsg(branch_response)
+
+
+def run_customer_pool(customers, collector):
+    branch_ids = sorted({event["branch"] for item in customers for event in item["events"]})
+    results = run_customers(customers, run_customer_session, branch_ids)
+    for index, result in enumerate(results):
+        collector.put(index, result)
+
+
+def start_customer_process(index, id, events, output_queue):
     customer = Customer(id, events)
     branch_response = customer.executeEvents()
+    customer.channels.close()
     branch_response = customer.update_recvMsg(branch_response)
-
-    directory = os.path.dirname(OUTPUT_FILE_PATH)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    output_file = open(OUTPUT_FILE_PATH, "w")
-    output_file.write(json.dumps(branch_response, indent=4))
-    # output_file.write(dict_to_str(branch_response))
-    output_file.close()
+    # the collector in the parent is the only writer of the output file, the responses of every
+    # customer end up in it in input order
+    output_queue.put((index, branch_response))
 
 
 def run_checker_scripts():
@@ -122,20 +153,23 @@ if __name__ == '__main__':
         processes = []
         result_queue = multiprocessing.Queue()
         parsed_data = json.load(input_file)
-        for item in parsed_data:
-            if item["type"] != "customer":
-                continue
-
-            id = item["id"]
-            type = item["type"]
-            events = item["events"]
-            process = multiprocessing.Process(target=start_customer_process,
-                                              args=(id, events))
-            processes.append(process)
-            process.start()
-
-        for process in processes:
-            process.join()
+        customers = [item for item in parsed_data if item["type"] == "customer"]
+        collector = OutputCollector(OUTPUT_FILE_PATH, OUTPUT_FORMAT)
+        if DRIVER_MODE == "pool":
+            run_customer_pool(customers, collector)
+        else:
+            for index, item in enumerate(customers):
+                id = item["id"]
+                type = item["type"]
+                events = item["events"]
+                process = multiprocessing.Process(target=start_customer_process,
+                                                  args=(index, id, events, collector.queue))
+                processes.append(process)
+                process.start()
+
+            for process in processes:
+                process.join()
+        collector.close()
         # run_checker_scripts()
         print("Customer process completed\n")
     except FileNotFoundError:
@@ -0,0 +1,53 @@
+import asyncio
+import multiprocessing
+import os
+
+from channel_manager import ChannelManager, CUSTOMER_CHANNEL_OPTIONS, CUSTOMER_WARM_UP_TIMEOUT
+
+# worker processes of the pool driver
+DRIVER_WORKERS = os.cpu_count() or 1
+# customer sessions a worker runs at the same time on its event loop
+CUSTOMERS_PER_WORKER = 64
+
+
+def run_customers(customers, run_customer, branch_ids, workers=DRIVER_WORKERS, concurrency=CUSTOMERS_PER_WORKER):
+    # Run every customer of the input on a bounded pool instead of one process per customer. Each worker
+    # process runs its share of the customers on one asyncio event loop and shares one channel per branch
+    # between them. `run_customer(customer, channels)` is a coroutine that sends the customer's requests in
+    # order; the results come back in input order once every customer has completed. A customer whose
+    # session fails is left out, like a customer process that dies.
+    indexed_customers = list(enumerate(customers))
+    workers = max(1, min(workers, len(indexed_customers)))
+    shares = [(indexed_customers[worker::workers], run_customer, branch_ids, concurrency) for worker in range(workers)]
+    # spawned, not forked: a forked worker inherits the gRPC state of the parent and can hang on its first call
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        worker_results = pool.starmap(run_worker, shares)
+
+    results = [None] * len(indexed_customers)
+    for worker_result in worker_results:
+        for index, result in worker_result:
+            results[index] = result
+    return [result for result in results if result is not None]
+
+
+def run_worker(indexed_customers, run_customer, branch_ids, concurrency):
+    return asyncio.run(drive_customers(indexed_customers, run_customer, branch_ids, concurrency))
+
+
+async def drive_customers(indexed_customers, run_customer, branch_ids, concurrency):
+    channels = ChannelManager(aio=True, options=CUSTOMER_CHANNEL_OPTIONS)
+    await channels.warm_up_async(branch_ids, CUSTOMER_WARM_UP_TIMEOUT)
+    sessions = asyncio.Semaphore(concurrency)
+
+    async def run_session(index, customer):
+        async with sessions:
+            try:
+                return index, await run_customer(customer, channels)
+            except Exception as e:
+                print(f"Customer {customer['id']} failed: {e}")
+                return index, None
+
+    try:
+        return await asyncio.gather(*(run_session(index, customer) for index, customer in indexed_customers))
+    finally:
+        await channels.close_async()
@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n distributed_banking_system.proto\x12\x13\x64istributed_banking\"_\n\x17\x42\x61nkingOperationRequest\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x0c\n\x04type\x18\x02 \x01(\t\x12*\n\x06\x65vents\x18\x03 \x03(\x0b\x32\x1a.distributed_banking.Event\"V\n\x18\x42\x61nkingOperationResponse\x12\n\n\x02id\x18\x01 \x01(\x05\x12.\n\x04recv\x18\x02 \x03(\x0b\x32 .distributed_banking.EventResult\"5\n\x05\x45vent\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x11\n\tinterface\x18\x02 \x01(\t\x12\r\n\x05money\x18\x03 \x01(\x05\"b\n\x0b\x45ventResult\x12\x11\n\tinterface\x18\x01 \x01(\t\x12\x0e\n\x06result\x18\x02 \x01(\t\x12\x14\n\x07\x62\x61lance\x18\x03 \x01(\x05H\x00\x88\x01\x01\x12\x0e\n\x06\x62ranch\x18\x04 \x01(\x05\x42\n\n\x08_balance2|\n\x0e\x42\x61nkingService\x12j\n\x0bMsgDelivery\x12,.distributed_banking.BankingOperationRequest\x1a-.distributed_banking.BankingOperationResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n distributed_banking_system.proto\x12\x13\x64istributed_banking\"s\n\x17\x42\x61nkingOperationRequest\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x0c\n\x04type\x18\x02 \x01(\t\x12*\n\x06\x65vents\x18\x03 \x03(\x0b\x32\x1a.distributed_banking.Event\x12\x12\n\x06\x64igest\x18\x04 \x03(\x05\x42\x02\x10\x01\"\x96\x01\n\x18\x42\x61nkingOperationResponse\x12\n\n\x02id\x18\x01 \x01(\x05\x12.\n\x04recv\x18\x02 \x03(\x0b\x32 .distributed_banking.EventResult\x12*\n\x06\x65vents\x18\x03 \x03(\x0b\x32\x1a.distributed_banking.Event\x12\x12\n\x06\x64igest\x18\x04 \x03(\x05\x42\x02\x10\x01\"\x8e\x01\n\x05\x45vent\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x11\n\tinterface\x18\x02 \x01(\t\x12\r\n\x05money\x18\x03 \x01(\x05\x12\x0f\n\x07version\x18\x04 \x01(\x05\x12\x0f\n\x07\x61\x63\x63ount\x18\x05 \x01(\x05\x12\x13\n\x07session\x18\x06 \x03(\x05\x42\x02\x10\x01\x12\x0e\n\x06origin\x18\x07 \x01(\x05\x12\x10\n\x08\x63ustomer\x18\x08 \x01(\x05\"s\n\x0b\x45ventResult\x12\x11\n\tinterface\x18\x01 \x01(\t\x12\x0e\n\x06result\x18\x02 \x01(\t\x12\x14\n\x07\x62\x61lance\x18\x03 \x01(\x05H\x00\x88\x01\x01\x12\x0e\n\x06\x62ranch\x18\x04 \x01(\x05\x12\x0f\n\x07version\x18\x05 \x01(\x05\x42\n\n\x08_balance2|\n\x0e\x42\x61nkingService\x12j\n\x0bMsgDelivery\x12,.distributed_banking.BankingOperationRequest\x1a-.distributed_banking.BankingOperationResponseb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -21,14 +21,20 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'distributed_banking_system_
 if _descriptor._USE_C_DESCRIPTORS == False:
 
   DESCRIPTOR._options = None
+  _BANKINGOPERATIONREQUEST.fields_by_name['digest']._options = None
+  _BANKINGOPERATIONREQUEST.fields_by_name['digest']._serialized_options = b'\020\001'
+  _BANKINGOPERATIONRESPONSE.fields_by_name['digest']._options = None
+  _BANKINGOPERATIONRESPONSE.fields_by_name['digest']._serialized_options = b'\020\001'
+  _EVENT.fields_by_name['session']._options = None
+  _EVENT.fields_by_name['session']._serialized_options = b'\020\001'
   _globals['_BANKINGOPERATIONREQUEST']._serialized_start=57
-  _globals['_BANKINGOPERATIONREQUEST']._serialized_end=152
-  _globals['_BANKINGOPERATIONRESPONSE']._serialized_start=154
-  _globals['_BANKINGOPERATIONRESPONSE']._serialized_end=240
-  _globals['_EVENT']._serialized_start=242
-  _globals['_EVENT']._serialized_end=295
-  _globals['_EVENTRESULT']._serialized_start=297
-  _globals['_EVENTRESULT']._serialized_end=395
-  _globals['_BANKINGSERVICE']._serialized_start=397
-  _globals['_BANKINGSERVICE']._serialized_end=521
+  _globals['_BANKINGOPERATIONREQUEST']._serialized_end=172
+  _globals['_BANKINGOPERATIONRESPONSE']._serialized_start=175
+  _globals['_BANKINGOPERATIONRESPONSE']._serialized_end=325
+  _globals['_EVENT']._serialized_start=328
+  _globals['_EVENT']._serialized_end=470
+  _globals['_EVENTRESULT']._serialized_start=472
+  _globals['_EVENTRESULT']._serialized_end=587
+  _globals['_BANKINGSERVICE']._serialized_start=589
+  _globals['_BANKINGSERVICE']._serialized_end=713
 # @@protoc_insertion_point(module_scope)
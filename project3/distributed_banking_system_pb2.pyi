@@ -6,41 +6,59 @@ from typing import ClassVar as _ClassVar, Iterable as _Iterable, Mapping as _Map
 DESCRIPTOR: _descriptor.FileDescriptor
 
 class BankingOperationRequest(_message.Message):
-    __slots__ = ["id", "type", "events"]
+    __slots__ = ["id", "type", "events", "digest"]
     ID_FIELD_NUMBER: _ClassVar[int]
     TYPE_FIELD_NUMBER: _ClassVar[int]
     EVENTS_FIELD_NUMBER: _ClassVar[int]
+    DIGEST_FIELD_NUMBER: _ClassVar[int]
     id: int
     type: str
     events: _containers.RepeatedCompositeFieldContainer[Event]
-    def __init__(self, id: _Optional[int] = ..., type: _Optional[str] = ..., events: _Optional[_Iterable[_Union[Event, _Mapping]]] = ...) -> None: ...
+    digest: _containers.RepeatedScalarFieldContainer[int]
+    def __init__(self, id: _Optional[int] = ..., type: _Optional[str] = ..., events: _Optional[_Iterable[_Union[Event, _Mapping]]] = ..., digest: _Optional[_Iterable[int]] = ...) -> None: ...
 
 class BankingOperationResponse(_message.Message):
-    __slots__ = ["id", "recv"]
+    __slots__ = ["id", "recv", "events", "digest"]
     ID_FIELD_NUMBER: _ClassVar[int]
     RECV_FIELD_NUMBER: _ClassVar[int]
+    EVENTS_FIELD_NUMBER: _ClassVar[int]
+    DIGEST_FIELD_NUMBER: _ClassVar[int]
     id: int
     recv: _containers.RepeatedCompositeFieldContainer[EventResult]
-    def __init__(self, id: _Optional[int] = ..., recv: _Optional[_Iterable[_Union[EventResult, _Mapping]]] = ...) -> None: ...
+    events: _containers.RepeatedCompositeFieldContainer[Event]
+    digest: _containers.RepeatedScalarFieldContainer[int]
+    def __init__(self, id: _Optional[int] = ..., recv: _Optional[_Iterable[_Union[EventResult, _Mapping]]] = ..., events: _Optional[_Iterable[_Union[Event, _Mapping]]] = ..., digest: _Optional[_Iterable[int]] = ...) -> None: ...
 
 class Event(_message.Message):
-    __slots__ = ["id", "interface", "money"]
+    __slots__ = ["id", "interface", "money", "version", "account", "session", "origin", "customer"]
     ID_FIELD_NUMBER: _ClassVar[int]
     INTERFACE_FIELD_NUMBER: _ClassVar[int]
     MONEY_FIELD_NUMBER: _ClassVar[int]
+    VERSION_FIELD_NUMBER: _ClassVar[int]
+    ACCOUNT_FIELD_NUMBER: _ClassVar[int]
+    SESSION_FIELD_NUMBER: _ClassVar[int]
+    ORIGIN_FIELD_NUMBER: _ClassVar[int]
+    CUSTOMER_FIELD_NUMBER: _ClassVar[int]
     id: int
     interface: str
     money: int
-    def __init__(self, id: _Optional[int] = ..., interface: _Optional[str] = ..., money: _Optional[int] = ...) -> None: ...
+    version: int
+    account: int
+    session: _containers.RepeatedScalarFieldContainer[int]
+    origin: int
+    customer: int
+    def __init__(self, id: _Optional[int] = ..., interface: _Optional[str] = ..., money: _Optional[int] = ..., version: _Optional[int] = ..., account: _Optional[int] = ..., session: _Optional[_Iterable[int]] = ..., origin: _Optional[int] = ..., customer: _Optional[int] = ...) -> None: ...
 
 class EventResult(_message.Message):
-    __slots__ = ["interface", "result", "balance", "branch"]
+    __slots__ = ["interface", "result", "balance", "branch", "version"]
     INTERFACE_FIELD_NUMBER: _ClassVar[int]
     RESULT_FIELD_NUMBER: _ClassVar[int]
     BALANCE_FIELD_NUMBER: _ClassVar[int]
     BRANCH_FIELD_NUMBER: _ClassVar[int]
+    VERSION_FIELD_NUMBER: _ClassVar[int]
     interface: str
     result: str
     balance: int
     branch: int
-    def __init__(self, interface: _Optional[str] = ..., result: _Optional[str] = ..., balance: _Optional[int] = ..., branch: _Optional[int] = ...) -> None: ...
+    version: int
+    def __init__(self, interface: _Optional[str] = ..., result: _Optional[str] = ..., balance: _Optional[int] = ..., branch: _Optional[int] = ..., version: _Optional[int] = ...) -> None: ...
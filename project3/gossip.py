@@ -0,0 +1,103 @@
+import random
+import threading
+
+import distributed_banking_system_pb2
+
+# seconds between the gossip rounds of a branch, None turns gossip off; it runs a thread or task per branch that
+# calls random peers, so a branch only gossips when it is asked to
+GOSSIP_INTERVAL = None
+# peers a branch exchanges digests with per round
+GOSSIP_FANOUT = 2
+# seconds a gossip call may take; it does not wait for an unreachable peer to come back
+GOSSIP_TIMEOUT = 5.0
+# operations sent in one gossip message at most, the rest follow in the next rounds
+GOSSIP_BATCH = 1000
+# operations kept per origin for the peers that have not caught up, beyond it the oldest are dropped
+OPERATION_LOG_LIMIT = 100000
+
+
+class OperationLog:
+    # The writes and releases a branch applied, per origin and version, for its gossip peers to catch up
+    # from. Every round a branch sends a few random peers its digest, the high-water mark of the versions it
+    # applied per origin, and each peer answers with the operations above it and its own digest, which the
+    # branch answers with the operations the peer is missing. An update spreads to every branch in a number
+    # of rounds that grows with the logarithm of the branch count, and a branch that missed a propagation or
+    # a release catches up without anyone retrying. An operation is dropped from the log once the digest of
+    # every other branch covers it.
+
+    def __init__(self, branch_ids, peers, fanout=GOSSIP_FANOUT, batch=GOSSIP_BATCH, limit=OPERATION_LOG_LIMIT):
+        # the other branches
+        self.peers = peers
+        self.fanout = fanout
+        self.batch = batch
+        self.limit = limit
+        self.lock = threading.Lock()
+        # origin -> {version: operation}, in the order they were applied here
+        self.operations = {branch_id: dict() for branch_id in branch_ids}
+        # last digest heard from every other branch
+        self.peer_digests = dict()
+        # metrics
+        self.rounds = 0
+        self.exchanges = 0
+        self.failed_exchanges = 0
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    def record(self, origin, event):
+        # a copy without the session token, stamped with its origin
+        operation = distributed_banking_system_pb2.Event(id=event.id, interface=event.interface, money=event.money,
+                                                         version=event.version, account=event.account,
+                                                         origin=origin)
+        with self.lock:
+            operations = self.operations.setdefault(origin, dict())
+            operations[event.version] = operation
+            if len(operations) > self.limit:
+                del operations[next(iter(operations))]
+                self.dropped += 1
+
+    def pick_peers(self):
+        with self.lock:
+            self.rounds += 1
+        return random.sample(self.peers, min(self.fanout, len(self.peers)))
+
+    def missing(self, digest):
+        # the operations above the digest, at most a batch of them
+        with self.lock:
+            missing = []
+            for origin, operations in self.operations.items():
+                known = digest.get(origin, 0)
+                missing += [operation for version, operation in operations.items() if version > known]
+            missing = missing[:self.batch]
+            self.sent += len(missing)
+        return missing
+
+    def observe(self, branch_id, digest):
+        # Remember what the peer has and drop the operations every branch has
+        with self.lock:
+            self.exchanges += 1
+            self.peer_digests[branch_id] = digest
+            if any(peer not in self.peer_digests for peer in self.peers):
+                return
+            for origin, operations in self.operations.items():
+                covered = min(self.peer_digests[peer].get(origin, 0) for peer in self.peers)
+                for version in [version for version in operations if version <= covered]:
+                    del operations[version]
+
+    def caught_up(self, received):
+        with self.lock:
+            self.received += received
+
+    def exchange_failed(self):
+        with self.lock:
+            self.failed_exchanges += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"rounds": self.rounds,
+                    "exchanges": self.exchanges,
+                    "failed_exchanges": self.failed_exchanges,
+                    "sent": self.sent,
+                    "received": self.received,
+                    "logged": sum(len(operations) for operations in self.operations.values()),
+                    "dropped": self.dropped}
@@ -0,0 +1,88 @@
+import json
+import multiprocessing
+import os
+import queue
+import textwrap
+import threading
+
+# results the writer takes off the queue before it writes them with one call
+OUTPUT_BATCH_SIZE = 256
+# bytes buffered before the output file is written to
+OUTPUT_BUFFER_SIZE = 1 << 20
+# put on the queue by close() once no customer is left to report
+_DONE = None
+
+
+class OutputCollector:
+    # Single writer of an output file. Customers put (index, records) on `queue`, from this process or
+    # from customer processes; one thread takes them off in batches and writes the records in index
+    # order, so the file is the same whatever order the customers complete in, and only the results
+    # that arrive before their turn are held in memory. Formats:
+    #   "lines"  one str(record) per line
+    #   "ndjson" one JSON object per line
+    #   "json"   one JSON list of all records, as json.dumps(records, indent=4) writes it
+
+    def __init__(self, path, format="lines", mode="w"):
+        self.format = format
+        self.queue = multiprocessing.Queue()
+        # results that arrived before the ones in front of them, by index
+        self.pending = dict()
+        self.next_index = 0
+        self.written = 0
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(path, mode, buffering=OUTPUT_BUFFER_SIZE)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def put(self, index, records):
+        self.queue.put((index, records))
+
+    def write_loop(self):
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while len(batch) < OUTPUT_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is _DONE:
+                    done = True
+                else:
+                    index, records = item
+                    self.pending[index] = records
+            self.write_ready(done)
+
+    def write_ready(self, done):
+        # Write the results that are next in order; once done, also the ones after a customer that never reported
+        chunks = []
+        while self.pending and (self.next_index in self.pending or done):
+            if self.next_index not in self.pending:
+                self.next_index = min(self.pending)
+            for record in self.pending.pop(self.next_index):
+                chunks.append(self.encode(record))
+            self.next_index += 1
+        if chunks:
+            self.file.write("".join(chunks))
+
+    def encode(self, record):
+        self.written += 1
+        match self.format:
+            case "json":
+                separator = "[\n" if self.written == 1 else ",\n"
+                return separator + textwrap.indent(json.dumps(record, indent=4), "    ")
+            case "ndjson":
+                return json.dumps(record) + "\n"
+            case _:
+                return str(record) + "\n"
+
+    def close(self):
+        # Call once every customer has reported: writes what is left and closes the file
+        self.queue.put(_DONE)
+        self.writer.join()
+        if self.format == "json":
+            self.file.write("\n]" if self.written else "[]")
+        self.file.close()
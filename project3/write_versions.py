@@ -0,0 +1,73 @@
+import threading
+
+# A session token is what a customer's session has written, as the highest version it saw per origin branch.
+# On the wire it is a packed repeated int32 of (origin, version) pairs, one pair per branch the session wrote
+# at, so a token costs nothing until the customer writes and grows with the branches it writes at.
+
+
+def encode_token(token):
+    pairs = []
+    for origin, version in token.items():
+        pairs += (origin, version)
+    return pairs
+
+
+def decode_token(pairs):
+    return dict(zip(pairs[0::2], pairs[1::2]))
+
+
+class WriteVersions:
+    # Every branch numbers the writes it originates 1, 2, 3, ... and sends that version along with the
+    # propagation. `applied[origin]` is the highest version up to which every write of that origin has been
+    # applied at this branch; versions that arrive ahead of a gap wait in `pending` until the gap closes.
+
+    def __init__(self, branch_ids):
+        # guards the version table; never held across an RPC
+        self.condition = threading.Condition()
+        # versions handed out to writes originated at this branch
+        self.issued = 0
+        self.applied = {branch_id: 0 for branch_id in branch_ids}
+        self.pending = {branch_id: set() for branch_id in branch_ids}
+        # (origin, version) of the writes that are being applied, so a copy that arrives meanwhile is dropped
+        self.claimed = set()
+
+    def issue(self):
+        with self.condition:
+            self.issued += 1
+            return self.issued
+
+    def claim(self, origin, version):
+        # Returns whether the write is new here; the caller applies it and then calls mark_applied()
+        with self.condition:
+            if (version <= self.applied.get(origin, 0) or version in self.pending.get(origin, ())
+                    or (origin, version) in self.claimed):
+                return False
+            self.claimed.add((origin, version))
+            return True
+
+    def mark_applied(self, origin, version):
+        with self.condition:
+            self.claimed.discard((origin, version))
+            applied = self.applied.setdefault(origin, 0)
+            pending = self.pending.setdefault(origin, set())
+            if version <= applied:
+                return
+            pending.add(version)
+            while applied + 1 in pending:
+                applied += 1
+                pending.remove(applied)
+            self.applied[origin] = applied
+            self.condition.notify_all()
+
+    def digest(self):
+        # the high-water mark per origin, what a peer has to send for this branch to catch up lies above it
+        with self.condition:
+            return dict(self.applied)
+
+    def covers(self, token):
+        return all(self.applied.get(origin, 0) >= version for origin, version in token.items())
+
+    def wait_until(self, written, timeout=None):
+        # Block until written() holds for the applied versions, returns False on timeout
+        with self.condition:
+            return self.condition.wait_for(written, timeout)